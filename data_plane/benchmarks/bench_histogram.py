@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+
+"""Benchmark of the delay histograms: memory per session and cost of
+recording the samples"""
+
+# General imports
+import random
+import sys
+import time
+from argparse import ArgumentParser
+
+# Data-plane dependencies
+from data_plane.twamp.histogram import DelayHistogram
+
+# Default number of samples recorded
+DEFAULT_NUM_SAMPLES = 2000000
+# Default number of sessions, i.e. histograms
+DEFAULT_NUM_SESSIONS = 10000
+# Range of the generated delays (in nanoseconds)
+MIN_DELAY = 10000
+MAX_DELAY = 100000000
+
+
+def histogram_size(rtt_histogram):
+    """Return the memory (in bytes) used by a histogram"""
+
+    return sys.getsizeof(rtt_histogram) + sys.getsizeof(rtt_histogram.counts)
+
+
+def bench_memory(num_sessions):
+    """Create a histogram per session and return the bytes per session"""
+
+    histograms = [DelayHistogram() for _ in range(num_sessions)]
+    return sum(histogram_size(rtt_histogram)
+               for rtt_histogram in histograms) / num_sessions
+
+
+def bench_record(num_samples):
+    """Record the samples in a histogram and return the time per sample
+    (in nanoseconds) and the histogram"""
+
+    samples = [random.randint(MIN_DELAY, MAX_DELAY)
+               for _ in range(num_samples)]
+    rtt_histogram = DelayHistogram()
+    start = time.perf_counter()
+    for sample in samples:
+        rtt_histogram.record(sample)
+    elapsed = time.perf_counter() - start
+    return elapsed / num_samples * 1e9, rtt_histogram
+
+
+def bench_percentile(rtt_histogram, repeat=1000):
+    """Return the time (in microseconds) of a percentile query"""
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rtt_histogram.percentile(99)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def parse_arguments():
+    """Parse options received from command-line"""
+
+    parser = ArgumentParser(
+        description='Benchmark of the delay histograms'
+    )
+    parser.add_argument(
+        '-n', '--num-samples', dest='num_samples', action='store', type=int,
+        default=DEFAULT_NUM_SAMPLES, help='Number of recorded samples'
+    )
+    parser.add_argument(
+        '-s', '--num-sessions', dest='num_sessions', action='store',
+        type=int, default=DEFAULT_NUM_SESSIONS,
+        help='Number of sessions used to measure the memory'
+    )
+    return parser.parse_args()
+
+
+def __main():
+    args = parse_arguments()
+    bytes_per_session = bench_memory(args.num_sessions)
+    print('Memory: {size:.0f} bytes per session ({num} sessions)'.format(
+        size=bytes_per_session, num=args.num_sessions))
+    ns_per_sample, rtt_histogram = bench_record(args.num_samples)
+    print('Record: {cost:.0f} ns per sample ({num} samples)'.format(
+        cost=ns_per_sample, num=args.num_samples))
+    print('Percentile: {cost:.1f} us per query'.format(
+        cost=bench_percentile(rtt_histogram)))
+    print('P50 {p50} - P99 {p99} - count {count}'.format(
+        p50=rtt_histogram.percentile(50), p99=rtt_histogram.percentile(99),
+        count=rtt_histogram.count))
+
+
+if __name__ == '__main__':
+    __main()
@@ -0,0 +1,396 @@
+#!/usr/bin/python
+
+
+"""End-to-end load test of a sender and a reflector in one process.
+
+N sessions are started on a SessionSender and on a SessionReflector
+sharing a simulated counter driver, which counts the packets of the
+production traffic of each path and drops a share of them. The TWAMP
+packets are exchanged through an in-memory transport and the time is a
+virtual clock, so the changes of color, the snapshots and the
+measurements are run by the schedulers of the daemon without waiting.
+For each number of sessions the test reports the TWAMP queries per
+second, the latency of the responses (from the transmission of the query
+to the processing of the response), the largest burst of queries sent
+in a tick of the clock and the accuracy of the computed loss, compared
+with the injected one. With --drop the transport drops a share of the
+TWAMP packets, and the test reports the share of the queries answered
+before their deadline (retransmissions included) and the number of
+retransmissions."""
+
+# General imports
+import contextlib
+import os
+import random
+import time
+from argparse import ArgumentParser
+from collections import deque
+from threading import Event
+
+# Scapy dependencies
+from scapy.layers.inet6 import IPv6, IPv6ExtHdrSegmentRouting
+
+# Data-plane dependencies
+from data_plane.benchmarks.bench_replay import FakeDriver, path_sid_lists
+from data_plane.twamp import admission, stagger, twamp, twamp_demon, utils
+from data_plane.twamp.histogram import DelayHistogram
+
+# Default numbers of sessions of the scaling curve
+DEFAULT_SESSIONS = '1,10,100,1000'
+# Default number of measured intervals
+DEFAULT_NUM_INTERVALS = 5
+# Default color options. The interval is in virtual seconds, so it does
+# not change the duration of the test
+DEFAULT_INTERVAL = 10
+DEFAULT_MARGIN = 2000
+# Default number of ticks of the virtual clock per interval
+DEFAULT_TICKS = 10
+# Default production packets sent per interval on each path and direction
+# and share of them dropped
+DEFAULT_PACKETS = 1000
+DEFAULT_LOSS = 0.01
+# Default share of the TWAMP packets dropped by the transport
+DEFAULT_DROP = 0.0
+
+
+class VirtualClock():
+    """A clock with the interface of clock.ClockOffsetEstimator, advanced
+    by the test"""
+
+    def __init__(self, start):
+        self.time = start
+        self.error = 0.0
+
+    def now(self):
+        """Return the current virtual time"""
+
+        return self.time
+
+    def advance(self, seconds):
+        """Move the clock forward"""
+
+        self.time += seconds
+
+
+class SimulatedDriver(FakeDriver):
+    """A driver counting the production packets of each flow and color.
+    The packets are marked with the active color, as done by the eBPF
+    programs, and a share of them is dropped between the TX and the RX
+    counters. The injected loss of each flow and color is kept as a
+    reference"""
+
+    def __init__(self, loss=DEFAULT_LOSS):
+        FakeDriver.__init__(self)
+        self.loss = loss
+        # (SID list key, color) -> cumulative counters
+        self.tx_counters = {}
+        self.rx_counters = {}
+        self.lost = {}
+
+    def send(self, sid_list_key, packets):
+        """Count packets sent on a SID list, dropping a share of them"""
+
+        counter = (sid_list_key, self.color)
+        # Stochastic rounding of the expected number of lost packets
+        lost = int(packets * self.loss + random.random())
+        self.tx_counters[counter] = self.tx_counters.get(counter, 0) + packets
+        self.rx_counters[counter] = \
+            self.rx_counters.get(counter, 0) + packets - lost
+        self.lost[counter] = self.lost.get(counter, 0) + lost
+
+    def read_tx_counter(self, color, sid_list):
+        """Return the TX counter of a flow"""
+
+        return self.tx_counters.get((utils.sid_list_key(sid_list), color), 0)
+
+    def read_rx_counter(self, color, sid_list):
+        """Return the RX counter of a flow"""
+
+        return self.rx_counters.get((utils.sid_list_key(sid_list), color), 0)
+
+    def get_lost(self, sid_list, color):
+        """Return the injected loss of a flow and color"""
+
+        return self.lost.get((utils.sid_list_key(sid_list), color), 0)
+
+
+class LoopbackTransport():
+    """An in-memory transport between a sender and a reflector. Each
+    packet carries the time of transmission of the query that originated
+    it, so the latency of the responses can be measured. A share of the
+    packets can be dropped"""
+
+    def __init__(self, receiver, drop=DEFAULT_DROP):
+        self.receiver = receiver
+        self.drop = drop
+        self.queries = deque()
+        self.responses = deque()
+        # Time of transmission of the query being processed
+        self.origin = None
+        self.queries_sent = 0
+        self.dropped = 0
+
+    def enqueue(self, queue, data):
+        """Enqueue a packet, unless it is dropped"""
+
+        if self.drop > 0 and random.random() < self.drop:
+            self.dropped += 1
+            return
+        queue.append((self.origin, data))
+
+    def send_query(self, pkt):
+        """Transmit path of the sender. No kernel timestamp is returned"""
+
+        self.origin = time.perf_counter()
+        self.queries_sent += 1
+        self.enqueue(self.queries, bytes(pkt))
+
+    def send_response(self, pkt):
+        """Transmit path of the reflector"""
+
+        self.enqueue(self.responses, bytes(pkt))
+
+    def pump(self, on_response):
+        """Deliver the queued packets until both the queues are empty.
+        on_response is called with the origin time and the packet of each
+        response, after the sender processed it"""
+
+        while self.queries or self.responses:
+            while self.queries:
+                self.origin, data = self.queries.popleft()
+                self.receiver.packet_recv_callback(IPv6(data))
+            while self.responses:
+                origin, data = self.responses.popleft()
+                packet = IPv6(data)
+                self.receiver.packet_recv_callback(packet)
+                on_response(origin, packet)
+
+
+class LoadTest():
+    """A load test with a given number of sessions"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, num_sessions, interval=DEFAULT_INTERVAL,
+                 margin=DEFAULT_MARGIN, packets=DEFAULT_PACKETS,
+                 loss=DEFAULT_LOSS, drop=DEFAULT_DROP,
+                 spread=stagger.DEFAULT_SPREAD,
+                 query_timeout=twamp_demon.DEFAULT_QUERY_TIMEOUT):
+
+        # pylint: disable=too-many-arguments
+
+        self.interval = interval
+        self.packets = packets
+        # Start just before a change of color
+        self.clock = VirtualClock(
+            (int(time.time() / interval) + 1) * interval - interval / 100)
+        self.driver = SimulatedDriver(loss)
+        stop_event = Event()
+        self.sender = twamp_demon.SessionSender(
+            self.driver, stop_event=stop_event, interval=interval,
+            margin=margin, clock=self.clock, spread=spread,
+            query_timeout=query_timeout)
+        # The queries of the test exceed the rate of the default admission
+        # control, since the time runs faster than the real one
+        self.reflector = twamp_demon.SessionReflector(
+            self.driver, stop_event=stop_event, interval=interval,
+            margin=margin, clock=self.clock,
+            admission_control=admission.AdmissionControl(
+                rate=None, global_rate=None))
+        receiver = twamp_demon.TestPacketReceiver(
+            None, self.sender, self.reflector)
+        self.transport = LoopbackTransport(receiver, drop)
+        self.sender.transmit = self.transport.send_query
+        self.reflector.transmit = self.transport.send_response
+
+        self.paths = [path_sid_lists(index) for index in range(num_sessions)]
+        self.sender.start_meas_many(
+            [(index, sid_list, rev_sid_list) for index, (sid_list,
+                                                         rev_sid_list)
+             in enumerate(self.paths)], interval, margin)
+        self.reflector.start_meas_many(self.paths, interval, margin)
+        self.keys = [(utils.sid_list_key(sid_list.split('/')),
+                      utils.sid_list_key(rev_sid_list.split('/')))
+                     for sid_list, rev_sid_list in self.paths]
+
+        # Results
+        self.latency = DelayHistogram()
+        self.responses = 0
+        # (path, sequence number) of the queries answered
+        self.answered = set()
+        self.peak = 0
+        self.exact = 0
+        self.injected_loss = 0
+        self.loss_error = 0
+        self.elapsed = 0.0
+
+    def start(self):
+        """Schedule the first change of color, as done by the threads"""
+
+        cc_time = self.sender.get_nexttime_to_change_color().timestamp()
+        self.sender.scheduler.enterabs(
+            cc_time, 1, self.sender.run_change_color, (cc_time,))
+        self.reflector.scheduler.enterabs(
+            cc_time, 1, self.reflector.run_change_color)
+
+    def tick(self, seconds):
+        """Advance the virtual clock, run the events of the daemon and
+        send the production traffic of the tick"""
+
+        self.clock.advance(seconds)
+        queries = self.transport.queries_sent
+        start = time.perf_counter()
+        self.sender.scheduler.run(blocking=False)
+        self.reflector.scheduler.run(blocking=False)
+        self.transport.pump(self.on_response)
+        self.elapsed += time.perf_counter() - start
+        self.peak = max(self.peak, self.transport.queries_sent - queries)
+        packets = int(self.packets * seconds / self.interval)
+        for sid_list_key, rev_sid_list_key in self.keys:
+            self.driver.send(sid_list_key, packets)
+            self.driver.send(rev_sid_list_key, packets)
+
+    def on_response(self, origin, packet):
+        """Record the latency of a response and check the loss computed
+        by the sender against the injected one"""
+
+        end = time.perf_counter()
+        self.latency.record(int((end - origin) * 1e9))
+        monitored_path = self.sender.return_paths.get(utils.sid_list_key(
+            utils.rem_punt(list(
+                packet[IPv6ExtHdrSegmentRouting].addresses))[::-1]))
+        if monitored_path is None:
+            return
+        self.responses += 1
+        meas = monitored_path['lastMeas']
+        # Skip the responses discarded by the sender (late or duplicate)
+        seq_num = packet[twamp.TWAMPTestResponse].SenderSequenceNumber
+        answer = (monitored_path['key'], seq_num)
+        if meas is None or meas['sssn'] != seq_num or \
+                answer in self.answered:
+            self.elapsed -= time.perf_counter() - end
+            return
+        self.answered.add(answer)
+        injected = (self.driver.get_lost(monitored_path['sidlist'],
+                                         meas['fwColor']),
+                    self.driver.get_lost(monitored_path['returnsidlist'],
+                                         meas['rvColor']))
+        measured = (meas['ssTXc'] - meas['rfRXc'],
+                    meas['rfTXc'] - meas['ssRXc'])
+        if measured == injected:
+            self.exact += 1
+        self.injected_loss += sum(injected)
+        self.loss_error += sum(abs(value - reference) for value, reference
+                               in zip(measured, injected))
+        # The check is not part of the work of the daemon
+        self.elapsed -= time.perf_counter() - end
+
+    def run(self, num_intervals, ticks):
+        """Run the test for num_intervals intervals"""
+
+        self.start()
+        for _ in range(num_intervals * ticks):
+            self.tick(self.interval / ticks)
+
+    def report(self):
+        """Return a row of the scaling curve"""
+
+        queries = self.transport.queries_sent
+        # Queries sent, without the retransmissions
+        sent = sum(monitored_path['txSequenceNumber'] - 1 for
+                   monitored_path in self.sender.monitored_paths.values())
+        retransmissions = sum(
+            monitored_path['retransmissions'] for
+            monitored_path in self.sender.monitored_paths.values())
+        return ('{sessions:>8} {qps:>10.0f} {p50:>10.1f} {p99:>10.1f} '
+                '{peak:>10} {resp:>8.1f} {meas:>8.1f} {retx:>6} '
+                '{exact:>9.1f} {error:>9.3f}'.format(
+                    sessions=len(self.paths),
+                    qps=queries / self.elapsed if self.elapsed > 0 else 0,
+                    p50=self.latency.percentile(50) / 1e3,
+                    p99=self.latency.percentile(99) / 1e3,
+                    peak=self.peak,
+                    resp=self.responses / queries * 100 if queries else 0,
+                    meas=len(self.answered) / sent * 100 if sent else 0,
+                    retx=retransmissions,
+                    exact=self.exact / self.responses * 100
+                    if self.responses else 0,
+                    error=self.loss_error / self.injected_loss * 100
+                    if self.injected_loss else 0))
+
+
+def parse_arguments():
+    """Parse options received from command-line"""
+
+    parser = ArgumentParser(
+        description='End-to-end load test of a sender and a reflector'
+    )
+    parser.add_argument(
+        '-s', '--sessions', dest='sessions', action='store',
+        default=DEFAULT_SESSIONS,
+        help='Comma-separated numbers of sessions of the scaling curve'
+    )
+    parser.add_argument(
+        '-n', '--num-intervals', dest='num_intervals', action='store',
+        type=int, default=DEFAULT_NUM_INTERVALS,
+        help='Number of measured intervals'
+    )
+    parser.add_argument(
+        '-i', '--interval', dest='interval', action='store', type=float,
+        default=DEFAULT_INTERVAL, help='Interval (in virtual seconds)'
+    )
+    parser.add_argument(
+        '-m', '--margin', dest='margin', action='store', type=int,
+        default=DEFAULT_MARGIN, help='Margin (in milliseconds)'
+    )
+    parser.add_argument(
+        '-t', '--ticks', dest='ticks', action='store', type=int,
+        default=DEFAULT_TICKS, help='Ticks of the clock per interval'
+    )
+    parser.add_argument(
+        '-p', '--packets', dest='packets', action='store', type=int,
+        default=DEFAULT_PACKETS,
+        help='Production packets per interval, path and direction'
+    )
+    parser.add_argument(
+        '-l', '--loss', dest='loss', action='store', type=float,
+        default=DEFAULT_LOSS, help='Share of production packets dropped'
+    )
+    parser.add_argument(
+        '-d', '--drop', dest='drop', action='store', type=float,
+        default=DEFAULT_DROP, help='Share of TWAMP packets dropped'
+    )
+    parser.add_argument(
+        '--spread', dest='spread', action='store', type=float,
+        default=stagger.DEFAULT_SPREAD,
+        help='Fraction of the safe window over which the queries are spread'
+    )
+    parser.add_argument(
+        '--timeout', dest='timeout', action='store', type=float,
+        default=twamp_demon.DEFAULT_QUERY_TIMEOUT,
+        help='Timeout (in virtual seconds) of the queries, 0 disables the '
+             'retransmissions'
+    )
+    return parser.parse_args()
+
+
+def __main():
+    args = parse_arguments()
+    print('{sessions:>8} {qps:>10} {p50:>10} {p99:>10} {peak:>10} '
+          '{resp:>8} {meas:>8} {retx:>6} {exact:>9} {error:>9}'.format(
+              sessions='sessions', qps='queries/s', p50='P50 (us)',
+              p99='P99 (us)', peak='peak/tick', resp='resp (%)',
+              meas='meas (%)', retx='retx', exact='exact (%)',
+              error='error (%)'))
+    for num_sessions in [int(num) for num in args.sessions.split(',')]:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            test = LoadTest(num_sessions, args.interval, args.margin,
+                            args.packets, args.loss, args.drop, args.spread,
+                            args.timeout if args.timeout > 0 else None)
+            test.run(args.num_intervals, args.ticks)
+        print(test.report())
+
+
+if __name__ == '__main__':
+    __main()
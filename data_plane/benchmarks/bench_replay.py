@@ -0,0 +1,453 @@
+#!/usr/bin/python
+
+
+"""Benchmark of the receive path of the daemon: replay of a capture.
+
+The packets of a pcap, or of a synthetic capture of TWAMP packets mixed
+with production traffic, are fed at full speed to
+TestPacketReceiver.packet_recv_callback, as done by the sniffer, and
+dispatched to a sender and a reflector. The eBPF driver and the transmit
+path are replaced by fakes, so only the work of the daemon is measured.
+The benchmark reports the packets per second, the latency of each stage
+and the share of the time spent on the packets that are not TWAMP. The
+exit status is 1 if the rate is below --min-pps, so the benchmark can be
+used as a check after changing the receive path.
+
+With --workers the packets are handed to the workers of the receiver,
+and --read-delay makes every counter read of the driver slow (as a
+contended eBPF map), to compare the time the capture thread is busy with
+and without the workers."""
+
+# General imports
+import contextlib
+import os
+import struct
+import sys
+import time
+from argparse import ArgumentParser
+from threading import Event, Lock
+
+# Scapy dependencies
+from scapy.layers.inet import TCP, UDP
+from scapy.layers.inet6 import IPv6
+
+# Data-plane dependencies
+from data_plane.twamp import (admission, loss_analyzer, snapshots, twamp_demon,
+                              utils)
+from data_plane.twamp.histogram import DelayHistogram
+
+# Default options of the synthetic capture: number of paths, number of
+# queries sent on each path and number of production packets per TWAMP
+# packet
+DEFAULT_NUM_PATHS = 100
+DEFAULT_NUM_ROUNDS = 20
+DEFAULT_PRODUCTION_RATIO = 10
+# Default number of replays of the capture
+DEFAULT_LOOPS = 1
+# UDP port of the production traffic (iperf3)
+PRODUCTION_UDP_PORT = 5201
+# Link type and header of the pcap files written by the benchmark
+# (raw IP, microsecond timestamps)
+LINKTYPE_RAW = 101
+PCAP_HEADER = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535,
+                          LINKTYPE_RAW)
+PCAP_RECORD = struct.Struct('<IIII')
+# Stages of the receive path
+STAGES = ('dissect', 'dispatch', 'query', 'response', 'other')
+
+
+class FakeDriver():
+    """A driver with the interface of twamp_demon.EbpfInterf, keeping the
+    flows in memory. The counters grow at every read, so the responses
+    carry different values. Each read takes 'read_delay' seconds"""
+
+    def __init__(self, read_delay=0.0):
+        self.color = 1
+        self.flows = set()
+        self.counter = 0
+        self.read_delay = read_delay
+
+    def set_sidlist_out(self, sid_list):
+        """Add an egress flow"""
+
+        self.flows.add((snapshots.DIRECTION_TX,
+                        utils.sid_list_key(sid_list)))
+
+    def set_sidlist_in(self, sid_list):
+        """Add an ingress flow"""
+
+        self.flows.add((snapshots.DIRECTION_RX,
+                        utils.sid_list_key(sid_list)))
+
+    def rem_sidlist_out(self, sid_list):
+        """Remove an egress flow"""
+
+        self.flows.discard((snapshots.DIRECTION_TX,
+                            utils.sid_list_key(sid_list)))
+
+    def rem_sidlist_in(self, sid_list):
+        """Remove an ingress flow"""
+
+        self.flows.discard((snapshots.DIRECTION_RX,
+                            utils.sid_list_key(sid_list)))
+
+    def set_flows(self, flows):
+        """Add several flows. Return a list of bools"""
+
+        for direction, sid_list in flows:
+            self.flows.add((direction, utils.sid_list_key(sid_list)))
+        return [True] * len(flows)
+
+    def rem_flows(self, flows):
+        """Remove several flows"""
+
+        for direction, sid_list in flows:
+            self.flows.discard((direction, utils.sid_list_key(sid_list)))
+
+    def set_color(self, color):
+        """Set the active color"""
+
+        self.color = color
+
+    def get_color(self):
+        """Return the active color"""
+
+        return self.color
+
+    def read_tx_counter(self, color, sid_list):
+        """Return the TX counter of a flow"""
+
+        # pylint: disable=unused-argument
+
+        if self.read_delay > 0:
+            time.sleep(self.read_delay)
+        self.counter += 1
+        return self.counter
+
+    def read_rx_counter(self, color, sid_list):
+        """Return the RX counter of a flow"""
+
+        # pylint: disable=unused-argument
+
+        if self.read_delay > 0:
+            time.sleep(self.read_delay)
+        self.counter += 1
+        return self.counter
+
+
+def path_sid_lists(index):
+    """Return the SID list and the return SID list of a synthetic path"""
+
+    node = 'fcff:{high:x}:{low:x}::1'.format(high=0x10 + (index >> 16),
+                                             low=index & 0xffff)
+    return ('{node}/fcff:8::100'.format(node=node),
+            '{node}/fcff:1::100'.format(node=node))
+
+
+def production_packet(index):
+    """Return a packet of the production traffic, alternating UDP and
+    TCP"""
+
+    src = 'fd00:0:13::{host:x}'.format(host=index % 0xffff + 1)
+    if index % 2 == 0:
+        layer = UDP(sport=40000 + index % 1000, dport=PRODUCTION_UDP_PORT)
+    else:
+        layer = TCP(sport=40000 + index % 1000, dport=PRODUCTION_UDP_PORT,
+                    flags='A')
+    return bytes(IPv6(src=src, dst='fd00:0:83::2') / layer /
+                 (b'\x00' * 1024))
+
+
+def synthetic_capture(num_paths, num_rounds, production_ratio):
+    """Build a capture of the queries and the responses exchanged on
+    num_paths paths and of the production traffic. Return a list of
+    (timestamp, raw IPv6 packet) tuples"""
+
+    driver = FakeDriver()
+    sender = twamp_demon.SessionSender(driver)
+    reflector = twamp_demon.SessionReflector(
+        driver, admission_control=admission.AdmissionControl(
+            rate=None, global_rate=None))
+    queries = []
+    responses = []
+    sender.transmit = lambda pkt: queries.append(bytes(pkt))
+    reflector.transmit = lambda pkt: responses.append(bytes(pkt))
+    receiver = twamp_demon.TestPacketReceiver(None, sender, reflector)
+    capture = []
+    now = time.time()
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for index in range(num_paths):
+            sid_list, rev_sid_list = path_sid_lists(index)
+            sender.start_meas(index, sid_list, rev_sid_list)
+            reflector.start_meas(sid_list, rev_sid_list)
+        for _ in range(num_rounds):
+            for monitored_path in list(sender.monitored_paths.values()):
+                sender.send_twamp_test_query(monitored_path)
+                receiver.packet_recv_callback(IPv6(queries[-1]))
+                for data in (queries[-1], responses[-1]):
+                    capture.append((now, data))
+                    for _ in range(production_ratio):
+                        capture.append(
+                            (now, production_packet(len(capture))))
+                    now += 1e-6
+    return capture
+
+
+def pcap_capture(path):
+    """Read a pcap and return a list of (timestamp, raw IPv6 packet)
+    tuples. The packets that are not IPv6 are skipped"""
+
+    capture = []
+    for timestamp, linktype, data in loss_analyzer.iter_pcap(path):
+        header_len = loss_analyzer.LINKTYPE_HEADER_LEN.get(linktype)
+        if header_len is None:
+            raise ValueError('Unsupported link type {linktype}'.format(
+                linktype=linktype))
+        data = data[header_len:]
+        if len(data) > 0 and data[0] >> 4 == 6:
+            capture.append((timestamp, data))
+    return capture
+
+
+def write_pcap(path, capture):
+    """Write a capture to a pcap file (raw IP link type)"""
+
+    with open(path, 'wb') as pcap:
+        pcap.write(PCAP_HEADER)
+        for timestamp, data in capture:
+            sec = int(timestamp)
+            pcap.write(PCAP_RECORD.pack(
+                sec, int((timestamp - sec) * 1e6), len(data), len(data)))
+            pcap.write(data)
+
+
+def provision_sender(sender, capture):
+    """Start a measurement on the sender for each return SID list of the
+    responses of the capture, so that they are matched by the sender"""
+
+    keys = set()
+    for _, data in capture:
+        parsed = utils.parse_srv6_udp(data)
+        if parsed is None or parsed[1] != sender.ss_udp_port:
+            continue
+        rev_sid_list = utils.rem_punt(parsed[0])[::-1]
+        key = utils.sid_list_key(rev_sid_list)
+        if key in keys:
+            continue
+        keys.add(key)
+        sender.start_meas(len(keys), '/'.join(rev_sid_list[::-1]),
+                          '/'.join(rev_sid_list))
+
+
+class ReplayStats():
+    """The latency of each stage of the receive path"""
+
+    def __init__(self):
+        self.histograms = {stage: DelayHistogram() for stage in STAGES}
+        self.elapsed = {stage: 0 for stage in STAGES}
+        self.packets = {stage: 0 for stage in STAGES}
+        # The handlers are timed by the workers of the receiver
+        self.lock = Lock()
+
+    def record(self, stage, elapsed):
+        """Record the time (in nanoseconds) spent in a stage"""
+
+        with self.lock:
+            self.histograms[stage].record(elapsed)
+            self.elapsed[stage] += elapsed
+            self.packets[stage] += 1
+
+
+def fake_transmit(pkt):
+    """Serialize a packet instead of sending it. No kernel timestamp is
+    returned"""
+
+    bytes(pkt)
+
+
+def timed_handler(stats, stage, handler, state):
+    """Wrap a handler of the TWAMP packets to record its latency and to
+    mark the packet as a TWAMP packet"""
+
+    def wrapper(packet):
+        state['twamp'] = True
+        start = time.perf_counter()
+        result = handler(packet)
+        stats.record(stage, int((time.perf_counter() - start) * 1e9))
+        return result
+
+    return wrapper
+
+
+def replay(capture, loops, enable_admission, workers=0, read_delay=0.0):
+    """Feed the capture to a receiver and return the statistics, the
+    number of packets, the elapsed time, the time spent by the capture
+    thread and the statistics of the workers (None without workers)"""
+
+    # pylint: disable=too-many-arguments,too-many-locals
+
+    driver = FakeDriver(read_delay)
+    stop_event = Event()
+    sender = twamp_demon.SessionSender(driver, stop_event=stop_event)
+    reflector = twamp_demon.SessionReflector(
+        driver, stop_event=stop_event, stateless=True,
+        admission_control=None if enable_admission
+        else admission.AdmissionControl(rate=None, global_rate=None))
+    sender.transmit = fake_transmit
+    reflector.transmit = fake_transmit
+    receiver = twamp_demon.TestPacketReceiver(None, sender, reflector,
+                                              workers=workers)
+
+    stats = ReplayStats()
+    state = {}
+    sender.recv_twamp_response = timed_handler(
+        stats, 'response', sender.recv_twamp_response, state)
+    reflector.recv_twamp_test_query = timed_handler(
+        stats, 'query', reflector.recv_twamp_test_query, state)
+    clock = time.perf_counter
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        provision_sender(sender, capture)
+        if receiver.dispatcher is not None:
+            receiver.dispatcher.start()
+        start = clock()
+        for _ in range(loops):
+            for timestamp, data in capture:
+                state['twamp'] = False
+                begin = clock()
+                packet = IPv6(data)
+                packet.time = timestamp
+                dissected = clock()
+                receiver.packet_recv_callback(packet)
+                end = clock()
+                stats.record('dissect', int((dissected - begin) * 1e9))
+                stats.record('dispatch', int((end - dissected) * 1e9))
+                # With the workers the packet is handled later, so the
+                # packets that are not TWAMP cannot be told apart
+                if receiver.dispatcher is None and not state['twamp']:
+                    stats.record('other', int((end - begin) * 1e9))
+        captured = clock() - start
+        dispatch_stats = None
+        if receiver.dispatcher is not None:
+            receiver.dispatcher.drain()
+            dispatch_stats = receiver.get_dispatch_stats()
+            receiver.dispatcher.stop()
+        elapsed = clock() - start
+    return stats, loops * len(capture), elapsed, captured, dispatch_stats
+
+
+def print_report(stats, num_packets, elapsed, captured,
+                 dispatch_stats=None):
+    """Print the rate, the latency of the stages, the share of the time
+    spent on the non-TWAMP packets and the statistics of the workers"""
+
+    print('Replayed {num} packets in {elapsed:.3f} s: {pps:.0f} packets/s'
+          .format(num=num_packets, elapsed=elapsed,
+                  pps=num_packets / elapsed))
+    print('Capture thread busy for {captured:.3f} s: {pps:.0f} packets/s'
+          .format(captured=captured, pps=num_packets / captured))
+    if dispatch_stats is not None:
+        print('Workers: {workers} - max depth {max_depth}/{size} - '
+              'handled {handled} - dropped {dropped} - errors {errors}'
+              .format(workers=dispatch_stats['workers'],
+                      max_depth=dispatch_stats['maxDepth'],
+                      size=dispatch_stats['queueSize'],
+                      handled=dispatch_stats['handled'],
+                      dropped=dispatch_stats['dropped'],
+                      errors=dispatch_stats['errors']))
+    for stage in STAGES:
+        rtt_histogram = stats.histograms[stage]
+        if rtt_histogram.count == 0:
+            continue
+        print('{stage:>9}: {count} packets - mean {mean:.1f} us - '
+              'P50 {p50:.1f} us - P99 {p99:.1f} us'.format(
+                  stage=stage, count=rtt_histogram.count,
+                  mean=rtt_histogram.mean() / 1e3,
+                  p50=rtt_histogram.percentile(50) / 1e3,
+                  p99=rtt_histogram.percentile(99) / 1e3))
+    total = stats.elapsed['dissect'] + stats.elapsed['dispatch']
+    if total > 0 and dispatch_stats is None:
+        print('Non-TWAMP packets: {pkts} ({share:.1f}% of the time)'.format(
+            pkts=stats.packets['other'],
+            share=stats.elapsed['other'] / total * 100))
+
+
+def parse_arguments():
+    """Parse options received from command-line"""
+
+    parser = ArgumentParser(
+        description='Benchmark of the receive path of the daemon'
+    )
+    parser.add_argument(
+        '-p', '--pcap', dest='pcap', action='store',
+        help='Replay this pcap instead of a synthetic capture'
+    )
+    parser.add_argument(
+        '-n', '--num-paths', dest='num_paths', action='store', type=int,
+        default=DEFAULT_NUM_PATHS, help='Paths of the synthetic capture'
+    )
+    parser.add_argument(
+        '-r', '--rounds', dest='rounds', action='store', type=int,
+        default=DEFAULT_NUM_ROUNDS,
+        help='Queries per path of the synthetic capture'
+    )
+    parser.add_argument(
+        '--production-ratio', dest='production_ratio', action='store',
+        type=int, default=DEFAULT_PRODUCTION_RATIO,
+        help='Production packets per TWAMP packet of the synthetic capture'
+    )
+    parser.add_argument(
+        '-w', '--write-pcap', dest='write_pcap', action='store',
+        help='Write the synthetic capture to this pcap'
+    )
+    parser.add_argument(
+        '-l', '--loops', dest='loops', action='store', type=int,
+        default=DEFAULT_LOOPS, help='Number of replays of the capture'
+    )
+    parser.add_argument(
+        '--admission', dest='admission', action='store_true',
+        default=False,
+        help='Enable the default admission control of the reflector'
+    )
+    parser.add_argument(
+        '--workers', dest='workers', action='store', type=int, default=0,
+        help='Workers of the receiver (0 handles the packets inline)'
+    )
+    parser.add_argument(
+        '--read-delay', dest='read_delay', action='store', type=float,
+        default=0.0, help='Time (in microseconds) of each counter read'
+    )
+    parser.add_argument(
+        '--min-pps', dest='min_pps', action='store', type=float,
+        default=None, help='Exit with status 1 below this rate'
+    )
+    return parser.parse_args()
+
+
+def __main():
+    args = parse_arguments()
+    if args.pcap is not None:
+        capture = pcap_capture(args.pcap)
+    else:
+        capture = synthetic_capture(args.num_paths, args.rounds,
+                                    args.production_ratio)
+        if args.write_pcap is not None:
+            write_pcap(args.write_pcap, capture)
+    if len(capture) == 0:
+        print('No IPv6 packets to replay')
+        sys.exit(1)
+    stats, num_packets, elapsed, captured, dispatch_stats = replay(
+        capture, args.loops, args.admission, args.workers,
+        args.read_delay / 1e6)
+    print_report(stats, num_packets, elapsed, captured, dispatch_stats)
+    pps = num_packets / elapsed
+    if args.min_pps is not None and pps < args.min_pps:
+        print('Rate below {min_pps:.0f} packets/s'.format(
+            min_pps=args.min_pps))
+        sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    __main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+
+"""Benchmark of the memory of the sessions: bytes per monitored path.
+
+N paths are started with start_meas_many on a SessionSender and on a
+SessionReflector, with a driver keeping no state, and the memory
+allocated by the daemon for the paths (state of the sessions and indexes
+by SID list) is measured with tracemalloc. The SID lists given by the
+controller are built before the measurement, so they are not counted."""
+
+# General imports
+import contextlib
+import os
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+# Data-plane dependencies
+from data_plane.benchmarks.bench_replay import FakeDriver, path_sid_lists
+from data_plane.twamp import twamp_demon
+
+# Default numbers of sessions
+DEFAULT_SESSIONS = '1000,100000'
+# Paths started by each call of start_meas_many, as done by a controller
+BATCH_SIZE = 1000
+
+
+class NullDriver(FakeDriver):
+    """A driver accepting every flow without storing it, so only the
+    memory of the daemon is measured"""
+
+    def set_sidlist_out(self, sid_list):
+        """Add an egress flow"""
+
+    def set_sidlist_in(self, sid_list):
+        """Add an ingress flow"""
+
+    def set_flows(self, flows):
+        """Add several flows. Return a list of bools"""
+
+        return [True] * len(flows)
+
+    def rem_flows(self, flows):
+        """Remove several flows"""
+
+
+def bench_memory(role, num_sessions):
+    """Start num_sessions paths on a sender or on a reflector. Return the
+    bytes allocated per session and the time (in seconds) to start the
+    paths"""
+
+    if role == 'sender':
+        session = twamp_demon.SessionSender(NullDriver())
+        paths = [(index,) + path_sid_lists(index)
+                 for index in range(num_sessions)]
+    else:
+        session = twamp_demon.SessionReflector(NullDriver())
+        paths = [path_sid_lists(index) for index in range(num_sessions)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for index in range(0, num_sessions, BATCH_SIZE):
+            session.start_meas_many(paths[index:index + BATCH_SIZE])
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size / num_sessions, elapsed
+
+
+def parse_arguments():
+    """Parse options received from command-line"""
+
+    parser = ArgumentParser(
+        description='Benchmark of the memory of the sessions'
+    )
+    parser.add_argument(
+        '-s', '--sessions', dest='sessions', action='store',
+        default=DEFAULT_SESSIONS,
+        help='Comma-separated numbers of sessions'
+    )
+    return parser.parse_args()
+
+
+def __main():
+    args = parse_arguments()
+    print('{role:>10} {sessions:>9} {size:>14} {total:>10} {start:>10}'.format(
+        role='role', sessions='sessions', size='bytes/session',
+        total='total MB', start='start (s)'))
+    for num_sessions in [int(num) for num in args.sessions.split(',')]:
+        for role in ('sender', 'reflector'):
+            size, elapsed = bench_memory(role, num_sessions)
+            print('{role:>10} {sessions:>9} {size:>14.0f} {total:>10.1f} '
+                  '{start:>10.2f}'.format(
+                      role=role, sessions=num_sessions, size=size,
+                      total=size * num_sessions / 1e6, start=elapsed))
+
+
+if __name__ == '__main__':
+    __main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+
+"""Benchmark of the startup of the daemon and of the traffic generator.
+
+Each module is imported in a new interpreter, several times, and the
+median import time is compared with the budget of the module. The exit
+status is 1 if any module exceeds its budget, so the benchmark can be
+used as a check after changing the imports."""
+
+# General imports
+import statistics
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+# Import-time budget (in seconds) of the modules. Importing scapy.all
+# alone takes longer than the budget of the daemon
+DEFAULT_BUDGETS = {
+    'data_plane.twamp.twamp': 0.2,
+    'data_plane.twamp.twamp_demon': 0.25,
+    'data_plane.twamp.sharding': 0.35,
+    'data_plane.traffic_generator.tg': 0.1
+}
+# Default number of imports of each module
+DEFAULT_REPEAT = 5
+
+# Code run by the child interpreter, which prints the import time
+IMPORT_CODE = ('import time; start = time.perf_counter(); import {module}; '
+               'print(time.perf_counter() - start)')
+
+
+def import_time(module):
+    """Import a module in a new interpreter and return the import time"""
+
+    result = subprocess.run(
+        [sys.executable, '-W', 'ignore', '-c',
+         IMPORT_CODE.format(module=module)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    # The modules can print warnings, the time is the last line
+    return float(result.stdout.decode().splitlines()[-1])
+
+
+def parse_arguments():
+    """Parse options received from command-line"""
+
+    parser = ArgumentParser(
+        description='Benchmark of the import time of the modules'
+    )
+    parser.add_argument(
+        '-r', '--repeat', dest='repeat', action='store', type=int,
+        default=DEFAULT_REPEAT, help='Number of imports of each module'
+    )
+    parser.add_argument(
+        '-b', '--budget', dest='budgets', action='append', default=[],
+        help='Override the budget of a module, e.g. '
+        'data_plane.twamp.twamp_demon=0.8'
+    )
+    return parser.parse_args()
+
+
+def __main():
+    args = parse_arguments()
+    budgets = dict(DEFAULT_BUDGETS)
+    for budget in args.budgets:
+        module, seconds = budget.split('=')
+        budgets[module] = float(seconds)
+    exceeded = False
+    for module, budget in sorted(budgets.items()):
+        elapsed = statistics.median(
+            import_time(module) for _ in range(args.repeat))
+        status = 'OK' if elapsed <= budget else 'OVER BUDGET'
+        exceeded = exceeded or elapsed > budget
+        print('{module}: {elapsed:.3f} s (budget {budget:.3f} s) {status}'
+              .format(module=module, elapsed=elapsed, budget=budget,
+                      status=status))
+    sys.exit(1 if exceeded else 0)
+
+
+if __name__ == '__main__':
+    __main()
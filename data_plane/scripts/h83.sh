@@ -1,4 +1,4 @@
 source /root/venv/bin/activate
 
 cd /opt/lmg/traffic-generator
-python tg.py -s -B fd00:0:83::2 --measure-id 10 --generator-id 200
+python -m data_plane.traffic_generator.tg -s -B fd00:0:83::2 --measure-id 10 --generator-id 200
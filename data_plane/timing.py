@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+
+"""This module implements a hashed timing wheel.
+
+The timers are stored in a ring of slots, one slot per tick, so adding or
+cancelling a timer costs O(1) and advancing the wheel only looks at the
+slots of the elapsed ticks, whatever the number of timers. The timers of
+a tick run in order of deadline; the timers further than a rotation stay
+in their slot until their tick comes. A timer never runs before its
+deadline. The wheel does not read the clock, it is advanced with the
+current time of the caller (local or reference clock), so the same wheel
+serves the traffic generator and the TWAMP sender."""
+
+# General imports
+import math
+
+# Default number of slots of the wheel
+DEFAULT_NUM_SLOTS = 512
+# Max time (in seconds) slept by run() between two checks of the stop event
+DEFAULT_MAX_SLEEP = 0.5
+
+
+class Timer():
+    """A timer of the wheel, running 'action(*argument)' at 'deadline'"""
+
+    __slots__ = ('deadline', 'tick', 'action', 'argument', 'cancelled')
+
+    def __init__(self, deadline, tick, action, argument):
+        self.deadline = deadline
+        self.tick = tick
+        self.action = action
+        self.argument = argument
+        self.cancelled = False
+
+
+class TimingWheel():
+    """A hashed timing wheel with a resolution of 'tick' seconds. The
+    timers scheduled in the past run at the next advance"""
+
+    def __init__(self, tick, num_slots=DEFAULT_NUM_SLOTS, start=0.0):
+        if tick <= 0:
+            raise ValueError('Invalid tick {tick}'.format(tick=tick))
+        self.tick = tick
+        self.slots = [[] for _ in range(num_slots)]
+        # First tick not fully processed yet
+        self.current = self.get_tick(start)
+        # Number of timers not cancelled
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def get_tick(self, instant):
+        """Return the tick of an instant"""
+
+        return int(math.floor(instant / self.tick))
+
+    def schedule(self, deadline, action, argument=()):
+        """Schedule 'action(*argument)' at 'deadline' and return the
+        timer"""
+
+        tick = max(self.get_tick(deadline), self.current)
+        timer = Timer(deadline, tick, action, argument)
+        self.slots[tick % len(self.slots)].append(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer. The timer is removed from its slot when its
+        tick comes"""
+
+        if not timer.cancelled:
+            timer.cancelled = True
+            self.count -= 1
+
+    def advance(self, now):
+        """Run the timers due until 'now'. Return the number of timers
+        run"""
+
+        last = self.get_tick(now)
+        run = 0
+        if self.count == 0:
+            # Nothing to run in the elapsed ticks
+            self.current = max(self.current, last)
+            return run
+        num_slots = len(self.slots)
+        if last - self.current + 1 >= num_slots:
+            # A whole rotation has elapsed, every slot can hold due timers
+            run += self.run_due(range(num_slots), last, now)
+        else:
+            for tick in range(self.current, last + 1):
+                # The timers scheduled in the past by the actions go in
+                # the slot being processed
+                self.current = tick
+                run += self.run_due((tick % num_slots,), tick, now)
+        # The timers of the last tick after 'now' are still pending
+        self.current = max(self.current, last)
+        return run
+
+    def run_due(self, slots, last, now):
+        """Run the timers of some slots due until the tick 'last' and the
+        instant 'now'. The timers scheduled by the actions in the past run
+        as well"""
+
+        run = 0
+        while True:
+            due = []
+            for index in slots:
+                slot = self.slots[index]
+                if not slot:
+                    continue
+                pending = []
+                for timer in slot:
+                    if timer.cancelled:
+                        continue
+                    if timer.tick <= last and timer.deadline <= now:
+                        due.append(timer)
+                    else:
+                        pending.append(timer)
+                self.slots[index] = pending
+            if not due:
+                return run
+            due.sort(key=lambda timer: timer.deadline)
+            for timer in due:
+                # A previous action can cancel the timer
+                if timer.cancelled:
+                    continue
+                timer.cancelled = True
+                self.count -= 1
+                timer.action(*timer.argument)
+                run += 1
+
+    def next_deadline(self):
+        """Return the earliest deadline of the timers, or None if there
+        are no timers"""
+
+        if self.count == 0:
+            return None
+        num_slots = len(self.slots)
+        for offset in range(num_slots):
+            tick = self.current + offset
+            deadlines = [timer.deadline for timer in
+                         self.slots[tick % num_slots]
+                         if not timer.cancelled and timer.tick <= tick]
+            if deadlines:
+                return min(deadlines)
+        # All the timers are further than a rotation
+        return min(timer.deadline for slot in self.slots for timer in slot
+                   if not timer.cancelled)
+
+    def run(self, now, sleep, stop_event=None, max_sleep=DEFAULT_MAX_SLEEP):
+        """Run the timers until there are none left or 'stop_event' is
+        set, reading the time with 'now' and waiting with 'sleep'"""
+
+        while self.count > 0:
+            if stop_event is not None and stop_event.is_set():
+                return
+            self.advance(now())
+            deadline = self.next_deadline()
+            if deadline is None:
+                return
+            delay = deadline - now()
+            if delay > 0:
+                sleep(min(delay, max_sleep))
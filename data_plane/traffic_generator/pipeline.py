@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+
+"""This module implements the pipeline exporting the reports of iperf3.
+
+The output of iperf3 is read by a reader thread, parsed by a parser
+thread and exported by a worker thread per sink (Kafka, controller),
+connected by bounded queues. The reader only moves the lines from the
+pipe to its queue, so iperf3 never waits on a slow sink: when the queue
+of the lines is full, the lines are dropped and counted. Each sink has
+a policy for its queue: 'block' makes the parser wait for the sink (so
+the lines are dropped by the reader only if the sink stays slow), 'drop'
+discards the reports that do not fit in the queue of the sink."""
+
+# General imports
+import queue
+from threading import Thread
+
+# Policies of the queues
+POLICY_BLOCK = 'block'
+POLICY_DROP = 'drop'
+POLICIES = (POLICY_BLOCK, POLICY_DROP)
+# Default size of the queues
+DEFAULT_QUEUE_SIZE = 1024
+
+# Marks the end of the stream in the queues
+END = None
+
+
+class BoundedQueue():
+    """A bounded queue with a policy for the items that do not fit and
+    the statistics of its depth"""
+
+    def __init__(self, name, maxsize=DEFAULT_QUEUE_SIZE, policy=POLICY_DROP):
+        if policy not in POLICIES:
+            raise ValueError('Invalid policy {policy}'.format(policy=policy))
+        self.name = name
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        # Statistics
+        self.enqueued = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def put(self, item):
+        """Enqueue an item according to the policy. Return False if the
+        item has been dropped"""
+
+        if self.policy == POLICY_BLOCK:
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+                return False
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def put_end(self):
+        """Enqueue the end of the stream, which is never dropped"""
+
+        self.queue.put(END)
+
+    def get(self):
+        """Dequeue an item, waiting for it"""
+
+        return self.queue.get()
+
+    def stats(self):
+        """Return the statistics of the queue"""
+
+        return {
+            'depth': self.queue.qsize(),
+            'maxDepth': self.max_depth,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped
+        }
+
+
+class Exporter(Thread):
+    """A worker exporting the reports of its queue to a sink"""
+
+    def __init__(self, name, export, maxsize=DEFAULT_QUEUE_SIZE,
+                 policy=POLICY_DROP):
+        Thread.__init__(self)
+        self.name = 'Exporter-{name}'.format(name=name)
+        self.daemon = True
+        self.export = export
+        self.queue = BoundedQueue(name, maxsize, policy)
+        # Statistics
+        self.exported = 0
+        self.errors = 0
+
+    def run(self):
+        """Export the reports until the end of the stream"""
+
+        while True:
+            report = self.queue.get()
+            if report is END:
+                return
+            try:
+                self.export(report)
+                self.exported += 1
+            except Exception as err:    # pylint: disable=broad-except
+                # A failure of the sink must not stop the pipeline
+                self.errors += 1
+                print('Export to {name} failed: {err}'.format(
+                    name=self.queue.name, err=err))
+
+    def stats(self):
+        """Return the statistics of the exporter"""
+
+        stats = self.queue.stats()
+        stats['exported'] = self.exported
+        stats['errors'] = self.errors
+        return stats
+
+
+class ReportPipeline():
+    """A pipeline reading the lines of iperf3 from a stream, parsing them
+    and exporting the reports to the sinks. 'parse' returns a record
+    (records.IperfRecord) or None for a line (a str); each sink is a tuple
+    (name, export function, policy). If 'rollup' (records.Rollup) is not
+    None, the records are aggregated into windows and the reports of the
+    windows are exported instead of the ones of the records"""
+
+    def __init__(self, parse, sinks, queue_size=DEFAULT_QUEUE_SIZE,
+                 rollup=None):
+        self.parse = parse
+        self.rollup = rollup
+        # The reader never blocks
+        self.lines = BoundedQueue('lines', queue_size, POLICY_DROP)
+        self.exporters = [Exporter(name, export, queue_size, policy)
+                          for name, export, policy in sinks]
+        self.parsed = 0
+        self.exported = 0
+
+    def read(self, stream):
+        """Move the lines of a stream to the queue of the lines, until the
+        end of the stream"""
+
+        for line in iter(stream.readline, b''):
+            self.lines.put(line)
+        self.lines.put_end()
+
+    def dispatch(self, reports):
+        """Pass the reports to the exporters"""
+
+        for report in reports:
+            self.exported += 1
+            for exporter in self.exporters:
+                # Each sink gets its own copy, the sinks can change it
+                exporter.queue.put(dict(report))
+
+    def parse_lines(self):
+        """Parse the lines and pass the reports to the exporters"""
+
+        while True:
+            line = self.lines.get()
+            if line is END:
+                break
+            record = self.parse(line.decode())
+            if record is None:
+                continue
+            self.parsed += 1
+            if self.rollup is None:
+                self.dispatch([record.as_report()])
+            else:
+                self.dispatch(self.rollup.add(record))
+        if self.rollup is not None:
+            # Windows still open at the end of the output
+            self.dispatch(self.rollup.flush())
+        for exporter in self.exporters:
+            exporter.queue.put_end()
+
+    def run(self, stream):
+        """Run the pipeline on a stream and return when all the reports
+        have been exported"""
+
+        for exporter in self.exporters:
+            exporter.start()
+        parser = Thread(target=self.parse_lines, name='Parser')
+        parser.daemon = True
+        parser.start()
+        self.read(stream)
+        parser.join()
+        for exporter in self.exporters:
+            exporter.join()
+
+    def stats(self):
+        """Return the statistics of the queues of the pipeline"""
+
+        stats = {'lines': self.lines.stats(), 'parsed': self.parsed,
+                 'exported': self.exported}
+        for exporter in self.exporters:
+            stats[exporter.queue.name] = exporter.stats()
+        return stats
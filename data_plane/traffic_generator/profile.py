@@ -0,0 +1,452 @@
+#!/usr/bin/python
+
+
+"""This module generates the traffic of a profile of many flows.
+
+A profile is a JSON file listing the flows, each with its destination or
+SID list, its rate curve (constant, ramp, burst or diurnal), the size of
+its packets, its start and its duration, e.g.
+
+    {
+        "tick": 0.01,
+        "flows": [
+            {"name": "web", "sid_list": ["fcff:2::1", "fcff:8::100"],
+             "rate": {"type": "diurnal", "mean": "20M",
+                      "amplitude": "15M", "period": 600},
+             "packet_size": 1200, "duration": 600},
+            {"name": "backup", "destination": "fd00:0:83::2",
+             "rate": {"type": "burst", "rate": "1M", "burst_rate": "80M",
+                      "period": 30, "burst_time": 5},
+             "start": 60, "duration": 300}
+        ]
+    }
+
+All the flows are sent by a single thread, from a UDP socket per flow:
+the flows are paced by a shared timing wheel (see data_plane.timing) and
+at each tick a flow sends the packets owed by its rate curve. The SID
+list of a flow is set on its socket as a Segment Routing Header, so the
+packets follow the SRv6 path without any route on the node. At the end,
+the achieved rate of each flow is compared with its target rate, over the
+whole flow and over each report interval."""
+
+# General imports
+import json
+import math
+import socket
+import struct
+import time
+
+# Data-plane dependencies
+from data_plane import timing
+
+# Default tick (in seconds) of the timing wheel pacing the flows
+DEFAULT_TICK = 0.01
+# Default UDP port (discard) and size of the UDP payload of the packets
+DEFAULT_PORT = 9
+DEFAULT_PACKET_SIZE = 1000
+# Default duration (in seconds) of a flow, as iperf3
+DEFAULT_DURATION = 10
+# Default interval (in seconds) of the accuracy reports of the flows
+DEFAULT_REPORT_INTERVAL = 1
+# Max packets sent by a flow in a tick, the flows late on their curve
+# catch up over the next ticks
+MAX_BURST = 1000
+
+# Multipliers of the rates, as the option --bitrate of iperf3
+RATE_UNITS = {'': 1, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3}
+# Type of the Segment Routing Header
+SRH_TYPE = 4
+
+
+def parse_rate(rate):
+    """Parse a rate (bits per second) with an optional K, M or G suffix"""
+
+    rate = str(rate).strip()
+    unit = rate[-1:].upper() if rate[-1:].isalpha() else ''
+    if unit not in RATE_UNITS:
+        raise ValueError('Invalid rate {rate}'.format(rate=rate))
+    return float(rate[:len(rate) - len(unit)]) * RATE_UNITS[unit]
+
+
+class ConstantCurve():
+    """A constant rate"""
+
+    def __init__(self, rate):
+        self.rate_bps = parse_rate(rate)
+
+    def rate(self, elapsed):    # pylint: disable=unused-argument
+        """Return the rate (bits per second) at 'elapsed' seconds"""
+
+        return self.rate_bps
+
+    def bits(self, elapsed):
+        """Return the bits sent in the first 'elapsed' seconds"""
+
+        return self.rate_bps * elapsed
+
+
+class RampCurve():
+    """A rate growing (or decreasing) linearly from 'start_rate' to
+    'end_rate' in 'ramp_time' seconds, then constant"""
+
+    def __init__(self, start_rate, end_rate, ramp_time):
+        self.start_rate = parse_rate(start_rate)
+        self.end_rate = parse_rate(end_rate)
+        if ramp_time < 0:
+            raise ValueError('Invalid ramp time {ramp_time}'.format(
+                ramp_time=ramp_time))
+        self.ramp_time = ramp_time
+
+    def rate(self, elapsed):
+        """Return the rate (bits per second) at 'elapsed' seconds"""
+
+        if elapsed >= self.ramp_time:
+            return self.end_rate
+        return self.start_rate + (self.end_rate - self.start_rate) * \
+            elapsed / self.ramp_time
+
+    def bits(self, elapsed):
+        """Return the bits sent in the first 'elapsed' seconds"""
+
+        ramp = min(elapsed, self.ramp_time)
+        bits = (self.start_rate + self.rate(ramp)) / 2 * ramp
+        return bits + self.end_rate * (elapsed - ramp)
+
+
+class BurstCurve():
+    """A base rate with a burst at 'burst_rate' during the first
+    'burst_time' seconds of every 'period' seconds"""
+
+    def __init__(self, rate, burst_rate, period, burst_time):
+        if period <= 0:
+            raise ValueError('Invalid period {period}'.format(period=period))
+        if not 0 <= burst_time <= period:
+            raise ValueError('Invalid burst time {burst_time}'.format(
+                burst_time=burst_time))
+        self.base_rate = parse_rate(rate)
+        self.burst_rate = parse_rate(burst_rate)
+        self.period = period
+        self.burst_time = burst_time
+
+    def rate(self, elapsed):
+        """Return the rate (bits per second) at 'elapsed' seconds"""
+
+        if elapsed % self.period < self.burst_time:
+            return self.burst_rate
+        return self.base_rate
+
+    def bits(self, elapsed):
+        """Return the bits sent in the first 'elapsed' seconds"""
+
+        periods, offset = divmod(elapsed, self.period)
+        burst = min(offset, self.burst_time)
+        per_period = self.burst_rate * self.burst_time + \
+            self.base_rate * (self.period - self.burst_time)
+        return periods * per_period + self.burst_rate * burst + \
+            self.base_rate * (offset - burst)
+
+
+class DiurnalCurve():
+    """A sinusoidal rate around 'mean' with an 'amplitude' and a 'period'
+    (a day by default, shorter to compress a day in a test). 'phase' is
+    the offset (in seconds) of the start of the flow in the period. The
+    amplitude cannot be larger than the mean"""
+
+    def __init__(self, mean, amplitude, period=86400, phase=0):
+        self.mean = parse_rate(mean)
+        self.amplitude = parse_rate(amplitude)
+        if self.amplitude > self.mean:
+            raise ValueError('The amplitude cannot be larger than the mean')
+        if period <= 0:
+            raise ValueError('Invalid period {period}'.format(period=period))
+        self.period = period
+        self.phase = phase
+
+    def angle(self, elapsed):
+        """Return the angle of the sinusoid at 'elapsed' seconds"""
+
+        return 2 * math.pi * (elapsed + self.phase) / self.period
+
+    def rate(self, elapsed):
+        """Return the rate (bits per second) at 'elapsed' seconds"""
+
+        return self.mean + self.amplitude * math.sin(self.angle(elapsed))
+
+    def bits(self, elapsed):
+        """Return the bits sent in the first 'elapsed' seconds"""
+
+        return self.mean * elapsed + self.amplitude * self.period / \
+            (2 * math.pi) * (math.cos(self.angle(0)) -
+                             math.cos(self.angle(elapsed)))
+
+
+def build_curve(spec, duration):
+    """Build the rate curve of a flow from its spec, a dict with a 'type'
+    and the parameters of the curve, or a rate for a constant curve"""
+
+    if not isinstance(spec, dict):
+        return ConstantCurve(spec)
+    kind = spec.get('type', 'constant')
+    if kind == 'constant':
+        return ConstantCurve(spec['rate'])
+    if kind == 'ramp':
+        return RampCurve(spec['from'], spec['to'],
+                         spec.get('ramp_time', duration))
+    if kind == 'burst':
+        return BurstCurve(spec['rate'], spec['burst_rate'], spec['period'],
+                          spec['burst_time'])
+    if kind == 'diurnal':
+        return DiurnalCurve(spec['mean'], spec['amplitude'],
+                            spec.get('period', 86400), spec.get('phase', 0))
+    raise ValueError('Invalid rate curve {kind}'.format(kind=kind))
+
+
+def build_srh(segments):
+    """Build a Segment Routing Header, to be set on a socket with
+    IPV6_RTHDR. The segments are in the order of the path, the last one
+    is the destination of the packets. The kernel moves the destination
+    in the first slot of the list and sends the packets to the first
+    segment"""
+
+    addresses = [socket.inet_pton(socket.AF_INET6, segment)
+                 for segment in reversed(segments)]
+    last_entry = len(addresses) - 1
+    header = struct.pack('!BBBBBBH', 0, 2 * len(addresses), SRH_TYPE,
+                         last_entry, last_entry, 0, 0)
+    return header + b''.join(addresses)
+
+
+class Flow():
+    """A flow of a profile, sending UDP packets at the rate of its curve"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, name, curve, destination=None, sid_list=None,
+                 port=DEFAULT_PORT, packet_size=DEFAULT_PACKET_SIZE,
+                 start=0, duration=DEFAULT_DURATION, source=None):
+
+        # pylint: disable=too-many-arguments
+
+        if destination is None and not sid_list:
+            raise ValueError('Flow {name} has no destination'.format(
+                name=name))
+        self.name = name
+        self.curve = curve
+        self.sid_list = list(sid_list or [])
+        # The last SID is the destination, if not given
+        self.destination = destination or self.sid_list[-1]
+        self.port = port
+        self.payload = bytes(packet_size)
+        self.start = start
+        self.duration = duration
+        self.source = source
+        self.sock = None
+        self.address = None
+        # Start time of the flow on the clock of the profile
+        self.start_time = None
+        # Bytes of the packets sent or failed, paced by the rate curve
+        self.paced_bytes = 0
+        # Statistics
+        self.sent_bytes = 0
+        self.sent_packets = 0
+        self.errors = 0
+        # Bytes sent and error of the worst report interval
+        self.report_bytes = 0
+        self.worst_error = 0.0
+
+    def open(self):
+        """Open the socket of the flow"""
+
+        family = socket.AF_INET6 if ':' in self.destination or \
+            self.sid_list else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        if self.source is not None:
+            self.sock.bind((self.source, 0))
+        if self.sid_list:
+            segments = self.sid_list
+            if self.destination != self.sid_list[-1]:
+                segments = segments + [self.destination]
+            self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RTHDR,
+                                 build_srh(segments))
+        # The socket is not connected, so the ICMP errors sent back by
+        # the destination (e.g. port unreachable) do not fail the sends
+        self.address = (self.destination, self.port)
+        # A full socket buffer must not stall the other flows
+        self.sock.setblocking(False)
+
+    def close(self):
+        """Close the socket of the flow"""
+
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def target_bytes(self, elapsed):
+        """Return the bytes to send in the first 'elapsed' seconds"""
+
+        elapsed = min(max(elapsed, 0), self.duration)
+        return self.curve.bits(elapsed) / 8
+
+    def send_owed(self, elapsed):
+        """Send the packets owed by the rate curve at 'elapsed' seconds"""
+
+        size = len(self.payload)
+        owed = int((self.target_bytes(elapsed) - self.paced_bytes) // size)
+        for _ in range(min(owed, MAX_BURST)):
+            try:
+                self.sock.sendto(self.payload, self.address)
+            except OSError:
+                # The flow does not retry the packet, so the error shows
+                # up in the accuracy
+                self.errors += 1
+            else:
+                self.sent_bytes += size
+                self.sent_packets += 1
+            self.paced_bytes += size
+
+    def record_interval(self, elapsed, report_interval):
+        """Update the worst error of the report intervals, at the end of
+        the interval ending at 'elapsed' seconds"""
+
+        target = self.target_bytes(elapsed) - \
+            self.target_bytes(elapsed - report_interval)
+        if target > 0:
+            error = abs(self.sent_bytes - self.report_bytes - target) / target
+            self.worst_error = max(self.worst_error, error)
+        self.report_bytes = self.sent_bytes
+
+    def report(self):
+        """Return the achieved and target rates of the flow"""
+
+        target_bytes = self.target_bytes(self.duration)
+        return {
+            'name': self.name,
+            'target_bitrate': target_bytes * 8 / self.duration,
+            'achieved_bitrate': self.sent_bytes * 8 / self.duration,
+            'accuracy': self.sent_bytes / target_bytes if target_bytes > 0
+            else None,
+            'worst_interval_error': self.worst_error,
+            'packets': self.sent_packets,
+            'errors': self.errors
+        }
+
+
+class ProfileRunner():
+    """Run the flows of a profile in the current thread, on a timing
+    wheel with a resolution of 'tick' seconds"""
+
+    def __init__(self, flows, tick=DEFAULT_TICK,
+                 report_interval=DEFAULT_REPORT_INTERVAL, now=time.monotonic,
+                 sleep=time.sleep):
+
+        # pylint: disable=too-many-arguments
+
+        self.flows = flows
+        self.tick = tick
+        self.report_interval = report_interval
+        self.now = now
+        self.sleep = sleep
+        self.wheel = timing.TimingWheel(tick)
+        self.start_time = None
+
+    def run(self, stop_event=None):
+        """Run the flows until all of them have ended or 'stop_event' is
+        set. Return the reports of the flows"""
+
+        self.start_time = self.now()
+        self.wheel = timing.TimingWheel(self.tick, start=self.start_time)
+        for flow in self.flows:
+            self.wheel.schedule(self.start_time + flow.start,
+                                self.start_flow, (flow,))
+        try:
+            self.wheel.run(self.now, self.sleep, stop_event)
+        finally:
+            for flow in self.flows:
+                flow.close()
+        return [flow.report() for flow in self.flows]
+
+    def start_flow(self, flow):
+        """Open the socket of a flow and send its first packets"""
+
+        flow.open()
+        flow.start_time = self.start_time + flow.start
+        self.wheel.schedule(flow.start_time, self.run_flow, (flow, 1))
+
+    def run_flow(self, flow, next_report):
+        """Send the packets owed by a flow and schedule its next tick"""
+
+        now = self.now()
+        elapsed = now - flow.start_time
+        flow.send_owed(elapsed)
+        # Report intervals closed since the last tick
+        while next_report * self.report_interval <= \
+                min(elapsed, flow.duration):
+            flow.record_interval(next_report * self.report_interval,
+                                 self.report_interval)
+            next_report += 1
+        if elapsed >= flow.duration:
+            # Last tick, all the bytes of the curve have been sent
+            flow.close()
+            return
+        self.wheel.schedule(min(now + self.tick,
+                                flow.start_time + flow.duration),
+                            self.run_flow, (flow, next_report))
+
+
+def load_profile(path):
+    """Load a profile from a JSON file. Return the flows and the tick.
+    Raise ValueError if the profile is not valid"""
+
+    with open(path) as profile_file:
+        profile = json.load(profile_file)
+    try:
+        return build_flows(profile)
+    except KeyError as err:
+        raise ValueError('Missing parameter {key} in the profile'.format(
+            key=err)) from None
+    except (AttributeError, TypeError) as err:
+        # E.g. a flow which is not an object or a parameter of the wrong
+        # type
+        raise ValueError('Invalid profile: {err}'.format(err=err)) from None
+
+
+def build_flows(profile):
+    """Build the flows of a profile. Return the flows and the tick"""
+
+    flows = []
+    for index, spec in enumerate(profile['flows']):
+        duration = spec.get('duration', DEFAULT_DURATION)
+        if not isinstance(duration, (int, float)) or duration <= 0:
+            raise ValueError('Invalid duration {duration} of flow {index}'
+                             .format(duration=duration, index=index))
+        flows.append(Flow(
+            name=spec.get('name', 'flow{index}'.format(index=index)),
+            curve=build_curve(spec['rate'], duration),
+            destination=spec.get('destination'),
+            sid_list=spec.get('sid_list'),
+            port=spec.get('port', DEFAULT_PORT),
+            packet_size=spec.get('packet_size', DEFAULT_PACKET_SIZE),
+            start=spec.get('start', 0),
+            duration=duration,
+            source=spec.get('source')
+        ))
+    tick = profile.get('tick', DEFAULT_TICK)
+    if tick <= 0:
+        raise ValueError('Invalid tick {tick}'.format(tick=tick))
+    return flows, tick
+
+
+def print_reports(reports):
+    """Print the achieved versus target rate of the flows"""
+
+    print('{:<16} {:>14} {:>14} {:>9} {:>9} {:>10} {:>7}'.format(
+        'flow', 'target Mbit/s', 'sent Mbit/s', 'accuracy', 'worst int',
+        'packets', 'errors'))
+    for report in reports:
+        accuracy = report['accuracy']
+        print('{:<16} {:>14.3f} {:>14.3f} {:>9} {:>8.1f}% {:>10} {:>7}'.format(
+            report['name'], report['target_bitrate'] / 1e6,
+            report['achieved_bitrate'] / 1e6,
+            '{:.1f}%'.format(accuracy * 100) if accuracy is not None
+            else '-', report['worst_interval_error'] * 100,
+            report['packets'], report['errors']))
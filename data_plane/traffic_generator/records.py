@@ -0,0 +1,279 @@
+#!/usr/bin/python
+
+
+"""This module normalizes the reports of iperf3 and aggregates them.
+
+The reports parsed from the output of iperf3 (see parse_client_report
+and parse_server_report) are dicts of strings, with the units printed by
+iperf3. They are converted into compact numeric records in base units
+(seconds, bytes, bits per second) and the records of all the streams are
+aggregated into windows of a few seconds, with the min, max and mean of
+each field, so a single report per window is exported instead of one per
+stream and interval."""
+
+# General imports
+import math
+import re
+
+# Units printed by iperf3, in bytes (the byte units are powers of 1024,
+# the bit units powers of 1000) and in bits per second
+BYTE_UNITS = {
+    'Bytes': 1, 'KBytes': 1024, 'MBytes': 1024 ** 2, 'GBytes': 1024 ** 3,
+    'bits': 1 / 8, 'Kbits': 1000 / 8, 'Mbits': 1000 ** 2 / 8,
+    'Gbits': 1000 ** 3 / 8
+}
+BITRATE_UNITS = {
+    unit + '/sec': value * 8 for unit, value in BYTE_UNITS.items()
+}
+# Units of the exported reports
+BYTE_DIM = 'Bytes'
+BITRATE_DIM = 'bits/sec'
+# Stream of the sums of the parallel streams, which are not aggregated
+SUM_STREAM = 'SUM'
+# Default sizes (in seconds) of the windows of the rollups
+DEFAULT_ROLLUP_WINDOWS = (10,)
+
+# Reports of the iperf3 server and client. The groups are the stream, the
+# interval, the transfer and its unit, the bitrate and its unit and, in
+# the reports of the client, the retransmissions (group 8) and the
+# congestion window and its unit
+SERVER_REPORT = re.compile(
+    r'^\[\s*(.+?)\s*]\s+(\d+.\d+-\d+.\d+)\s+sec\s+(\d+.\d+)\s(GBytes|MBytes|KBytes|Gbits|Mbits|Kbits|Bytes|bits)\s+(\d+.\d+)\s+((GBytes|MBytes|KBytes|Gbits|Mbits|Kbits|Bytes|bits)+\/sec)')    # pylint: disable=line-too-long  # noqa=E501
+CLIENT_REPORT = re.compile(
+    r'^\[\s*(.+?)\s*]\s+(\d+.\d+-\d+.\d+)\s+sec\s+(\d+.\d+)\s(GBytes|MBytes|KBytes|Gbits|Mbits|Kbits|Bytes|bits)\s+(\d+.\d+)\s+((GBytes|MBytes|KBytes|Gbits|Mbits|Kbits|Bytes|bits)+\/sec)\s+(\d+)\s+(\d+.\d+)\s+(GBytes|MBytes|KBytes|Gbits|Mbits|Kbits|Bytes|bits)')    # pylint: disable=line-too-long  # noqa=E501
+
+
+def parse_server_report(line):
+    """Parse a line of the log of the iperf3 server. Return a dict of
+    strings or None if the line is not a report"""
+
+    match = SERVER_REPORT.search(line)
+    if match is None:
+        return None
+    return {
+        'stream': match.group(1),
+        'interval': match.group(2),
+        'transfer': match.group(3),
+        'transfer_dim': match.group(4),
+        'bitrate': match.group(5),
+        'bitrate_dim': match.group(6)
+    }
+
+
+def parse_client_report(line):
+    """Parse a line of the log of the iperf3 client. Return a dict of
+    strings or None if the line is not a report"""
+
+    match = CLIENT_REPORT.search(line)
+    if match is None:
+        return None
+    return {
+        'stream': match.group(1),
+        'interval': match.group(2),
+        'transfer': match.group(3),
+        'transfer_dim': match.group(4),
+        'bitrate': match.group(5),
+        'bitrate_dim': match.group(6),
+        'retr': match.group(8),
+        'cwnd': match.group(9),
+        'cwnd_dim': match.group(10)
+    }
+
+
+class IperfRecord():
+    """A report of iperf3 for a stream and an interval, in base units.
+    'retr' and 'cwnd' are None in the reports of the server"""
+
+    __slots__ = ('stream', 'start', 'end', 'transfer', 'bitrate', 'retr',
+                 'cwnd')
+
+    def __init__(self, stream, start, end, transfer, bitrate, retr=None,
+                 cwnd=None):
+
+        # pylint: disable=too-many-arguments
+
+        self.stream = stream
+        self.start = start
+        self.end = end
+        self.transfer = transfer
+        self.bitrate = bitrate
+        self.retr = retr
+        self.cwnd = cwnd
+
+    @classmethod
+    def from_report(cls, report):
+        """Build a record from a report parsed by parse_client_report
+        or parse_server_report"""
+
+        start, end = report['interval'].split('-')
+        return cls(
+            report.get('stream'), float(start), float(end),
+            float(report['transfer']) * BYTE_UNITS[report['transfer_dim']],
+            float(report['bitrate']) * BITRATE_UNITS[report['bitrate_dim']],
+            int(report['retr']) if 'retr' in report else None,
+            float(report['cwnd']) * BYTE_UNITS[report['cwnd_dim']]
+            if 'cwnd' in report else None)
+
+    def as_report(self):
+        """Return the record as a report, in the format accepted by the
+        sinks of tg"""
+
+        report = {
+            'interval': '{start:.2f}-{end:.2f}'.format(
+                start=self.start, end=self.end),
+            'transfer': self.transfer,
+            'transfer_dim': BYTE_DIM,
+            'bitrate': self.bitrate,
+            'bitrate_dim': BITRATE_DIM
+        }
+        if self.stream is not None:
+            report['stream'] = self.stream
+        if self.retr is not None:
+            report['retr'] = self.retr
+        if self.cwnd is not None:
+            report['cwnd'] = self.cwnd
+            report['cwnd_dim'] = BYTE_DIM
+        return report
+
+
+class FieldStats():
+    """The min, max and mean of the samples of a field"""
+
+    __slots__ = ('count', 'min', 'max', 'total')
+
+    def __init__(self):
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.total = 0.0
+
+    def add(self, value):
+        """Add a sample"""
+
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        """Mean of the samples"""
+
+        return self.total / self.count if self.count > 0 else None
+
+
+class RollupWindow():
+    """The aggregate of the records of all the streams in a window"""
+
+    __slots__ = ('size', 'start', 'end', 'streams', 'transfer', 'bitrate',
+                 'retr', 'cwnd')
+
+    def __init__(self, size, start):
+        self.size = size
+        self.start = start
+        # End of the last record, the last window of a test can be shorter
+        self.end = start
+        self.streams = set()
+        # Total bytes and retransmissions of all the streams
+        self.transfer = 0.0
+        self.retr = None
+        # Bitrate and congestion window of the samples of the streams
+        self.bitrate = FieldStats()
+        self.cwnd = FieldStats()
+
+    def add(self, record):
+        """Add a record"""
+
+        self.streams.add(record.stream)
+        self.end = max(self.end, record.end)
+        self.transfer += record.transfer
+        self.bitrate.add(record.bitrate)
+        if record.retr is not None:
+            self.retr = (self.retr or 0) + record.retr
+        if record.cwnd is not None:
+            self.cwnd.add(record.cwnd)
+
+    def as_report(self):
+        """Return the window as a report, in the format accepted by the
+        sinks of tg. The bitrate is the one of all the streams together,
+        the min, max and mean are the ones of the samples of each stream"""
+
+        duration = self.end - self.start
+        report = {
+            'interval': '{start:.2f}-{end:.2f}'.format(
+                start=self.start, end=self.end),
+            'window': self.size,
+            'streams': len(self.streams),
+            'samples': self.bitrate.count,
+            'transfer': self.transfer,
+            'transfer_dim': BYTE_DIM,
+            'bitrate': self.transfer * 8 / duration if duration > 0 else 0.0,
+            'bitrate_dim': BITRATE_DIM,
+            'bitrate_min': self.bitrate.min,
+            'bitrate_max': self.bitrate.max,
+            'bitrate_mean': self.bitrate.mean
+        }
+        if self.retr is not None:
+            report['retr'] = self.retr
+        if self.cwnd.count > 0:
+            report['cwnd'] = self.cwnd.mean
+            report['cwnd_dim'] = BYTE_DIM
+            report['cwnd_min'] = self.cwnd.min
+            report['cwnd_max'] = self.cwnd.max
+        return report
+
+
+class Rollup():
+    """A stage aggregating the records into windows of one or more sizes
+    (in seconds). iperf3 prints the reports of all the streams of an
+    interval together, so a window is closed by the first record of a
+    later window. The sums of the parallel streams and the summaries
+    printed at the end of a test are skipped, since they repeat the
+    records of the streams. A record starting before the end of the
+    previous one of its stream, and ending earlier, starts a new test
+    (e.g. on a server) and closes the windows of the previous test"""
+
+    def __init__(self, windows=DEFAULT_ROLLUP_WINDOWS):
+        self.windows = sorted(windows)
+        # Open window of each size
+        self.open = {}
+        # End of the last record of each stream
+        self.last_end = {}
+
+    def add(self, record):
+        """Add a record. Return the reports of the windows closed by it"""
+
+        if record.stream == SUM_STREAM:
+            return []
+        closed = []
+        last_end = self.last_end.get(record.stream)
+        if last_end is not None and record.start < last_end - 1e-6:
+            if record.end >= last_end - 1e-6:
+                # Summary of the test
+                return []
+            closed = self.flush()
+            self.last_end = {}
+        self.last_end[record.stream] = record.end
+        for size in self.windows:
+            # The start of the records is rounded to the hundredth of
+            # second by iperf3
+            start = math.floor(record.start / size + 1e-6) * size
+            window = self.open.get(size)
+            if window is not None and window.start != start:
+                closed.append(window.as_report())
+                window = None
+            if window is None:
+                window = RollupWindow(size, start)
+                self.open[size] = window
+            window.add(record)
+        return closed
+
+    def flush(self):
+        """Close the open windows and return their reports"""
+
+        closed = [self.open[size].as_report() for size in self.windows
+                  if size in self.open]
+        self.open = {}
+        return closed
@@ -31,27 +31,28 @@ generation and monitoring with iperf3"""
 # pylint: disable=fixme
 
 import atexit
+import importlib.util
 import json
 import logging
 import os
-import re
 import signal
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from subprocess import PIPE, Popen
 
-try:
-    from kafka import KafkaProducer
-    ENABLE_KAFKA_INTEGRATION = True
-except ImportError:
-    ENABLE_KAFKA_INTEGRATION = False
+# Traffic generator dependencies
+from data_plane.traffic_generator import pipeline, profile, records
+
+# Kafka and gRPC are imported only when the data are published, so the
+# startup does not pay for them. Here we only check that they are installed
+ENABLE_KAFKA_INTEGRATION = importlib.util.find_spec('kafka') is not None
+if not ENABLE_KAFKA_INTEGRATION:
     print('WARNING: kafka-python not installed. Kafka features are disabled')
 
-try:
-    import grpc
-    import srv6pmServiceController_pb2_grpc
-    import srv6pmServiceController_pb2
-except ImportError:
-    ENABLE_CONTROLLER_INTEGRATION = False
+ENABLE_CONTROLLER_INTEGRATION = all(
+    importlib.util.find_spec(module) is not None
+    for module in ('grpc', 'srv6pmServiceController_pb2',
+                   'srv6pmServiceController_pb2_grpc'))
+if not ENABLE_CONTROLLER_INTEGRATION:
     print('WARNING: rose-srv6-protos not installed.'
           'Controller integration is disabled')
 
@@ -76,10 +77,23 @@ TOPIC = 'iperf'
 # Controller IP and port
 GRPC_IP_CONTROLLER = 'fcfd:0:0:fd::1'        # TODO remove hardcoded param
 GRPC_PORT_CONTROLLER = 50051        # TODO remove hardcoded param
-# gRPC channel
-channel = channel = grpc.insecure_channel(
-    'ipv6:[%s]:%s' %
-    (GRPC_IP_CONTROLLER, GRPC_PORT_CONTROLLER))  # TODO remove hardcoded param
+# gRPC channel, opened when the first data are sent to the controller
+channel = None        # pylint: disable=invalid-name
+
+
+def get_grpc_channel():
+    """Return the gRPC channel to the controller, opening it on first use"""
+
+    # pylint: disable=global-statement,invalid-name,import-outside-toplevel
+    global channel
+
+    if channel is None:
+        import grpc
+
+        # TODO remove hardcoded param
+        channel = grpc.insecure_channel(
+            'ipv6:[%s]:%s' % (GRPC_IP_CONTROLLER, GRPC_PORT_CONTROLLER))
+    return channel
 
 
 PUBLISH_TO_KAFKA = False
@@ -90,6 +104,14 @@ PUBLISH_TO_KAFKA = ENABLE_KAFKA_INTEGRATION and PUBLISH_TO_KAFKA
 SEND_DATA_TO_CONTROLLER = ENABLE_CONTROLLER_INTEGRATION and \
     SEND_DATA_TO_CONTROLLER
 
+# Default policies of the queues of the sinks. The reports sent to the
+# controller are kept as long as the queues can absorb a slow sink, the
+# ones published to Kafka are dropped when the producer falls behind
+DEFAULT_SINK_POLICIES = {
+    'kafka': pipeline.POLICY_DROP,
+    'controller': pipeline.POLICY_BLOCK
+}
+
 
 def publish_data_to_kafka(
         _from,
@@ -99,6 +121,9 @@ def publish_data_to_kafka(
         verbose=False):
     """Publish iperf3 data to Kafka"""
 
+    # pylint: disable=import-outside-toplevel
+    from kafka import KafkaProducer
+
     data['from'] = _from
     data['measure_id'] = measure_id
     data['generator_id'] = generator_id
@@ -127,6 +152,10 @@ def send_data_to_controller(_from, measure_id,
                             generator_id, data, verbose=False):
     """Send iperf3 data to a controller through the gRPC interface"""
 
+    # pylint: disable=import-outside-toplevel
+    import srv6pmServiceController_pb2
+    import srv6pmServiceController_pb2_grpc
+
     data['_from'] = _from
     data['measure_id'] = measure_id
     data['generator_id'] = generator_id
@@ -158,7 +187,8 @@ def send_data_to_controller(_from, measure_id,
         iperf_data.cwnd.val = float(data['cwnd'])
         iperf_data.cwnd.dim = str(data['cwnd_dim'])
     # Get the stub
-    stub = srv6pmServiceController_pb2_grpc.SRv6PMControllerStub(channel)
+    stub = srv6pmServiceController_pb2_grpc.SRv6PMControllerStub(
+        get_grpc_channel())
     # Send mesaurement data
     res = stub.SendIperfData(request)
     if verbose:
@@ -170,41 +200,10 @@ def parse_data_server(data, verbose=False):
 
     if verbose:
         print('Parsing line:  %s' % data)
-    # Search pattern
-    match = re.search(
-        r'^\[.+]\s+(\d+.\d+-\d+.\d+)\s+sec\s+(\d+.\d+)\s(MBytes|KBytes|Mbits|Kbits|Bytes|bits)\s+(\d+.\d+)\s+((MBytes|KBytes|Mbits|Kbits|Bytes|bits)+\/sec)',   # pylint: disable=line-too-long  # noqa=E501
-        data)
-    # Group 1.	Interval
-    # Group 2.	Transfer
-    # Group 3.	Transfer dimension
-    # Group 4.	Bitrate
-    # Group 5.	Bitrate dimension
-    # Group 6.	no needed
-
-    # Match
-    if match:
-        # Extract interval
-        interval = match.group(1)
-        # Extract transfer
-        transfer = match.group(2)
-        transfer_dim = match.group(3)
-        # Extract bitrate
-        bitrate = match.group(4)
-        bitrate_dim = match.group(5)
-        # Build results dict
-        res = {
-            'interval': interval,
-            'transfer': transfer,
-            'transfer_dim': transfer_dim,
-            'bitrate': bitrate,
-            'bitrate_dim': bitrate_dim
-        }
-        if verbose:
-            print('Got %s\n' % res)
-        # Return results
-        return res
-    # No match
-    return None
+    res = records.parse_server_report(data)
+    if verbose and res is not None:
+        print('Got %s\n' % res)
+    return res
 
 
 def parse_data_client(data, verbose=False):
@@ -212,52 +211,10 @@ def parse_data_client(data, verbose=False):
 
     if verbose:
         print('Parsing line:  %s' % data)
-    # Search pattern
-    match = re.search(r'^\[.+]\s+(\d+.\d+-\d+.\d+)\s+sec\s+(\d+.\d+)\s(MBytes|KBytes|Mbits|Kbits|Bytes|bits)\s+(\d+.\d+)\s+((MBytes|KBytes|Mbits|Kbits|Bytes|bits)+\/sec)\s+(\d+)\s+(\d+.\d+)\s+(MBytes|KBytes|Mbits|Kbits|Bytes|bits)',   # pylint: disable=line-too-long  # noqa=E501
-                      data)
-
-    # Group 1.	Interval
-    # Group 2.	Transfer
-    # Group 3.	Transfer dimension
-    # Group 4.	Bitrate
-    # Group 5.	Bitrate dimension
-    # Group 6.	no needed
-    # Group 7.	Retr
-    # Group 8.	Cwnd
-    # Group 9.	Cwnd dimension
-
-    # Match
-    if match:
-        # Extract interval
-        interval = match.group(1)
-        # Extract transfer
-        transfer = match.group(2)
-        transfer_dim = match.group(3)
-        # Extract bitrate
-        bitrate = match.group(4)
-        bitrate_dim = match.group(5)
-        # Extract retr
-        retr = match.group(7)
-        # Extract cwnd
-        cwnd = match.group(8)
-        cwnd_dim = match.group(9)
-        # Build results dict
-        res = {
-            'interval': interval,
-            'transfer': transfer,
-            'transfer_dim': transfer_dim,
-            'bitrate': bitrate,
-            'bitrate_dim': bitrate_dim,
-            'retr': retr,
-            'cwnd': cwnd,
-            'cwnd_dim': cwnd_dim
-        }
-        if verbose:
-            print('Got %s\n' % res)
-        # Return results
-        return res
-    # No match
-    return None
+    res = records.parse_client_report(data)
+    if verbose and res is not None:
+        print('Got %s\n' % res)
+    return res
 
 
 def cleanup(process):
@@ -272,8 +229,57 @@ def cleanup(process):
         pass
 
 
+def parse_record(parse, line, verbose=False):
+    """Parse a line with a parse function (parse_data_server or
+    parse_data_client) and return a numeric record or None"""
+
+    res = parse(line, verbose)
+    if res is None:
+        return None
+    return records.IperfRecord.from_report(res)
+
+
+def export_reports(process, parse, _from, measure_id, generator_id,
+                   sink_policies=None, queue_size=pipeline.DEFAULT_QUEUE_SIZE,
+                   rollup_windows=records.DEFAULT_ROLLUP_WINDOWS,
+                   verbose=False):
+    """Export the reports printed by an iperf3 process to the enabled
+    sinks, through a pipeline of bounded queues, so that a slow sink never
+    stalls iperf3. 'sink_policies' maps the name of a sink to the policy
+    of its queue (see DEFAULT_SINK_POLICIES). The reports are converted
+    to base units and, if 'rollup_windows' is not empty, aggregated into
+    windows of the given sizes (in seconds) before they are exported"""
+
+    # pylint: disable=too-many-arguments
+
+    policies = dict(DEFAULT_SINK_POLICIES)
+    policies.update(sink_policies or {})
+    sinks = []
+    # Publish data to Kafka
+    if PUBLISH_TO_KAFKA:
+        sinks.append(('kafka', lambda report: publish_data_to_kafka(
+            _from=_from, measure_id=measure_id, generator_id=generator_id,
+            data=report, verbose=verbose), policies['kafka']))
+    # Send data to the controller
+    if SEND_DATA_TO_CONTROLLER:
+        sinks.append(('controller', lambda report: send_data_to_controller(
+            _from=_from, measure_id=measure_id, generator_id=generator_id,
+            data=report, verbose=verbose), policies['controller']))
+    rollup = records.Rollup(rollup_windows) if rollup_windows else None
+    report_pipeline = pipeline.ReportPipeline(
+        lambda line: parse_record(parse, line, verbose), sinks, queue_size,
+        rollup)
+    report_pipeline.run(process.stdout)
+    # The output ends when iperf3 terminates
+    process.wait()
+    for name, stats in sorted(report_pipeline.stats().items()):
+        logger.info('Pipeline %s: %s', name, stats)
+
+
 def start_server(address, port=None, interval=None, measure_id=None,
-                 generator_id=None, one_off=False, verbose=False):
+                 generator_id=None, one_off=False, verbose=False,
+                 sink_policies=None, queue_size=pipeline.DEFAULT_QUEUE_SIZE,
+                 rollup_windows=records.DEFAULT_ROLLUP_WINDOWS):
     """Start iperf3 server"""
 
     # pylint: disable=too-many-arguments
@@ -296,43 +302,19 @@ def start_server(address, port=None, interval=None, measure_id=None,
     process = Popen(cmd, shell=True, stdout=PIPE)
     # Register process termination when the python program terminates
     atexit.register(cleanup, process=process)
-    # Iterate on the output generated by iperf3
-    while True:
-        # Read a line
-        out = process.stdout.readline().decode()
-        # Check if the process has terminated
-        if out == '' and process.poll() is not None:
-            break
-        # Parse the output generated by iperf3
-        if out != '':
-            # Parse data
-            res = parse_data_server(out, verbose)
-            if res is not None:
-                # Publish data to Kafka
-                if PUBLISH_TO_KAFKA:
-                    publish_data_to_kafka(
-                        _from='server',
-                        measure_id=measure_id,
-                        generator_id=generator_id,
-                        data=res,
-                        verbose=verbose
-                    )
-                # Send data to the controller
-                if SEND_DATA_TO_CONTROLLER:
-                    send_data_to_controller(
-                        _from='server',
-                        measure_id=measure_id,
-                        generator_id=generator_id,
-                        data=res,
-                        verbose=verbose
-                    )
+    # Export the reports generated by iperf3
+    export_reports(process, parse_data_server, 'server', measure_id,
+                   generator_id, sink_policies, queue_size, rollup_windows,
+                   verbose)
 
 
 def start_client(client_address, server_address, server_port=None,
                  interval=None, duration=None, bandwidth=None,
                  num_streams=None, mss=None, bidir=False,
                  reverse=False, zerocopy=False, version6=False,
-                 measure_id=None, generator_id=None, verbose=False):
+                 measure_id=None, generator_id=None, verbose=False,
+                 sink_policies=None, queue_size=pipeline.DEFAULT_QUEUE_SIZE,
+                 rollup_windows=records.DEFAULT_ROLLUP_WINDOWS):
     """Start iperf3 client"""
 
     # pylint: disable=too-many-branches, too-many-arguments, too-many-locals
@@ -379,36 +361,52 @@ def start_client(client_address, server_address, server_port=None,
     process = Popen(cmd, shell=True, stdout=PIPE)
     # Register process termination when the python program terminates
     atexit.register(cleanup, process=process)
-    # Iterate on the output generated by iperf3
-    while True:
-        # Read a line
-        out = process.stdout.readline().decode()
-        # Check if the process has terminated
-        if out == '' and process.poll() is not None:
-            break
-        # Parse the output generated by iperf3
-        if out != '':
-            # Parse data
-            res = parse_data_client(out, verbose)
-            if res is not None:
-                # Publish data to Kafka
-                if PUBLISH_TO_KAFKA:
-                    publish_data_to_kafka(
-                        _from='client',
-                        measure_id=measure_id,
-                        generator_id=generator_id,
-                        data=res,
-                        verbose=verbose
-                    )
-                # Send data to the controller
-                if SEND_DATA_TO_CONTROLLER:
-                    send_data_to_controller(
-                        _from='client',
-                        measure_id=measure_id,
-                        generator_id=generator_id,
-                        data=res,
-                        verbose=verbose
-                    )
+    # Export the reports generated by iperf3
+    export_reports(process, parse_data_client, 'client', measure_id,
+                   generator_id, sink_policies, queue_size, rollup_windows,
+                   verbose)
+
+
+def start_profile(path, tick=None, verbose=False):
+    """Send the flows of a profile (see profile.load_profile) from this
+    process and print the achieved versus target rate of each flow"""
+
+    try:
+        flows, profile_tick = profile.load_profile(path)
+    except (OSError, ValueError) as err:
+        print('Parameter error: {err}'.format(err=err))
+        return None
+    if verbose:
+        for flow in flows:
+            print('Flow {name}: destination {destination}, SID list '
+                  '{sid_list}, start {start}s, duration {duration}s'.format(
+                      name=flow.name, destination=flow.destination,
+                      sid_list=flow.sid_list, start=flow.start,
+                      duration=flow.duration))
+    runner = profile.ProfileRunner(flows, tick or profile_tick)
+    reports = runner.run()
+    profile.print_reports(reports)
+    for report in reports:
+        logger.info('Flow %s: %s', report['name'], report)
+    return reports
+
+
+def parse_rollup_windows(value):
+    """Parse the comma-separated sizes of the windows of the rollups.
+    The sizes equal to 0 are skipped"""
+
+    windows = []
+    for size in value.split(','):
+        try:
+            size = int(size)
+        except ValueError:
+            size = -1
+        if size < 0:
+            raise ArgumentTypeError('invalid window size in {value}'.format(
+                value=value))
+        if size > 0:
+            windows.append(size)
+    return windows
 
 
 def parse_arguments():
@@ -429,6 +427,17 @@ def parse_arguments():
         '-s', '--server', dest='server', action='store_true',
         default=False, help='Run in server mode'
     )
+    # Run the flows of a profile
+    parser.add_argument(
+        '--profile', dest='profile', action='store', default=None,
+        help='Send the flows of a profile (JSON file) instead of running '
+             'iperf3'
+    )
+    parser.add_argument(
+        '--profile-tick', dest='profile_tick', action='store', type=float,
+        default=None, help='Tick (in seconds) pacing the flows of the '
+                           'profile, overrides the one of the profile'
+    )
     # Measure ID
     parser.add_argument(
         '--measure-id', dest='measure_id', action='store',
@@ -507,6 +516,31 @@ def parse_arguments():
         '-1', '--one-of', dest='one_off', action='store_true',
         default=False, help='Handle one client connection, then exit'
     )
+    # Policies of the queues of the sinks
+    parser.add_argument(
+        '--kafka-policy', dest='kafka_policy', action='store',
+        choices=pipeline.POLICIES, default=DEFAULT_SINK_POLICIES['kafka'],
+        help='Policy of the queue of the reports published to Kafka'
+    )
+    parser.add_argument(
+        '--controller-policy', dest='controller_policy', action='store',
+        choices=pipeline.POLICIES,
+        default=DEFAULT_SINK_POLICIES['controller'],
+        help='Policy of the queue of the reports sent to the controller'
+    )
+    # Size of the queues of the export pipeline
+    parser.add_argument(
+        '--queue-size', dest='queue_size', action='store', type=int,
+        default=pipeline.DEFAULT_QUEUE_SIZE,
+        help='Size of the queues of the export pipeline'
+    )
+    # Windows of the rollups of the reports
+    parser.add_argument(
+        '--rollup', dest='rollup', action='store', type=parse_rollup_windows,
+        default=','.join(str(size) for size in records.DEFAULT_ROLLUP_WINDOWS),
+        help='Comma-separated sizes (in seconds) of the windows aggregating '
+             'the reports of all the streams, 0 to export every report'
+    )
     # Define whether to enable debug mode or not
     parser.add_argument(
         '-d', '--debug', action='store_true', help='Activate debug logs'
@@ -531,6 +565,9 @@ def __main():
     # Run in client mode
     host = args.host
     client = host is not None
+    # Profile of many flows
+    profile_path = args.profile
+    profile_tick = args.profile_tick
     # Measure ID
     measure_id = args.measure_id
     # Generator ID
@@ -565,6 +602,14 @@ def __main():
     debug = args.debug
     # Define whether to enable verbose mode or not
     verbose = args.verbose
+    # Policies and size of the queues of the export pipeline
+    sink_policies = {
+        'kafka': args.kafka_policy,
+        'controller': args.controller_policy
+    }
+    queue_size = args.queue_size
+    # Windows of the rollups of the reports
+    rollup_windows = args.rollup
     #
     # Setup properly the logger
     if debug:
@@ -575,7 +620,12 @@ def __main():
     server_debug = logger.getEffectiveLevel() == logging.DEBUG
     logging.info('SERVER_DEBUG: %s', str(server_debug))
     # Start server/client
-    if server and client:
+    if profile_path is not None and (server or client):
+        print('Parameter error: a profile cannot run with a client or '
+              'a server')
+    elif profile_path is not None:
+        start_profile(profile_path, profile_tick, verbose)
+    elif server and client:
         print('Parameter error: cannot be both server and client')
     elif not server and not client:
         print('Parameter error: must either be a client (-c) or a server (-s)')
@@ -587,7 +637,10 @@ def __main():
             one_off=one_off,
             measure_id=measure_id,
             generator_id=generator_id,
-            verbose=verbose
+            verbose=verbose,
+            sink_policies=sink_policies,
+            queue_size=queue_size,
+            rollup_windows=rollup_windows
         )
     elif client and not server:
         start_client(
@@ -605,7 +658,10 @@ def __main():
             version6=version6,
             measure_id=measure_id,
             generator_id=generator_id,
-            verbose=verbose
+            verbose=verbose,
+            sink_policies=sink_policies,
+            queue_size=queue_size,
+            rollup_windows=rollup_windows
         )
     else:
         print('Invalid params')
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+
+"""This module implements the admission control of the TWAMP queries
+received by a reflector.
+
+Each sender (i.e. each source address and SID list) has a token bucket,
+and all the queries share a global token bucket, so that the work of the
+reflector is bounded even when the queries come from many sources. The
+duplicates of a query already answered in the current interval are
+answered with the response already built, without reading the counters
+again and without taking a token."""
+
+# General imports
+import time
+from collections import OrderedDict
+
+# Default rate (queries per second) and burst of each sender. A sender
+# sends a query per interval on each path, plus the retransmissions
+DEFAULT_RATE = 10
+DEFAULT_BURST = 10
+# Default rate and burst of all the queries received by the reflector
+DEFAULT_GLOBAL_RATE = 10000
+DEFAULT_GLOBAL_BURST = 1000
+# Default max number of senders tracked. The least recently seen senders
+# are forgotten first
+DEFAULT_MAX_SENDERS = 65536
+
+# Decisions of the admission control
+ADMIT = 0
+COALESCE = 1
+DROP = 2
+
+
+class TokenBucket():
+    """A token bucket, refilled with 'rate' tokens per second up to
+    'burst' tokens"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def take(self, now):
+        """Take a token. Return False if the bucket is empty"""
+
+        tokens = min(self.burst,
+                     self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
+class SenderState():
+    """The state of a sender: its token bucket, the last query answered
+    with its response and the number of dropped queries"""
+
+    __slots__ = ('bucket', 'query', 'response', 'drops')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.query = None
+        self.response = None
+        self.drops = 0
+
+
+class AdmissionControl():
+    """A class deciding which TWAMP queries are answered. A rate of None
+    disables the corresponding token bucket"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 global_rate=DEFAULT_GLOBAL_RATE,
+                 global_burst=DEFAULT_GLOBAL_BURST,
+                 max_senders=DEFAULT_MAX_SENDERS):
+
+        # pylint: disable=too-many-arguments
+
+        self.rate = rate
+        self.burst = burst
+        self.global_bucket = TokenBucket(
+            global_rate, global_burst, time.monotonic()) \
+            if global_rate is not None else None
+        self.max_senders = max_senders
+        # Senders, in least recently seen order
+        self.senders = OrderedDict()
+        # Statistics
+        self.admitted = 0
+        self.coalesced = 0
+        self.dropped_rate = 0
+        self.dropped_global = 0
+
+    def admit(self, key, query_id, now=None):
+        """Decide if a query must be answered. 'key' identifies the sender
+        (e.g. its address and SID list), 'query_id' the query (e.g. the
+        interval, the color and the sequence number). Return ADMIT, COALESCE
+        if the query has already been answered and the last response must
+        be sent again, or DROP"""
+
+        if now is None:
+            now = time.monotonic()
+        state = self.senders.get(key)
+        if state is None:
+            state = SenderState(TokenBucket(self.rate, self.burst, now)
+                                if self.rate is not None else None)
+            self.senders[key] = state
+            if len(self.senders) > self.max_senders:
+                self.senders.popitem(last=False)
+        else:
+            self.senders.move_to_end(key)
+        # The duplicates of a query already answered (e.g. the
+        # retransmissions of a sender whose response was lost) take no
+        # token, so they are never dropped in place of the first copies
+        if state.response is not None and state.query == query_id:
+            self.coalesced += 1
+            return COALESCE
+        if state.bucket is not None and not state.bucket.take(now):
+            state.drops += 1
+            self.dropped_rate += 1
+            return DROP
+        if self.global_bucket is not None and \
+                not self.global_bucket.take(now):
+            state.drops += 1
+            self.dropped_global += 1
+            return DROP
+        self.admitted += 1
+        return ADMIT
+
+    def store_response(self, key, query_id, response):
+        """Store the response sent to a query, used to answer its
+        duplicates"""
+
+        state = self.senders.get(key)
+        if state is not None:
+            state.query = query_id
+            state.response = response
+
+    def get_response(self, key):
+        """Return the last response sent to a sender"""
+
+        return self.senders[key].response
+
+    def get_drops(self, key):
+        """Return the number of queries of a sender dropped"""
+
+        state = self.senders.get(key)
+        return state.drops if state is not None else 0
+
+    def stats(self):
+        """Return the counters of the admission control"""
+
+        return {
+            'admitted': self.admitted,
+            'coalesced': self.coalesced,
+            'droppedRate': self.dropped_rate,
+            'droppedGlobal': self.dropped_global,
+            'senders': len(self.senders)
+        }
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+
+"""This module manages the attachment of the eBPF programs to the
+interfaces.
+
+The programs are loaded only on the interfaces where they are not already
+attached, in parallel, and the set of interfaces is kept in sync with the
+interfaces of the node, which can be added or removed while the daemon is
+running (e.g. in a mininet lab)."""
+
+# General imports
+import importlib.util
+import select
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+
+# Netifaces dependencies
+import netifaces
+
+# pyroute2 is used to find the eBPF programs already attached to the
+# interfaces and to receive the notifications of the interface changes
+ENABLE_PYROUTE2 = importlib.util.find_spec('pyroute2') is not None
+if not ENABLE_PYROUTE2:
+    print('WARNING: pyroute2 not installed. The eBPF programs will be '
+          'reloaded on all the interfaces')
+
+# Parent of the tc filters attached to the egress hook (clsact qdisc)
+TC_H_CLSACT_EGRESS = 0xFFFFFFF3
+# Flag of the loopback interfaces (linux/if.h)
+IFF_LOOPBACK = 0x8
+# Default number of threads loading the programs
+DEFAULT_ATTACH_WORKERS = 8
+# Interval (in seconds) between two checks of the interfaces, when the
+# netlink notifications are not available, and timeout of the netlink
+# socket, used to check the stop event
+WATCH_INTERVAL = 1
+
+
+def is_xdp_attached(intf):
+    """True if an XDP program is attached to an interface"""
+
+    # pylint: disable=import-outside-toplevel
+
+    if not ENABLE_PYROUTE2:
+        return False
+    from pyroute2 import IPRoute
+    with IPRoute() as ipr:
+        idx = ipr.link_lookup(ifname=intf)
+        if len(idx) == 0:
+            return False
+        xdp = ipr.get_links(idx[0])[0].get_attr('IFLA_XDP')
+    return xdp is not None and bool(xdp.get_attr('IFLA_XDP_ATTACHED'))
+
+
+def is_tc_egress_attached(intf):
+    """True if a BPF filter is attached to the egress of an interface"""
+
+    # pylint: disable=import-outside-toplevel
+
+    if not ENABLE_PYROUTE2:
+        return False
+    from pyroute2 import IPRoute
+    from pyroute2.netlink.exceptions import NetlinkError
+    with IPRoute() as ipr:
+        idx = ipr.link_lookup(ifname=intf)
+        if len(idx) == 0:
+            return False
+        try:
+            filters = ipr.get_filters(index=idx[0],
+                                      parent=TC_H_CLSACT_EGRESS)
+        except NetlinkError:
+            # No clsact qdisc on the interface
+            return False
+    return any(tc_filter.get_attr('TCA_KIND') == 'bpf'
+               for tc_filter in filters)
+
+
+def is_loopback(intf):
+    """True if an interface is a loopback interface"""
+
+    try:
+        with open('/sys/class/net/{intf}/flags'.format(intf=intf)) as flags:
+            return int(flags.read(), 16) & IFF_LOOPBACK != 0
+    except (OSError, ValueError):
+        return intf == 'lo'
+
+
+class AttachManager():
+    """A class keeping the eBPF programs attached to a set of interfaces.
+
+    If the list of interfaces of a direction is empty, the programs are
+    attached to all the interfaces of the node except the loopback ones.
+    'epbf' is the EbpfPFPLM object loading the programs and 'exception'
+    the exception raised by its methods"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, epbf, exception, in_interfaces=None,
+                 out_interfaces=None, max_workers=DEFAULT_ATTACH_WORKERS):
+
+        # pylint: disable=too-many-arguments
+
+        self.epbf = epbf
+        self.exception = exception
+        self.in_interfaces = list(in_interfaces) if in_interfaces else []
+        self.out_interfaces = list(out_interfaces) if out_interfaces else []
+        self.max_workers = max_workers
+        # Interfaces with an attached program (loaded by us or found
+        # already attached)
+        self.attached_in = set()
+        self.attached_out = set()
+        # sync can be called by the watcher and by the owner of the driver
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.watcher = None
+
+    def desired_in(self):
+        """Return the interfaces which should have the ingress program"""
+
+        return self.desired(self.in_interfaces)
+
+    def desired_out(self):
+        """Return the interfaces which should have the egress program"""
+
+        return self.desired(self.out_interfaces)
+
+    @staticmethod
+    def desired(interfaces):
+        """Return the configured interfaces present on the node or, if no
+        interface is configured, all the non-loopback interfaces"""
+
+        present = netifaces.interfaces()
+        if interfaces:
+            return set(interfaces).intersection(present)
+        return set(intf for intf in present if not is_loopback(intf))
+
+    def load(self, direction, intf):
+        """Load a program on an interface, unless it is already attached.
+        Return True if the program is attached"""
+
+        if direction == 'in':
+            if is_xdp_attached(intf):
+                print('EBPF reattached ingress', intf)
+                return True
+            load = self.epbf.load_ingress
+        else:
+            if is_tc_egress_attached(intf):
+                print('EBPF reattached egress', intf)
+                return True
+            load = self.epbf.load_egress
+        try:
+            load(intf)
+        except self.exception as err:
+            err.print_exception()
+            return False
+        return True
+
+    def unload(self, direction, intf):
+        """Unload a program from an interface"""
+
+        unload = self.epbf.unload_ingress if direction == 'in' \
+            else self.epbf.unload_egress
+        try:
+            unload(intf)
+        except self.exception as err:
+            err.print_exception()
+
+    def sync(self):
+        """Load the programs on the interfaces that miss them, in parallel,
+        and forget the interfaces removed from the node"""
+
+        with self.lock:
+            desired_in = self.desired_in()
+            desired_out = self.desired_out()
+            # The programs of the removed interfaces are removed by the
+            # kernel with the interfaces
+            self.attached_in.intersection_update(desired_in)
+            self.attached_out.intersection_update(desired_out)
+            jobs = ([('in', intf) for intf in desired_in - self.attached_in] +
+                    [('out', intf) for intf in
+                     desired_out - self.attached_out])
+            if len(jobs) == 0:
+                return
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                results = list(pool.map(lambda job: self.load(*job), jobs))
+            for (direction, intf), attached in zip(jobs, results):
+                if not attached:
+                    continue
+                if direction == 'in':
+                    self.attached_in.add(intf)
+                else:
+                    self.attached_out.add(intf)
+            print('EBPF attached {num} programs in {elapsed:.3f} s'.format(
+                num=sum(results), elapsed=time.time() - start))
+
+    def detach_all(self):
+        """Unload the programs from all the interfaces, in parallel"""
+
+        with self.lock:
+            jobs = ([('in', intf) for intf in self.attached_in] +
+                    [('out', intf) for intf in self.attached_out])
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                list(pool.map(lambda job: self.unload(*job), jobs))
+            self.attached_in.clear()
+            self.attached_out.clear()
+
+    def start_watch(self):
+        """Start a thread keeping the programs attached to the interfaces
+        added to the node"""
+
+        self.watcher = Thread(target=self.watch, name='AttachManager')
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def stop_watch(self):
+        """Stop the thread watching the interfaces"""
+
+        self.stop_event.set()
+        if self.watcher is not None:
+            self.watcher.join()
+            self.watcher = None
+
+    def watch(self):
+        """Call sync every time an interface is added or removed. Use the
+        netlink notifications if available, otherwise poll the interfaces"""
+
+        # pylint: disable=import-outside-toplevel
+
+        if not ENABLE_PYROUTE2:
+            interfaces = set(netifaces.interfaces())
+            while not self.stop_event.wait(WATCH_INTERVAL):
+                current = set(netifaces.interfaces())
+                if current != interfaces:
+                    interfaces = current
+                    self.sync()
+            return
+        from pyroute2 import IPRoute
+        with IPRoute() as ipr:
+            # Subscribe to the notifications, including the link ones
+            ipr.bind()
+            # Interfaces added before the subscription
+            self.sync()
+            while not self.stop_event.is_set():
+                readable, _, _ = select.select([ipr], [], [], WATCH_INTERVAL)
+                if not readable:
+                    continue
+                if any(msg['event'] in ('RTM_NEWLINK', 'RTM_DELLINK')
+                       for msg in ipr.get()):
+                    self.sync()
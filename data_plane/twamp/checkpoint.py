@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+
+"""This module implements the checkpoint of the measurement sessions.
+
+The sessions are stored in a memory-mapped state file, one fixed-size
+record per session, so that a restarted daemon can resume them without
+the controller replaying every start_meas. The sequence numbers are
+updated in place in the record of the session, which is a single write to
+the mapped memory. The state is written to the page cache by the kernel,
+so it survives a crash or a restart of the daemon (not a crash of the
+host)."""
+
+# General imports
+import mmap
+import os
+import struct
+
+# Magic number and version of the state file
+MAGIC = b'TWCP'
+VERSION = 1
+# Header of the state file: magic, version, size of a record and number
+# of records
+HEADER = struct.Struct('<4sHHI')
+# Fixed part of a record: used flag, number of colors, measure ID (-1 for
+# a reflector), sequence number, interval (in seconds), margin (in
+# milliseconds), length of the SID list and of the return SID list. The
+# SID lists follow the fixed part
+RECORD = struct.Struct('<BBxxiQddHH')
+# The sequence number is updated in place
+SEQ_NUM = struct.Struct('<Q')
+SEQ_NUM_OFFSET = 8
+# Default size of a record and default number of records
+DEFAULT_RECORD_SIZE = 1024
+DEFAULT_NUM_SLOTS = 4096
+
+
+class SessionCheckpoint():
+    """A memory-mapped file storing the state of the sessions of a sender
+    or of a reflector. Each session object must own its state file"""
+
+    def __init__(self, path, num_slots=DEFAULT_NUM_SLOTS,
+                 record_size=DEFAULT_RECORD_SIZE):
+        self.path = path
+        self.num_slots = num_slots
+        self.record_size = record_size
+        size = HEADER.size + num_slots * record_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # A state file with a different layout cannot be resumed
+            header = os.read(fd, HEADER.size)
+            expected = HEADER.pack(MAGIC, VERSION, record_size, num_slots)
+            if header != expected:
+                if len(header) > 0:
+                    print('WARNING: incompatible state file {path}, the '
+                          'sessions will not be resumed'.format(path=path))
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, expected, 0)
+            self.mem = mmap.mmap(fd, size)
+        finally:
+            # The mapping keeps the file open
+            os.close(fd)
+        # Free records, the lowest ones are used first
+        self.free_slots = [slot for slot in range(num_slots - 1, -1, -1)
+                           if self.mem[self.offset_of(slot)] == 0]
+
+    def offset_of(self, slot):
+        """Return the offset of a record in the state file"""
+
+        return HEADER.size + slot * self.record_size
+
+    def store(self, sid_list, rev_sid_list, interval, margin,
+              num_color, meas_id=-1, seq_num=0):
+        """Store a new session and return its record, or None if the state
+        file is full or the SID lists do not fit in a record"""
+
+        # pylint: disable=too-many-arguments
+
+        sid_list = sid_list.encode()
+        rev_sid_list = rev_sid_list.encode()
+        if (RECORD.size + len(sid_list) + len(rev_sid_list) >
+                self.record_size):
+            print('WARNING: SID lists too long for the state file')
+            return None
+        if len(self.free_slots) == 0:
+            print('WARNING: state file {path} is full'.format(
+                path=self.path))
+            return None
+        slot = self.free_slots.pop()
+        offset = self.offset_of(slot)
+        data = (RECORD.pack(0, num_color, meas_id, seq_num, interval, margin,
+                            len(sid_list), len(rev_sid_list)) +
+                sid_list + rev_sid_list)
+        self.mem[offset:offset + len(data)] = data
+        # Mark the record as used only when it is complete
+        self.mem[offset] = 1
+        return slot
+
+    def update_seq(self, slot, seq_num):
+        """Update the sequence number of a session"""
+
+        SEQ_NUM.pack_into(self.mem, self.offset_of(slot) + SEQ_NUM_OFFSET,
+                          seq_num)
+
+    def clear(self, slot):
+        """Remove a session"""
+
+        self.mem[self.offset_of(slot)] = 0
+        self.free_slots.append(slot)
+
+    def load(self):
+        """Return the stored sessions as a list of dicts"""
+
+        records = []
+        for slot in range(self.num_slots):
+            offset = self.offset_of(slot)
+            if self.mem[offset] == 0:
+                continue
+            (_, num_color, meas_id, seq_num, interval, margin, sid_list_len,
+             rev_sid_list_len) = RECORD.unpack_from(self.mem, offset)
+            offset += RECORD.size
+            sid_list = self.mem[offset:offset + sid_list_len].decode()
+            offset += sid_list_len
+            rev_sid_list = self.mem[offset:offset + rev_sid_list_len].decode()
+            records.append({
+                'slot': slot,
+                'meas_id': meas_id,
+                'seq_num': seq_num,
+                'interval': interval,
+                'margin': margin,
+                'num_color': num_color,
+                'sid_list': sid_list,
+                'rev_sid_list': rev_sid_list
+            })
+        return records
+
+    def flush(self):
+        """Write the state file to the disk"""
+
+        self.mem.flush()
+
+    def close(self):
+        """Flush and unmap the state file"""
+
+        self.mem.flush()
+        self.mem.close()
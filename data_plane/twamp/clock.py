@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+
+"""This module estimates the offset of the local clock from a reference
+clock and adapts the measurement margin to the network.
+
+The colors change at the same instants on all the nodes only if their
+clocks agree. The daemon periodically queries a reference (an NTP server,
+or any object with the same query interface, e.g. a stand-in used in a
+lab) and shifts its color boundaries by the estimated offset. The margin
+after a change of color must cover the delay of the packets marked with
+the old color, the lateness of the change of color and the error of the
+offset, so it is derived from the observed values of these quantities
+instead of being fixed."""
+
+# General imports
+import importlib.util
+import time
+from collections import deque
+from datetime import timedelta
+from threading import Event, Thread
+
+# ntplib is used to query the NTP servers
+ENABLE_NTPLIB = importlib.util.find_spec('ntplib') is not None
+if not ENABLE_NTPLIB:
+    print('WARNING: ntplib not installed. The clock offset cannot be '
+          'estimated against an NTP server')
+
+# Default options of the NTP queries
+DEFAULT_NTP_PORT = 123
+DEFAULT_NTP_VERSION = 3
+DEFAULT_NTP_TIMEOUT = 1
+# Default interval (in seconds) between two queries to the reference and
+# number of samples used to estimate the offset
+DEFAULT_SYNC_INTERVAL = 16
+DEFAULT_NUM_OFFSET_SAMPLES = 8
+# Default lowest margin (in milliseconds), safety factor applied to the
+# observed delays and number of samples of each delay kept
+DEFAULT_MIN_MARGIN = 10
+DEFAULT_MARGIN_SAFETY = 2
+DEFAULT_NUM_MARGIN_SAMPLES = 64
+
+
+class NtpReference():
+    """A reference clock provided by an NTP server"""
+
+    def __init__(self, server, port=DEFAULT_NTP_PORT,
+                 version=DEFAULT_NTP_VERSION, timeout=DEFAULT_NTP_TIMEOUT):
+        if not ENABLE_NTPLIB:
+            raise ImportError('ntplib is required to query an NTP server')
+        self.server = server
+        self.port = port
+        self.version = version
+        self.timeout = timeout
+
+    def query(self):
+        """Return the offset of the local clock from the reference and the
+        round-trip delay of the query, in seconds. Raise OSError if the
+        reference does not answer"""
+
+        # pylint: disable=import-outside-toplevel
+
+        import ntplib
+        try:
+            response = ntplib.NTPClient().request(
+                self.server, version=self.version, port=self.port,
+                timeout=self.timeout)
+        except ntplib.NTPException as err:
+            raise OSError(str(err)) from err
+        return response.offset, response.delay
+
+
+class StaticReference():
+    """A reference clock with a fixed offset from the local clock, e.g. a
+    stand-in for an NTP server in a lab"""
+
+    def __init__(self, offset=0.0, delay=0.0):
+        self.offset = offset
+        self.delay = delay
+
+    def query(self):
+        """Return the offset of the local clock from the reference and the
+        round-trip delay of the query, in seconds"""
+
+        return self.offset, self.delay
+
+
+class ClockOffsetEstimator():
+    """A class estimating the offset of the local clock from a reference.
+    Of the last samples, the one with the shortest round-trip delay is
+    used, since its offset has the smallest error (as in the NTP clock
+    filter). The estimator is started and stopped by its owner"""
+
+    def __init__(self, reference, sync_interval=DEFAULT_SYNC_INTERVAL,
+                 num_samples=DEFAULT_NUM_OFFSET_SAMPLES):
+        self.reference = reference
+        self.sync_interval = sync_interval
+        # (round-trip delay, offset) of the last queries
+        self.samples = deque(maxlen=num_samples)
+        # Offset (in seconds) to add to the local clock and its max error
+        self.offset = 0.0
+        self.error = 0.0
+        self.stop_event = Event()
+        self.thread = None
+
+    def update(self):
+        """Query the reference and update the offset. Return False if the
+        reference did not answer"""
+
+        try:
+            offset, delay = self.reference.query()
+        except OSError as err:
+            print('WARNING: clock reference not reachable: {err}'.format(
+                err=err))
+            return False
+        self.samples.append((delay, offset))
+        delay, self.offset = min(self.samples)
+        self.error = delay / 2
+        return True
+
+    def now(self):
+        """Return the current time of the reference clock (POSIX timestamp
+        in seconds)"""
+
+        return time.time() + self.offset
+
+    def start(self):
+        """Estimate the offset and start a thread updating it"""
+
+        self.update()
+        self.thread = Thread(target=self.run, name='ClockOffsetEstimator')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the thread updating the offset"""
+
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """Query the reference every sync_interval seconds"""
+
+        while not self.stop_event.wait(self.sync_interval):
+            self.update()
+
+
+class AdaptiveMargin():
+    """A measurement margin adapted to the network. The margin is the sum
+    of the largest recent round-trip time and lateness of the change of
+    color, multiplied by a safety factor, plus the error of the clock
+    offset on both the nodes. It is clamped to [min_margin, max_margin]
+    (in milliseconds)"""
+
+    def __init__(self, min_margin=DEFAULT_MIN_MARGIN, max_margin=None,
+                 safety=DEFAULT_MARGIN_SAFETY,
+                 num_samples=DEFAULT_NUM_MARGIN_SAMPLES, clock=None):
+
+        # pylint: disable=too-many-arguments
+
+        self.min_margin = min_margin
+        self.max_margin = max_margin
+        self.safety = safety
+        # Observed round-trip times and lateness (in seconds)
+        self.rtts = deque(maxlen=num_samples)
+        self.lateness = deque(maxlen=num_samples)
+        # ClockOffsetEstimator providing the error of the offset
+        self.clock = clock
+
+    def record_rtt(self, rtt):
+        """Record a round-trip time (in seconds)"""
+
+        self.rtts.append(rtt)
+
+    def record_lateness(self, lateness):
+        """Record the lateness of a change of color (in seconds)"""
+
+        self.lateness.append(max(lateness, 0.0))
+
+    def margin(self):
+        """Return the margin as a timedelta, or None until a round-trip
+        time has been observed"""
+
+        if len(self.rtts) == 0:
+            return None
+        error = self.clock.error if self.clock is not None else 0.0
+        margin = (self.safety * (max(self.rtts) + max(self.lateness,
+                                                      default=0.0)) +
+                  2 * error) * 1000
+        margin = max(margin, self.min_margin)
+        if self.max_margin is not None:
+            margin = min(margin, self.max_margin)
+        return timedelta(milliseconds=margin)
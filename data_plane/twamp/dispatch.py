@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+
+"""This module implements the dispatch of the TWAMP packets to a pool of
+workers.
+
+The capture thread used to run the whole receive path of a packet
+(dissection of the TWAMP payload, counter reads, construction and
+transmission of the query or of the response), so a single slow read of
+the eBPF maps delayed every packet queued behind it and the socket could
+overflow. The capture thread now only extracts the key of the session
+and hands the packet to a worker. The workers are sharded by the key, so
+the packets of a session are always handled by the same worker, in the
+order they were received, while different sessions are handled in
+parallel. Each worker has a bounded queue: when it is full the packet is
+dropped and counted, so an overloaded worker never blocks the capture
+thread."""
+
+# General imports
+import queue
+import zlib
+from threading import Thread
+
+# Default number of workers
+DEFAULT_NUM_WORKERS = 4
+# Default max number of packets waiting in the queue of a worker
+DEFAULT_QUEUE_SIZE = 1024
+# Fraction of its queue above which a worker is reported as overloaded
+OVERLOAD_RATIO = 0.8
+
+# Item telling a worker to stop
+_STOP = object()
+
+
+def shard_of(key, num_shards):
+    """Return the index of the worker handling a session. The hash of the
+    key must not depend on the process, so we cannot use hash()"""
+
+    if key is None:
+        return 0
+    return zlib.crc32(key.encode()) % num_shards
+
+
+class DispatchPool():
+    """A pool of worker threads calling 'handler(item)' on the items
+    submitted, sharded by the key of their session"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, handler, num_workers=DEFAULT_NUM_WORKERS,
+                 queue_size=DEFAULT_QUEUE_SIZE, name='DispatchWorker'):
+        if num_workers < 1:
+            raise ValueError('Invalid number of workers {num}'.format(
+                num=num_workers))
+        if queue_size < 1:
+            raise ValueError('Invalid queue size {size}'.format(
+                size=queue_size))
+        self.handler = handler
+        self.queue_size = queue_size
+        self.name = name
+        self.queues = [queue.Queue(queue_size) for _ in range(num_workers)]
+        self.threads = []
+        # Statistics of each worker. The counters of the submitted and of
+        # the dropped items are only updated by the capture thread, the
+        # other ones only by the worker
+        self.submitted = [0] * num_workers
+        self.dropped = [0] * num_workers
+        self.handled = [0] * num_workers
+        self.errors = [0] * num_workers
+        self.max_depth = [0] * num_workers
+
+    def __len__(self):
+        return len(self.queues)
+
+    def start(self):
+        """Start the workers"""
+
+        if self.threads:
+            return
+        for index in range(len(self.queues)):
+            thread = Thread(target=self.run_worker, args=(index,),
+                            name='{name}-{index}'.format(name=self.name,
+                                                         index=index))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop the workers after the items already submitted"""
+
+        for work_queue in self.queues:
+            work_queue.put(_STOP)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def submit(self, key, item):
+        """Hand an item to the worker of its session. Return False if the
+        queue of the worker is full and the item has been dropped"""
+
+        index = shard_of(key, len(self.queues))
+        work_queue = self.queues[index]
+        try:
+            work_queue.put_nowait(item)
+        except queue.Full:
+            self.dropped[index] += 1
+            return False
+        self.submitted[index] += 1
+        # qsize() is approximate, good enough for a high-water mark
+        depth = work_queue.qsize()
+        if depth > self.max_depth[index]:
+            self.max_depth[index] = depth
+        return True
+
+    def drain(self):
+        """Wait until the workers have handled all the items submitted"""
+
+        for work_queue in self.queues:
+            work_queue.join()
+
+    def run_worker(self, index):
+        """Loop of a worker: handle the items of its queue in order"""
+
+        work_queue = self.queues[index]
+        while True:
+            item = work_queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self.handler(item)
+                self.handled[index] += 1
+            except Exception as err:        # pylint: disable=broad-except
+                # A bad packet must not kill the worker of its sessions
+                self.errors[index] += 1
+                print('{name}-{index}: error handling a packet: {err}'
+                      .format(name=self.name, index=index, err=err))
+            finally:
+                work_queue.task_done()
+
+    def stats(self):
+        """Return the statistics of the pool: the current and the max
+        depth of the queues, the items submitted, handled, dropped because
+        a queue was full and failed, and the workers overloaded now"""
+
+        depths = [work_queue.qsize() for work_queue in self.queues]
+        return {
+            'workers': len(self.queues),
+            'queueSize': self.queue_size,
+            'depth': sum(depths),
+            'maxDepth': max(self.max_depth),
+            'depths': depths,
+            'submitted': sum(self.submitted),
+            'handled': sum(self.handled),
+            'dropped': sum(self.dropped),
+            'errors': sum(self.errors),
+            'overloaded': sum(1 for depth in depths
+                              if depth >= OVERLOAD_RATIO * self.queue_size)
+        }
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+
+"""This module implements a compact histogram of the delay samples.
+
+The histogram is log-linear, as in HdrHistogram: the values are split in
+ranges of powers of two, and each range is split in a fixed number of
+linear sub-buckets. The relative error of the reported values is bounded
+by the number of sub-buckets, regardless of the magnitude of the values.
+The counters are stored in a flat array, so the memory of a histogram
+does not grow with the number of samples."""
+
+# General imports
+from array import array
+
+# Default number of bits of the sub-buckets, i.e. 32 sub-buckets per
+# power of two and a relative error lower than 3.2%
+DEFAULT_SUB_BUCKET_BITS = 5
+# Default number of bits of the largest value, i.e. about 68 seconds
+# when the values are in nanoseconds
+DEFAULT_VALUE_BITS = 36
+# Percentiles reported in the measurement data
+PERCENTILES = (50, 90, 99)
+
+
+class DelayHistogram():
+    """A log-linear histogram of non-negative integer values (e.g. delays
+    in nanoseconds). The values larger than the largest one are counted in
+    the last bucket, the negative values in the first one"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    __slots__ = ('sub_bucket_bits', 'value_bits', 'sub_bucket_count',
+                 'half_count', 'max_value', 'counts', 'count', 'total',
+                 'min', 'max')
+
+    def __init__(self, sub_bucket_bits=DEFAULT_SUB_BUCKET_BITS,
+                 value_bits=DEFAULT_VALUE_BITS):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.value_bits = value_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.half_count = self.sub_bucket_count >> 1
+        self.max_value = (1 << value_bits) - 1
+        # The values lower than sub_bucket_count have a bucket each, then
+        # each power of two has half_count buckets. The sessions record
+        # a few samples per interval, so 32 bit counters are enough
+        self.counts = array('I', [0]) * (
+            self.sub_bucket_count +
+            (value_bits - sub_bucket_bits) * self.half_count)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def index_of(self, value):
+        """Return the index of the bucket containing a value"""
+
+        if value < self.sub_bucket_count:
+            return value if value > 0 else 0
+        if value > self.max_value:
+            value = self.max_value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return (self.sub_bucket_count + (shift - 1) * self.half_count +
+                (value >> shift) - self.half_count)
+
+    def bounds_of(self, index):
+        """Return the lowest and the highest value of a bucket"""
+
+        if index < self.sub_bucket_count:
+            return index, index
+        shift = (index - self.sub_bucket_count) // self.half_count + 1
+        sub_bucket = ((index - self.sub_bucket_count) % self.half_count +
+                      self.half_count)
+        return sub_bucket << shift, ((sub_bucket + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        """Record a value"""
+
+        value = int(value)
+        self.counts[self.index_of(value)] += count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the samples of another histogram, e.g. the histogram of
+        another interval or the one of the same session in another shard"""
+
+        if (other.sub_bucket_bits != self.sub_bucket_bits or
+                other.value_bits != self.value_bits):
+            raise ValueError('Cannot merge histograms with different layouts')
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, percentile):
+        """Return the value below which the given percentage of the samples
+        falls, or None if the histogram is empty. The value is the middle of
+        the bucket, clamped to the recorded min and max"""
+
+        if self.count == 0:
+            return None
+        # Rank of the sample, starting from 1
+        rank = max(1, -(-self.count * percentile // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                low, high = self.bounds_of(index)
+                return min(max((low + high) // 2, self.min), self.max)
+        return self.max
+
+    def mean(self):
+        """Return the mean of the samples, or None if there are none"""
+
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def reset(self):
+        """Remove all the samples"""
+
+        self.counts = array('I', [0]) * len(self.counts)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def summary(self, prefix=''):
+        """Return the count and the percentiles of the samples as a dict,
+        whose keys start with 'prefix'. The percentiles are missing if the
+        histogram is empty"""
+
+        data = {prefix + 'Count': self.count}
+        if self.count == 0:
+            return data
+        data[prefix + 'Min'] = self.min
+        data[prefix + 'Max'] = self.max
+        for percentile in PERCENTILES:
+            data['{prefix}P{percentile}'.format(
+                prefix=prefix, percentile=percentile)] = \
+                self.percentile(percentile)
+        return data
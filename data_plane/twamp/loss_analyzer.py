@@ -0,0 +1,473 @@
+#!/usr/bin/python
+
+
+"""Offline analysis of the packet loss measured by the TWAMP daemon.
+
+The measurement data are read from the log written by the sender (see
+measlog) or from a pcap of the TWAMP responses, in chunks, so the memory
+does not grow with the number of intervals. The counters of a color are
+cumulative, so the loss of an interval is the difference between the
+packets sent and received since the previous measurement of the same path
+and color. The analyzer reports the loss of each path, the worst
+intervals and, given the log of an iperf3 client or server started by the
+traffic generator, the correlation between the loss and the traffic.
+
+NumPy is used when installed; otherwise the chunks are processed row by
+row, with the same results."""
+
+# General imports
+import heapq
+import importlib.util
+import math
+import struct
+import sys
+from argparse import ArgumentParser
+
+# Data-plane dependencies
+from data_plane.traffic_generator import records
+from data_plane.twamp import measlog, twamp, utils
+
+# NumPy is used to process the chunks with vectorized operations
+ENABLE_NUMPY = importlib.util.find_spec('numpy') is not None
+
+# Directions of the measurement: name, counter of the sender of the
+# packets, counter of the receiver and color
+DIRECTIONS = (
+    ('fw', 'ssTXc', 'rfRXc', 'fwColor'),
+    ('rv', 'rfTXc', 'ssRXc', 'rvColor'),
+)
+# UDP port of the sender, i.e. destination port of the responses
+SENDER_UDP_PORT = 1206
+# Length of the link-layer header of the supported pcap link types
+# (Ethernet, raw IP, Linux cooked capture)
+LINKTYPE_HEADER_LEN = {1: 14, 101: 0, 228: 0, 229: 0, 113: 16}
+# Header of a pcap file and magic numbers of the little-endian and
+# big-endian files, with the resolution of their timestamps
+PCAP_HEADER_LEN = 24
+PCAP_MAGIC_LE = {b'\xd4\xc3\xb2\xa1': 1e-6, b'\x4d\x3c\xb2\xa1': 1e-9}
+PCAP_MAGIC_BE = {b'\xa1\xb2\xc3\xd4': 1e-6, b'\xa1\xb2\x3c\x4d': 1e-9}
+# Default number of worst intervals reported
+DEFAULT_TOP = 10
+
+
+def iter_pcap(path):
+    """Iterate over the packets of a pcap file, as (timestamp, link type,
+    data) tuples. The file is read sequentially, one packet at a time"""
+
+    with open(path, 'rb') as pcap:
+        header = pcap.read(PCAP_HEADER_LEN)
+        if len(header) < PCAP_HEADER_LEN:
+            raise ValueError('Truncated pcap header')
+        magic = header[:4]
+        if magic in PCAP_MAGIC_LE:
+            endian = '<'
+            resolution = PCAP_MAGIC_LE[magic]
+        elif magic in PCAP_MAGIC_BE:
+            endian = '>'
+            resolution = PCAP_MAGIC_BE[magic]
+        else:
+            raise ValueError('Not a pcap file (pcapng is not supported)')
+        linktype, = struct.unpack_from(endian + 'I', header, 20)
+        record = struct.Struct(endian + 'IIII')
+        while True:
+            record_header = pcap.read(record.size)
+            if len(record_header) < record.size:
+                return
+            sec, frac, caplen, _ = record.unpack(record_header)
+            yield sec + frac * resolution, linktype, pcap.read(caplen)
+
+
+def read_pcap_chunks(path, chunk_rows=measlog.DEFAULT_CHUNK_ROWS):
+    """Decode the TWAMP responses of a pcap and return them in chunks with
+    the same fields of the measurement log. The paths are identified by
+    their return SID list, numbered in order of appearance, and the RX
+    counter of the sender, which is not carried by the packets, is
+    missing. Return the generator of the chunks and the list of the SID
+    lists of the paths"""
+
+    paths = []
+    path_ids = {}
+
+    def generator():
+        chunk = new_chunk()
+        for timestamp, linktype, data in iter_pcap(path):
+            header_len = LINKTYPE_HEADER_LEN.get(linktype)
+            if header_len is None:
+                raise ValueError('Unsupported link type {linktype}'.format(
+                    linktype=linktype))
+            parsed = utils.parse_srv6_udp(data[header_len:])
+            if parsed is None or parsed[1] != SENDER_UDP_PORT:
+                continue
+            addresses, _, offset = parsed
+            resp = twamp.TWAMPTestResponse(data[header_len + offset:])
+            key = utils.sid_list_key(utils.rem_punt(addresses)[::-1])
+            if key not in path_ids:
+                path_ids[key] = len(paths)
+                paths.append(key)
+            chunk['timestamp'].append(timestamp)
+            chunk['meas_id'].append(path_ids[key])
+            chunk['ssTXc'].append(resp.SenderCounter)
+            chunk['rfRXc'].append(resp.ReceiveCounter)
+            chunk['rfTXc'].append(resp.TransmitCounter)
+            chunk['fwColor'].append(resp.SenderBlockNumber)
+            chunk['rvColor'].append(resp.BlockNumber)
+            if len(chunk['timestamp']) == chunk_rows:
+                yield chunk
+                chunk = new_chunk()
+        if chunk['timestamp']:
+            yield chunk
+
+    return generator(), paths
+
+
+def new_chunk():
+    """Return an empty chunk of the responses decoded from a pcap"""
+
+    return {'timestamp': [], 'meas_id': [], 'ssTXc': [], 'rfRXc': [],
+            'rfTXc': [], 'fwColor': [], 'rvColor': []}
+
+
+def read_iperf_log(path, start_time):
+    """Parse the log of an iperf3 client or server. Return the list of the
+    (start, end, transferred bytes) of the reports, where start and end
+    are POSIX timestamps, given the start time of iperf3. The sums of the
+    parallel streams are skipped, since they repeat the reports of the
+    streams"""
+
+    reports = []
+    with open(path) as log:
+        for line in log:
+            res = (records.parse_client_report(line) or
+                   records.parse_server_report(line))
+            if res is None:
+                continue
+            record = records.IperfRecord.from_report(res)
+            if record.stream == records.SUM_STREAM:
+                continue
+            reports.append((start_time + record.start,
+                            start_time + record.end, record.transfer))
+    return reports
+
+
+def pearson(xs, ys):
+    """Return the Pearson correlation of two sequences, or None if it is
+    not defined"""
+
+    count = len(xs)
+    if count < 2:
+        return None
+    mean_x = sum(xs) / count
+    mean_y = sum(ys) / count
+    cov = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    var_y = sum((y - mean_y) ** 2 for y in ys)
+    if var_x == 0 or var_y == 0:
+        return None
+    return cov / math.sqrt(var_x * var_y)
+
+
+class LossAnalyzer():
+    """A class accumulating the loss of the intervals of a measurement,
+    one chunk at a time"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, top=DEFAULT_TOP, iperf_reports=None):
+        self.top = top
+        # Last counters of each direction, path and color
+        self.state = {direction[0]: {} for direction in DIRECTIONS}
+        # (direction, path) -> [intervals, sent, lost]
+        self.totals = {}
+        # Heap of the worst intervals:
+        # (lost, timestamp, path, direction, sent)
+        self.worst = []
+        # Packets sent and lost during each iperf3 report
+        self.iperf_reports = iperf_reports or []
+        self.iperf_starts = [report[0] for report in self.iperf_reports]
+        self.iperf_sent = [0] * len(self.iperf_reports)
+        self.iperf_lost = [0] * len(self.iperf_reports)
+        self.rows = 0
+
+    def add_chunk(self, chunk):
+        """Add the intervals of a chunk"""
+
+        self.rows += len(chunk['timestamp'])
+        for direction, tx_field, rx_field, color_field in DIRECTIONS:
+            if rx_field not in chunk or tx_field not in chunk:
+                continue
+            if ENABLE_NUMPY:
+                self.add_losses_numpy(direction, *self.losses_numpy(
+                    chunk, direction, tx_field, rx_field, color_field))
+            else:
+                self.add_losses(direction, *self.losses(
+                    chunk, direction, tx_field, rx_field, color_field))
+
+    def losses(self, chunk, direction, tx_field, rx_field, color_field):
+        """Return the timestamp, path, sent and lost packets of each
+        interval of a chunk, for a direction"""
+
+        # pylint: disable=too-many-arguments,too-many-locals
+
+        state = self.state[direction]
+        intervals = ([], [], [], [])
+        for timestamp, path, color, tx_counter, rx_counter in zip(
+                chunk['timestamp'], chunk['meas_id'], chunk[color_field],
+                chunk[tx_field], chunk[rx_field]):
+            key = (path, color)
+            prev = state.get(key)
+            state[key] = (tx_counter, rx_counter)
+            if prev is None:
+                continue
+            sent = tx_counter - prev[0]
+            received = rx_counter - prev[1]
+            if sent < 0 or received < 0:
+                # The counters have been reset, e.g. the flow was re-added
+                continue
+            for values, value in zip(intervals, (timestamp, path, sent,
+                                                 sent - received)):
+                values.append(value)
+        return intervals
+
+    def losses_numpy(self, chunk, direction, tx_field, rx_field,
+                     color_field):
+        """Vectorized version of losses, returning NumPy arrays"""
+
+        # pylint: disable=too-many-arguments,too-many-locals
+        # pylint: disable=import-outside-toplevel
+
+        import numpy
+
+        state = self.state[direction]
+        path = numpy.asarray(chunk['meas_id'], dtype=numpy.int64)
+        key = path * 256 + numpy.asarray(chunk[color_field],
+                                         dtype=numpy.int64)
+        timestamp = numpy.asarray(chunk['timestamp'], dtype=numpy.float64)
+        # Group the samples of each path and color, in order of time
+        order = numpy.lexsort((timestamp, key))
+        key = key[order]
+        path = path[order]
+        timestamp = timestamp[order]
+        tx_counter = numpy.asarray(chunk[tx_field],
+                                   dtype=numpy.int64)[order]
+        rx_counter = numpy.asarray(chunk[rx_field],
+                                   dtype=numpy.int64)[order]
+        first = numpy.ones(len(key), dtype=bool)
+        first[1:] = key[1:] != key[:-1]
+        last = numpy.ones(len(key), dtype=bool)
+        last[:-1] = first[1:]
+        prev_tx = numpy.empty_like(tx_counter)
+        prev_tx[1:] = tx_counter[:-1]
+        prev_rx = numpy.empty_like(rx_counter)
+        prev_rx[1:] = rx_counter[:-1]
+        valid = ~first
+        # The first sample of each group follows the last one of the
+        # previous chunks
+        for idx in numpy.flatnonzero(first):
+            prev = state.get(int(key[idx]))
+            if prev is not None:
+                prev_tx[idx], prev_rx[idx] = prev
+                valid[idx] = True
+        for idx in numpy.flatnonzero(last):
+            state[int(key[idx])] = (int(tx_counter[idx]),
+                                    int(rx_counter[idx]))
+        sent = tx_counter - prev_tx
+        received = rx_counter - prev_rx
+        # Skip the intervals where the counters have been reset
+        valid &= (sent >= 0) & (received >= 0)
+        return (timestamp[valid], path[valid], sent[valid],
+                (sent - received)[valid])
+
+    def add_losses(self, direction, timestamps, paths, sent, lost):
+        """Accumulate the loss of a list of intervals"""
+
+        # pylint: disable=too-many-arguments
+
+        for timestamp, path, path_sent, path_lost in zip(
+                timestamps, paths, sent, lost):
+            totals = self.totals.setdefault((direction, path), [0, 0, 0])
+            totals[0] += 1
+            totals[1] += path_sent
+            totals[2] += path_lost
+            self.push_worst((path_lost, timestamp, path, direction,
+                             path_sent))
+            self.add_iperf(timestamp, path_sent, path_lost)
+
+    def add_losses_numpy(self, direction, timestamps, paths, sent, lost):
+        """Vectorized version of add_losses"""
+
+        # pylint: disable=too-many-arguments,import-outside-toplevel
+
+        import numpy
+
+        if len(paths) == 0:
+            return
+        unique_paths, inverse = numpy.unique(paths, return_inverse=True)
+        counts = numpy.bincount(inverse)
+        sent_sums = numpy.bincount(inverse, weights=sent)
+        lost_sums = numpy.bincount(inverse, weights=lost)
+        for idx, path in enumerate(unique_paths.tolist()):
+            totals = self.totals.setdefault((direction, path), [0, 0, 0])
+            totals[0] += int(counts[idx])
+            totals[1] += int(sent_sums[idx])
+            totals[2] += int(lost_sums[idx])
+        # Only the worst intervals of the chunk can enter the heap
+        if len(lost) > self.top:
+            candidates = numpy.argpartition(lost, -self.top)[-self.top:]
+        else:
+            candidates = numpy.arange(len(lost))
+        for idx in candidates.tolist():
+            self.push_worst((int(lost[idx]), float(timestamps[idx]),
+                             int(paths[idx]), direction, int(sent[idx])))
+        if self.iperf_reports:
+            reports = numpy.searchsorted(self.iperf_starts, timestamps,
+                                         side='right') - 1
+            ends = numpy.asarray([report[1]
+                                  for report in self.iperf_reports])
+            inside = (reports >= 0) & (timestamps < ends[numpy.maximum(
+                reports, 0)])
+            size = len(self.iperf_reports)
+            sent_sums = numpy.bincount(reports[inside], weights=sent[inside],
+                                       minlength=size)
+            lost_sums = numpy.bincount(reports[inside], weights=lost[inside],
+                                       minlength=size)
+            for idx in numpy.flatnonzero(sent_sums).tolist():
+                self.iperf_sent[idx] += int(sent_sums[idx])
+                self.iperf_lost[idx] += int(lost_sums[idx])
+
+    def push_worst(self, interval):
+        """Keep an interval if it is among the worst ones"""
+
+        if len(self.worst) < self.top:
+            heapq.heappush(self.worst, interval)
+        elif interval > self.worst[0]:
+            heapq.heapreplace(self.worst, interval)
+
+    def add_iperf(self, timestamp, sent, lost):
+        """Add the loss of an interval to the iperf3 report covering it"""
+
+        if not self.iperf_reports:
+            return
+        # Binary search of the last report started before the interval
+        low, high = 0, len(self.iperf_starts)
+        while low < high:
+            mid = (low + high) // 2
+            if self.iperf_starts[mid] <= timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        idx = low - 1
+        if idx >= 0 and timestamp < self.iperf_reports[idx][1]:
+            self.iperf_sent[idx] += sent
+            self.iperf_lost[idx] += lost
+
+    def traffic_correlation(self):
+        """Return the correlation between the traffic of the iperf3
+        reports and the loss ratio measured during them, and the number of
+        reports used"""
+
+        traffic = []
+        ratios = []
+        for report, sent, lost in zip(self.iperf_reports, self.iperf_sent,
+                                      self.iperf_lost):
+            if sent > 0:
+                traffic.append(report[2])
+                ratios.append(lost / sent)
+        return pearson(traffic, ratios), len(traffic)
+
+    def print_report(self, paths=None):
+        """Print the results of the analysis. 'paths' are the names of the
+        paths, if they are not identified by a measure ID"""
+
+        def path_name(path):
+            return paths[path] if paths is not None else \
+                'meas_id {path}'.format(path=path)
+
+        print('Analyzed {rows} measurements'.format(rows=self.rows))
+        print('\nLoss per path:')
+        for (direction, path), (intervals, sent, lost) in sorted(
+                self.totals.items(), key=lambda item: (item[0][1],
+                                                       item[0][0])):
+            print('  {path} {direction}: {intervals} intervals, {sent} sent, '
+                  '{lost} lost ({ratio:.4%})'.format(
+                      path=path_name(path), direction=direction,
+                      intervals=intervals, sent=sent, lost=lost,
+                      ratio=lost / sent if sent else 0))
+        print('\nWorst intervals:')
+        for lost, timestamp, path, direction, sent in sorted(
+                self.worst, reverse=True):
+            print('  {timestamp:.3f} {path} {direction}: {lost} lost of '
+                  '{sent}'.format(timestamp=timestamp, path=path_name(path),
+                                  direction=direction, lost=lost, sent=sent))
+        if self.iperf_reports:
+            correlation, num_reports = self.traffic_correlation()
+            print('\nCorrelation between traffic and loss ratio: {corr} '
+                  '({num} iperf3 reports)'.format(
+                      corr='n/a' if correlation is None
+                      else '{:.3f}'.format(correlation),
+                      num=num_reports))
+
+
+def parse_arguments():
+    """Parse options received from command-line"""
+
+    parser = ArgumentParser(
+        description='Offline analysis of the packet loss measured by the '
+        'TWAMP daemon'
+    )
+    parser.add_argument(
+        '--measlog', dest='measlog', action='store', default=None,
+        help='Directory of the measurement log written by the sender'
+    )
+    parser.add_argument(
+        '--pcap', dest='pcap', action='store', default=None,
+        help='pcap of the TWAMP responses received by the sender'
+    )
+    parser.add_argument(
+        '--iperf', dest='iperf', action='store', default=None,
+        help='Log of the iperf3 client or server of the traffic generator'
+    )
+    parser.add_argument(
+        '--iperf-start', dest='iperf_start', action='store', type=float,
+        default=None, help='Start time of iperf3 (POSIX timestamp). '
+        'Required with --iperf'
+    )
+    parser.add_argument(
+        '--top', dest='top', action='store', type=int, default=DEFAULT_TOP,
+        help='Number of worst intervals reported'
+    )
+    parser.add_argument(
+        '--chunk-rows', dest='chunk_rows', action='store', type=int,
+        default=measlog.DEFAULT_CHUNK_ROWS,
+        help='Number of measurements processed at once'
+    )
+    return parser.parse_args()
+
+
+def __main():
+    args = parse_arguments()
+    if (args.measlog is None) == (args.pcap is None):
+        print('Parameter error: either --measlog or --pcap is required')
+        sys.exit(2)
+    if args.iperf is not None and args.iperf_start is None:
+        print('Parameter error: --iperf-start is required with --iperf')
+        sys.exit(2)
+    iperf_reports = read_iperf_log(args.iperf, args.iperf_start) \
+        if args.iperf is not None else None
+    analyzer = LossAnalyzer(top=args.top, iperf_reports=iperf_reports)
+    paths = None
+    if args.measlog is not None:
+        chunks = measlog.iter_chunks(args.measlog, chunk_rows=args.chunk_rows)
+    else:
+        chunks, paths = read_pcap_chunks(args.pcap,
+                                         chunk_rows=args.chunk_rows)
+    try:
+        for chunk in chunks:
+            analyzer.add_chunk(chunk)
+    except (OSError, ValueError, struct.error) as err:
+        print('Error reading the measurement data: {err}'.format(err=err))
+        sys.exit(1)
+    analyzer.print_report(paths)
+
+
+if __name__ == '__main__':
+    __main()
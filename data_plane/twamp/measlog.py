@@ -0,0 +1,289 @@
+#!/usr/bin/python
+
+
+"""This module implements an append-only columnar log of the measurement
+data, used for the post-mortem analysis of the losses.
+
+The log is a directory of segments. Each segment is a directory holding
+one file per field, with a fixed-width little-endian value per interval,
+so every field file can be mapped as a NumPy array without any parsing
+(numpy.memmap with the dtype of the field). The files are preallocated
+and mapped in memory, so an append is a few stores in the mapped pages.
+The number of rows of a segment is written after the fields, so the
+readers never see a partially written row. When a segment is full, a new
+one is started and the oldest segments are removed, according to the
+retention options. The max age of the data is also enforced periodically
+on append, so the old segments are removed even when the log grows
+slowly."""
+
+# General imports
+import importlib.util
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+from array import array
+
+# NumPy is only used by the readers, to map the fields as arrays
+ENABLE_NUMPY = importlib.util.find_spec('numpy') is not None
+
+# Fields of a row: name, NumPy dtype and struct format
+FIELDS = (
+    # Time of the measurement (POSIX timestamp in seconds)
+    ('timestamp', '<f8', '<d'),
+    ('meas_id', '<i8', '<q'),
+    ('ssTXc', '<u8', '<Q'),
+    ('rfRXc', '<u8', '<Q'),
+    ('rfTXc', '<u8', '<Q'),
+    ('ssRXc', '<u8', '<Q'),
+    ('fwColor', 'u1', '<B'),
+    ('rvColor', 'u1', '<B'),
+)
+# Typecodes of array.array used when NumPy is not available
+ARRAY_TYPECODES = {'<f8': 'd', '<i8': 'q', '<u8': 'Q', 'u1': 'B'}
+# Version of the layout of the segments
+VERSION = 1
+# Names of the files of a segment
+SCHEMA_FILE = 'schema.json'
+ROWS_FILE = 'rows.bin'
+ROWS = struct.Struct('<Q')
+SEGMENT_PREFIX = 'segment-'
+# Default number of rows of a segment (about 50 MB per segment)
+DEFAULT_SEGMENT_ROWS = 1 << 20
+# Default number of rows of the chunks returned to the readers
+DEFAULT_CHUNK_ROWS = 1 << 16
+# Default interval (in seconds) between the checks of the max age on append
+DEFAULT_RETENTION_INTERVAL = 60
+
+
+def segment_name(index):
+    """Return the name of the directory of a segment"""
+
+    return '{prefix}{index:08d}'.format(prefix=SEGMENT_PREFIX, index=index)
+
+
+def list_segments(path):
+    """Return the paths of the segments of a log, oldest first"""
+
+    if not os.path.isdir(path):
+        return []
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if name.startswith(SEGMENT_PREFIX)]
+
+
+def read_rows(segment_path):
+    """Return the number of rows written in a segment"""
+
+    try:
+        with open(os.path.join(segment_path, ROWS_FILE), 'rb') as rows_file:
+            return ROWS.unpack(rows_file.read(ROWS.size))[0]
+    except (OSError, struct.error):
+        return 0
+
+
+def segment_end_time(segment_path):
+    """Return the timestamp of the last row of a segment, or None if the
+    segment is empty"""
+
+    rows = read_rows(segment_path)
+    if rows == 0:
+        return None
+    # The timestamp is the first field
+    name, _, fmt = FIELDS[0]
+    size = struct.calcsize(fmt)
+    with open(os.path.join(segment_path, name + '.bin'), 'rb') as field_file:
+        field_file.seek((rows - 1) * size)
+        return struct.unpack(fmt, field_file.read(size))[0]
+
+
+def open_segment(segment_path, fields=None):
+    """Return the number of rows of a segment and a dict with a read-only
+    array for each field (numpy.memmap if NumPy is available, otherwise
+    array.array)"""
+
+    # pylint: disable=import-outside-toplevel
+
+    rows = read_rows(segment_path)
+    columns = {}
+    for name, dtype, fmt in FIELDS:
+        if fields is not None and name not in fields:
+            continue
+        field_path = os.path.join(segment_path, name + '.bin')
+        if ENABLE_NUMPY:
+            import numpy
+            columns[name] = numpy.memmap(field_path, dtype=dtype, mode='r',
+                                         shape=(rows,)) \
+                if rows > 0 else numpy.zeros(0, dtype=dtype)
+        else:
+            column = array(ARRAY_TYPECODES[dtype])
+            with open(field_path, 'rb') as field_file:
+                column.frombytes(
+                    field_file.read(rows * struct.calcsize(fmt)))
+            columns[name] = column
+    return rows, columns
+
+
+def iter_chunks(path, fields=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Iterate over the rows of a log, oldest first, in chunks of at most
+    chunk_rows rows. Each chunk is a dict with an array for each field"""
+
+    for segment_path in list_segments(path):
+        rows, columns = open_segment(segment_path, fields)
+        for start in range(0, rows, chunk_rows):
+            yield {name: column[start:start + chunk_rows]
+                   for name, column in columns.items()}
+
+
+class LogSegment():
+    """A segment of the log open for writing"""
+
+    def __init__(self, path, capacity):
+        self.path = path
+        if os.path.isdir(path):
+            with open(os.path.join(path, SCHEMA_FILE)) as schema_file:
+                capacity = json.load(schema_file)['capacity']
+        else:
+            os.makedirs(path)
+            with open(os.path.join(path, SCHEMA_FILE), 'w') as schema_file:
+                json.dump({'version': VERSION, 'capacity': capacity,
+                           'fields': [[name, dtype]
+                                      for name, dtype, _ in FIELDS]},
+                          schema_file)
+        self.capacity = capacity
+        # Mapped file and struct of each field
+        self.columns = []
+        for name, _, fmt in FIELDS:
+            packer = struct.Struct(fmt)
+            self.columns.append((self.map_file(name + '.bin',
+                                               capacity * packer.size),
+                                 packer))
+        self.rows_mem = self.map_file(ROWS_FILE, ROWS.size)
+        self.rows = ROWS.unpack_from(self.rows_mem)[0]
+
+    def map_file(self, name, size):
+        """Map a file of the segment, creating it if needed"""
+
+        fd = os.open(os.path.join(self.path, name), os.O_RDWR | os.O_CREAT,
+                     0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            return mmap.mmap(fd, size)
+        finally:
+            # The mapping keeps the file open
+            os.close(fd)
+
+    @property
+    def full(self):
+        """True if no more rows can be added"""
+
+        return self.rows >= self.capacity
+
+    def append(self, values):
+        """Append a row, given as a sequence of values in the order of
+        FIELDS"""
+
+        row = self.rows
+        for (mem, packer), value in zip(self.columns, values):
+            packer.pack_into(mem, row * packer.size, value)
+        # Commit the row
+        self.rows = row + 1
+        ROWS.pack_into(self.rows_mem, 0, self.rows)
+
+    def flush(self):
+        """Write the segment to the disk"""
+
+        for mem, _ in self.columns:
+            mem.flush()
+        self.rows_mem.flush()
+
+    def close(self):
+        """Flush and unmap the segment"""
+
+        self.flush()
+        for mem, _ in self.columns:
+            mem.close()
+        self.rows_mem.close()
+
+
+class MeasurementLog():
+    """An append-only log of the measurement data of a sender. Each log
+    must be written by a single sender. 'max_segments' is the max number
+    of segments kept and 'max_age' (in seconds) the max age of the data
+    kept. If they are None, the segments are never removed. The max age
+    is checked on rotation and on append, at most once every
+    'retention_interval' seconds"""
+
+    def __init__(self, path, segment_rows=DEFAULT_SEGMENT_ROWS,
+                 max_segments=None, max_age=None,
+                 retention_interval=DEFAULT_RETENTION_INTERVAL):
+        self.path = path
+        self.segment_rows = segment_rows
+        self.max_segments = max_segments
+        self.max_age = max_age
+        self.retention_interval = retention_interval
+        # Time (time.monotonic) of the next check of the max age on append
+        self.next_retention = 0
+        os.makedirs(path, exist_ok=True)
+        segments = list_segments(path)
+        # Resume the last segment
+        self.index = int(os.path.basename(segments[-1])[
+            len(SEGMENT_PREFIX):]) if segments else 0
+        self.segment = LogSegment(
+            os.path.join(path, segment_name(self.index)), segment_rows)
+        self.apply_retention()
+
+    def append(self, timestamp, meas_id, meas):
+        """Append the measurement data of an interval"""
+
+        if self.segment.full:
+            self.rotate()
+        elif self.max_age is not None \
+                and time.monotonic() >= self.next_retention:
+            # A slow log may not rotate for a long time
+            self.apply_retention()
+        self.segment.append((timestamp, meas_id, meas['ssTXc'],
+                             meas['rfRXc'], meas['rfTXc'], meas['ssRXc'],
+                             meas['fwColor'], meas['rvColor']))
+
+    def rotate(self):
+        """Close the current segment and start a new one"""
+
+        self.segment.close()
+        self.index += 1
+        self.segment = LogSegment(
+            os.path.join(self.path, segment_name(self.index)),
+            self.segment_rows)
+        self.apply_retention()
+
+    def apply_retention(self):
+        """Remove the oldest segments, according to the retention options.
+        The current segment is never removed"""
+
+        self.next_retention = time.monotonic() + self.retention_interval
+        segments = list_segments(self.path)[:-1]
+        if self.max_segments is not None:
+            excess = len(segments) + 1 - self.max_segments
+            for segment_path in segments[:max(excess, 0)]:
+                shutil.rmtree(segment_path)
+            segments = segments[max(excess, 0):]
+        if self.max_age is not None:
+            oldest = time.time() - self.max_age
+            for segment_path in segments:
+                end_time = segment_end_time(segment_path)
+                if end_time is not None and end_time >= oldest:
+                    # The next segments are newer
+                    break
+                shutil.rmtree(segment_path)
+
+    def flush(self):
+        """Write the current segment to the disk"""
+
+        self.segment.flush()
+
+    def close(self):
+        """Flush and close the log"""
+
+        self.segment.close()
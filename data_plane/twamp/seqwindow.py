@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+
+"""This module tracks the TWAMP queries of the sessions of a sender that
+are still waiting for a response.
+
+A lost query or response used to leave the last measurement of the path
+stale until the next interval, without the sender noticing. Each session
+now has a window of the last WINDOW_SIZE sequence numbers sent, stored as
+bitmaps in the columns of the table of the sessions (see sessions), so
+the window costs a few words per session:
+
+- 'seqBase' is the sequence number of the first bit of the window;
+- 'pendingBits' marks the queries waiting for a response;
+- 'expiredBits' marks the queries whose timeout expired without a
+  response;
+- 'retxBits' marks the queries retransmitted at least once.
+
+The window slides forward when a query is sent beyond its end, and the
+queries still pending that fall out of the window are reported as lost.
+A response is classified as the answer to a pending query, a late answer
+(to a query already expired or out of the window), a duplicate (a
+second answer to a query, e.g. the answer to its retransmission) or an
+unknown answer (to a query never sent, e.g. a response in flight
+before a restart or a forged one)."""
+
+# Number of sequence numbers of the window of a session. The bitmaps are
+# stored in unsigned 64 bit columns
+WINDOW_SIZE = 64
+WINDOW_MASK = (1 << WINDOW_SIZE) - 1
+
+# Columns of the table of the sessions storing the windows
+FIELDS = ('seqBase', 'pendingBits', 'expiredBits', 'retxBits')
+# Columns of the table of the sessions counting the queries lost and
+# retransmitted and the late, duplicate and unknown responses
+STATS = ('lostQueries', 'retransmissions', 'lateResponses',
+         'duplicateResponses', 'unknownResponses')
+
+# Classification of the responses
+ACK = 0         # answer to a pending query
+ACK_RETX = 1        # answer to a pending query retransmitted
+LATE = 2        # answer to a query expired or out of the window
+DUPLICATE = 3       # answer to a query already answered
+UNKNOWN = 4     # answer to a query never sent in the window
+
+
+def count_bits(bits):
+    """Return the number of bits set"""
+
+    return bin(bits).count('1')
+
+
+class SequenceWindows():
+    """The windows of the outstanding queries of the sessions of a table,
+    indexed by the id of the session. The table must have the columns
+    FIELDS"""
+
+    def __init__(self, table):
+        self.base = table.counters['seqBase']
+        self.pending = table.counters['pendingBits']
+        self.expired = table.counters['expiredBits']
+        self.retx = table.counters['retxBits']
+
+    def sent(self, index, seq_num, retransmission=False):
+        """Mark a query as pending. Return the number of pending queries
+        which fell out of the window, i.e. lost"""
+
+        lost = 0
+        offset = seq_num - self.base[index]
+        if offset < 0:
+            # Older than the window, cannot be tracked
+            return lost
+        if offset >= WINDOW_SIZE:
+            # Slide the window so that the query is its last bit
+            shift = offset - WINDOW_SIZE + 1
+            if shift >= WINDOW_SIZE:
+                lost = count_bits(self.pending[index])
+                self.pending[index] = 0
+                self.expired[index] = 0
+                self.retx[index] = 0
+            else:
+                lost = count_bits(self.pending[index] & ((1 << shift) - 1))
+                self.pending[index] >>= shift
+                self.expired[index] >>= shift
+                self.retx[index] >>= shift
+            self.base[index] += shift
+            offset = WINDOW_SIZE - 1
+        bit = 1 << offset
+        self.pending[index] |= bit
+        self.expired[index] &= ~bit & WINDOW_MASK
+        if retransmission:
+            self.retx[index] |= bit
+        return lost
+
+    def is_pending(self, index, seq_num):
+        """Return True if a query is waiting for a response"""
+
+        offset = seq_num - self.base[index]
+        return 0 <= offset < WINDOW_SIZE and \
+            self.pending[index] & (1 << offset) != 0
+
+    def expire(self, index, seq_num):
+        """Mark a pending query as expired. Return False if the query was
+        not pending"""
+
+        if not self.is_pending(index, seq_num):
+            return False
+        bit = 1 << (seq_num - self.base[index])
+        self.pending[index] &= ~bit & WINDOW_MASK
+        self.expired[index] |= bit
+        return True
+
+    def acknowledge(self, index, seq_num, next_seq_num):
+        """Classify a response to a query and update the window, given the
+        sequence number of the next query of the session. Return ACK,
+        ACK_RETX, LATE, DUPLICATE or UNKNOWN"""
+
+        offset = seq_num - self.base[index]
+        if seq_num >= next_seq_num or offset >= WINDOW_SIZE:
+            return UNKNOWN
+        if offset < 0:
+            return LATE
+        bit = 1 << offset
+        if self.pending[index] & bit:
+            self.pending[index] &= ~bit & WINDOW_MASK
+            return ACK_RETX if self.retx[index] & bit else ACK
+        if self.expired[index] & bit:
+            # Answered after the timeout, further answers are duplicates
+            self.expired[index] &= ~bit & WINDOW_MASK
+            return LATE
+        return DUPLICATE
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+
+"""This module implements the compact state of the monitored paths.
+
+The state of a path used to be a dict holding its own copies of the SID
+list, of the return SID list and of their reversed versions. With many
+paths, the memory per path limits the number of paths a node can
+monitor, so the state is now a record with __slots__ and:
+
+- the SID lists are tuples of interned SIDs (the SIDs of the nodes are
+  repeated in many SID lists) and the reversed SID lists are derived when
+  the packets are built, instead of being stored;
+- the sequence numbers and the windows of the outstanding queries (see
+  seqwindow) are stored in typed arrays of the table, indexed by the
+  dense id of the session;
+- the buffers of the measurement data and the RTT histogram are
+  allocated by the first response.
+
+The records support the item access of the old dicts (e.g.
+monitored_path['sidlist']), so the sessions handle them as before."""
+
+# General imports
+import sys
+from array import array
+
+# Data-plane dependencies
+from data_plane.twamp import seqwindow
+
+# Type of the counters of the sessions (unsigned 64 bit)
+COUNTER_TYPE = 'Q'
+
+
+def intern_sid_list(sid_list):
+    """Return a SID list as a tuple of interned SIDs, so the SIDs repeated
+    in many SID lists are stored once"""
+
+    return tuple(sys.intern(sid) for sid in sid_list)
+
+
+class SessionTable():
+    """The sessions of a sender or of a reflector, indexed by a dense id.
+    The ids of the removed sessions are reused"""
+
+    def __init__(self, counters=()):
+        # Id -> session, None for the free ids
+        self.records = []
+        self.free = []
+        # Name -> array of the values of the sessions, indexed by id
+        self.counters = {name: array(COUNTER_TYPE) for name in counters}
+
+    def __len__(self):
+        return len(self.records) - len(self.free)
+
+    def __iter__(self):
+        return (record for record in self.records if record is not None)
+
+    def get(self, index):
+        """Return the session with an id, or None"""
+
+        if 0 <= index < len(self.records):
+            return self.records[index]
+        return None
+
+    def add(self, record):
+        """Assign an id to a session and return it"""
+
+        if self.free:
+            index = self.free.pop()
+            self.records[index] = record
+        else:
+            index = len(self.records)
+            self.records.append(record)
+            for counter in self.counters.values():
+                counter.append(0)
+        return index
+
+    def remove(self, record):
+        """Remove a session, its id can be reused"""
+
+        if self.records[record.index] is not record:
+            return
+        self.records[record.index] = None
+        self.free.append(record.index)
+        for counter in self.counters.values():
+            counter[record.index] = 0
+
+
+class Session():
+    """The state of a path, stored in a table. The fields are read and
+    written as items, as in a dict"""
+
+    # pylint: disable=invalid-name
+
+    __slots__ = ('table', 'index', 'sidlist', 'returnsidlist',
+                 'checkpointSlot')
+
+    # Fields derived from the other ones and fields stored in the
+    # counters of the table
+    DERIVED = ('sidlistrev', 'returnsidlistrev', 'sidlistgrpc')
+    COUNTERS = ()
+
+    def __init__(self, table, sid_list, rev_sid_list):
+        self.table = table
+        self.sidlist = intern_sid_list(sid_list)
+        self.returnsidlist = intern_sid_list(rev_sid_list)
+        self.checkpointSlot = None
+        self.index = table.add(self)
+
+    @property
+    def sidlistrev(self):
+        """The SID list, reversed"""
+
+        return self.sidlist[::-1]
+
+    @property
+    def returnsidlistrev(self):
+        """The return SID list, reversed"""
+
+        return self.returnsidlist[::-1]
+
+    def __getitem__(self, name):
+        counter = self.table.counters.get(name)
+        if counter is not None:
+            return counter[self.index]
+        if name == 'sidlistgrpc':
+            # SID list in the format of the gRPC requests
+            return '/'.join(self.sidlist)
+        if name in ('table', 'index'):
+            raise KeyError(name)
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
+        counter = self.table.counters.get(name)
+        if counter is not None:
+            counter[self.index] = value
+            return
+        if name in ('table', 'index'):
+            raise KeyError(name)
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def get(self, name, default=None):
+        """Return a field, or 'default' if it is not set"""
+
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def as_dict(self):
+        """Return the fields that are set as a dict"""
+
+        fields = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()) + \
+                    getattr(cls, 'DERIVED', ()) + getattr(cls, 'COUNTERS', ()):
+                if name not in ('table', 'index') and name not in fields:
+                    value = self.get(name)
+                    if value is not None:
+                        fields[name] = value
+        return fields
+
+    def __repr__(self):
+        return '{cls}({fields})'.format(cls=type(self).__name__,
+                                        fields=self.as_dict())
+
+
+class SenderSession(Session):
+    """The state of a path measured by a sender"""
+
+    # pylint: disable=invalid-name,too-many-instance-attributes
+
+    __slots__ = ('key', 'meas_id', 'interval', 'intervalRatio', 'margin',
+                 'measBuffers', 'measIndex', 'lastMeas', 'rttHistogram',
+                 'queryTimestamp', 'slot')
+
+    COUNTERS = ('txSequenceNumber',) + seqwindow.FIELDS + seqwindow.STATS
+
+    def __init__(self, table, key, meas_id, sid_list, rev_sid_list,
+                 interval, interval_ratio, margin):
+
+        # pylint: disable=too-many-arguments
+
+        Session.__init__(self, table, sid_list, rev_sid_list)
+        self.key = key
+        self.meas_id = meas_id
+        self.interval = interval
+        self.intervalRatio = interval_ratio
+        self.margin = margin
+        # Double buffer of the measurement data and RTT histogram,
+        # allocated by the first response
+        self.measBuffers = None
+        self.measIndex = 0
+        self.lastMeas = None
+        self.rttHistogram = None
+        self['txSequenceNumber'] = 1
+        self['seqBase'] = 1
+
+
+class ReflectorSession(Session):
+    """The state of a path answered by a reflector"""
+
+    # pylint: disable=invalid-name
+
+    __slots__ = ('sender',)
+
+    COUNTERS = ('revTxSequenceNumber',)
+
+    def __init__(self, table, sid_list, rev_sid_list):
+        Session.__init__(self, table, sid_list, rev_sid_list)
+        self['revTxSequenceNumber'] = 0
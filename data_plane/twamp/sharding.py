@@ -0,0 +1,832 @@
+#!/usr/bin/python
+
+"""This module implements a sharded deployment of the TWAMP daemon.
+
+The measurement sessions are partitioned by a hash of their SID list
+across a pool of worker processes, so that the sender and reflector work
+is not serialized on a single GIL. Each worker owns its own sessions and
+its own driver, while a thin coordinator keeps the same controller API
+(start_meas/stop_meas/get_meas) exposed by SessionSender and
+SessionReflector. The last measurement of each session is published by
+the workers in a shared memory array, so the coordinator can answer to
+get_meas without any round trip to the worker processes."""
+
+# General imports
+import multiprocessing
+import queue
+import socket
+import time
+import zlib
+from threading import Lock
+
+# Scapy dependencies
+from scapy.layers.inet6 import IPv6, IPv6ExtHdrSegmentRouting
+
+# Data-plane dependencies
+from data_plane.twamp import admission, seqwindow, timestamps, utils
+from data_plane.twamp.twamp_demon import (DEFAULT_INTERVAL, DEFAULT_MARGIN,
+                                          DEFAULT_NUM_COLOR, STATUS_FULL,
+                                          STATUS_INTERNAL_ERROR, STATUS_OK,
+                                          SessionReflector, SessionSender,
+                                          TestPacketReceiver, remove_paths,
+                                          validate_paths)
+
+# Fields of the measurement data published by the workers. They are the
+# same fields stored in the 'lastMeas' dict of a monitored path. The delays
+# (in nanoseconds) and the RTT distribution are 0 if the queries do not
+# carry timestamps
+DATA_FIELDS = ('sssn', 'ssTXc', 'rfRXc', 'fwColor',
+               'rfsn', 'rfTXc', 'ssRXc', 'rvColor',
+               'rtt', 'fwDelay', 'rvDelay',
+               'rttCount', 'rttMin', 'rttMax', 'rttP50', 'rttP90', 'rttP99')
+# Fields returned by get_meas: the measurement data followed by the
+# statistics of the queries and of the responses, as in SessionSender
+MEAS_FIELDS = DATA_FIELDS + seqwindow.STATS
+# Each slot of the shared memory array contains a generation number, a
+# flag telling whether the measurement data have been published (i.e. a
+# response has been received) and the fields. The generation number is
+# odd while the worker is updating the slot and even when the slot is
+# stable
+SLOT_WORDS = 2 + len(MEAS_FIELDS)
+# Default max number of sessions handled by a coordinator
+DEFAULT_MAX_SESSIONS = 65536
+# Timeout (in seconds) of the blocking operations, used to periodically
+# check the stop event
+POLL_TIMEOUT = 1
+# Max time (in seconds) waited by a worker for a packet before checking the
+# commands of the coordinator, and by the coordinator for a reply
+CMD_POLL_TIMEOUT = 0.05
+REPLY_TIMEOUT = 30
+# Max number of attempts to read a shared memory slot being updated
+MAX_READ_RETRIES = 1000
+# Ethertype of the IPv6 packets
+ETH_P_IPV6 = 0x86DD
+
+# Roles of the workers
+ROLE_SENDER = 'sender'
+ROLE_REFLECTOR = 'reflector'
+
+
+def shard_of(sid_list, num_shards):
+    """Return the index of the shard owning a SID list. The hash must be
+    stable across processes and restarts, so we cannot use hash()"""
+
+    return zlib.crc32(sid_list.encode()) % num_shards
+
+
+def publish_meas(results, slot, meas, stats):
+    """Write the measurement data of a session, or None if there are no
+    data yet, and its statistics in its shared memory slot"""
+
+    base = slot * SLOT_WORDS
+    # Mark the slot as being updated
+    results[base] += 1
+    results[base + 1] = int(meas is not None)
+    for idx, field in enumerate(DATA_FIELDS):
+        results[base + 2 + idx] = meas.get(field, 0) \
+            if meas is not None else 0
+    for idx, field in enumerate(seqwindow.STATS, len(DATA_FIELDS)):
+        results[base + 2 + idx] = stats[field]
+    # Mark the slot as stable
+    results[base] += 1
+
+
+def read_meas(results, slot):
+    """Read the measurement data of a session from its shared memory slot.
+    Return an empty dict if no measurement has been published yet"""
+
+    base = slot * SLOT_WORDS
+    for _ in range(MAX_READ_RETRIES):
+        generation = results[base]
+        if generation % 2 == 0:
+            values = results[base + 1:base + SLOT_WORDS]
+            if results[base] == generation:
+                if generation == 0:
+                    return {}
+                if not values[0]:
+                    # No response yet, only the statistics
+                    return dict(zip(seqwindow.STATS,
+                                    values[1 + len(DATA_FIELDS):]))
+                return dict(zip(MEAS_FIELDS, values[1:]))
+        # The worker is updating the slot, let it run and retry
+        time.sleep(0)
+    # The slot stays inconsistent, e.g. the worker died while updating it
+    print('SHARDS: measurement slot {slot} not readable'.format(slot=slot))
+    return {}
+
+
+def clear_meas(results, slot):
+    """Reset a shared memory slot before assigning it to a new session"""
+
+    base = slot * SLOT_WORDS
+    for idx in range(SLOT_WORDS):
+        results[base + idx] = 0
+
+
+# ''' ***************************************** WORKERS '''
+
+
+class ShardSessionSender(SessionSender):
+    """A SessionSender running in a worker process, which publishes
+    the measurement data in the shared memory of the coordinator"""
+
+    def __init__(self, driver, results, stop_event=None, **kwargs):
+        SessionSender.__init__(self, driver, stop_event=stop_event, **kwargs)
+        self.results = results
+        # The slots are updated by the scheduler (queries and timeouts)
+        # and by the receiver (responses)
+        self.publish_lock = Lock()
+
+    def publish(self, monitored_path):
+        """Publish the measurement data and the statistics of a path"""
+
+        slot = monitored_path.get('slot')
+        if slot is None:
+            # Not started by the coordinator yet
+            return
+        with self.publish_lock:
+            publish_meas(self.results, slot, monitored_path['lastMeas'],
+                         monitored_path)
+
+    def start_meas_slot(self, slot, meas_id, sid_list, rev_sid_list,
+                        interval=None, margin=None):
+        """Start a measurement process publishing its data in a slot"""
+
+        # pylint: disable=too-many-arguments
+
+        res = self.start_meas(meas_id, sid_list, rev_sid_list,
+                              interval=interval, margin=margin)
+        if res == 1:
+            self.monitored_paths[
+                utils.sid_list_key(sid_list.split('/'))]['slot'] = slot
+        return res
+
+    def start_meas_many_slots(self, slots, paths, interval=None,
+                              margin=None):
+        """Start a batch of measurement processes, each one publishing its
+        data in the corresponding slot. The SID lists must be canonical"""
+
+        statuses = self.start_meas_many(paths, interval=interval,
+                                        margin=margin)
+        for slot, (_, sid_list, _), status in zip(slots, paths, statuses):
+            if status == STATUS_OK:
+                self.monitored_paths[sid_list]['slot'] = slot
+        return statuses
+
+    def send_twamp_test_query(self, monitored_path, block_number=None,
+                              deadline=None, seq_num=None, retries=0):
+        """Send a TWAMP query and publish the statistics of the path, e.g.
+        the retransmissions and the queries lost out of the window"""
+
+        # pylint: disable=too-many-arguments
+
+        SessionSender.send_twamp_test_query(
+            self, monitored_path, block_number, deadline, seq_num, retries)
+        self.publish(monitored_path)
+
+    def run_query_timeout(self, monitored_path, seq_num, block_number,
+                          deadline, retries):
+        """Handle the timeout of a query and publish the queries lost"""
+
+        # pylint: disable=too-many-arguments
+
+        SessionSender.run_query_timeout(self, monitored_path, seq_num,
+                                        block_number, deadline, retries)
+        self.publish(monitored_path)
+
+    def recv_twamp_response(self, packet):
+        """Handle a TWAMP response and publish the measurement data and the
+        statistics of its path, also if the response is discarded"""
+
+        updated_path = SessionSender.recv_twamp_response(self, packet)
+        monitored_path = updated_path if updated_path is not None \
+            else self.get_return_path(
+                packet[IPv6ExtHdrSegmentRouting].addresses)
+        if monitored_path is not None:
+            self.publish(monitored_path)
+        return updated_path
+
+
+class ShardError(Exception):
+    """A worker failed to execute a command or did not reply"""
+
+
+def execute_command(role, session, cmd, args):
+    """Execute a command of the coordinator in a worker and return the
+    result"""
+
+    # pylint: disable=too-many-return-statements
+
+    if cmd == 'start':
+        if role == ROLE_SENDER:
+            return session.start_meas_slot(*args)
+        return session.start_meas(*args)
+    if cmd == 'stop':
+        return session.stop_meas(*args)
+    if cmd == 'start_many':
+        if role == ROLE_SENDER:
+            return session.start_meas_many_slots(*args)
+        return session.start_meas_many(*args)
+    if cmd == 'stop_many':
+        return session.stop_meas_many(*args)
+    if cmd == 'hist':
+        return session.get_delay_histogram(*args)
+    if cmd == 'admission':
+        return session.get_admission_stats()
+    if cmd == 'set_sender_path':
+        return session.set_sender_return_path(*args)
+    if cmd == 'rem_sender_path':
+        return session.rem_sender_return_path(*args)
+    raise ValueError('Unknown command {cmd}'.format(cmd=cmd))
+
+
+def execute_commands(role, session, cmd_queue, reply_queue):
+    """Execute the commands waiting in the queue, replying to each one with
+    (id, True, result) or (id, False, error). Return False when the
+    worker must quit"""
+
+    while True:
+        try:
+            cmd, cmd_id, args = cmd_queue.get_nowait()
+        except queue.Empty:
+            return True
+        if cmd == 'quit':
+            return False
+        try:
+            reply = (cmd_id, True, execute_command(role, session, cmd, args))
+        except Exception as err:        # pylint: disable=broad-except
+            # A failed command must not kill the worker and its sessions
+            print('Shard: command {cmd} failed: {err!r}'.format(cmd=cmd,
+                                                                err=err))
+            reply = (cmd_id, False, repr(err))
+        reply_queue.put(reply)
+
+
+def shard_worker(role, shard_id, driver_factory, cmd_queue, pkt_queue,
+                 reply_queue, results, stop_event, session_kwargs):
+    """Entry point of a worker process. Execute the commands received from
+    the coordinator and handle the TWAMP packets dispatched to this shard.
+    The commands have their own queue and are executed before the next
+    packet, so they never wait behind the queued packets"""
+
+    # pylint: disable=too-many-arguments
+
+    # Each worker opens its own driver. The active color is shared by all
+    # the eBPF flows and every worker with running sessions sets it, but
+    # the color is derived from the clock, so they all set the same one
+    driver = driver_factory()
+    if role == ROLE_SENDER:
+        session = ShardSessionSender(driver, results, stop_event=stop_event,
+                                     **session_kwargs)
+        receiver = TestPacketReceiver(None, session, None)
+    else:
+        session = SessionReflector(driver, stop_event=stop_event,
+                                   **session_kwargs)
+        receiver = TestPacketReceiver(None, None, session)
+    session.daemon = True
+    session.start()
+    print('Shard {role} {shard} started'.format(role=role, shard=shard_id))
+    while not stop_event.is_set():
+        if not execute_commands(role, session, cmd_queue, reply_queue):
+            break
+        try:
+            data, rx_timestamp = pkt_queue.get(timeout=CMD_POLL_TIMEOUT)
+        except queue.Empty:
+            continue
+        try:
+            packet = IPv6(data)
+            if rx_timestamp is not None:
+                # Kernel timestamp of the reception
+                packet.time = rx_timestamp
+            receiver.packet_recv_callback(packet)
+        except Exception as err:        # pylint: disable=broad-except
+            # A malformed packet must not kill the worker and its sessions
+            print('Shard {role} {shard}: error handling a packet: {err!r}'
+                  .format(role=role, shard=shard_id, err=err))
+    driver.stop()
+    print('Shard {role} {shard} stopped'.format(role=role, shard=shard_id))
+
+
+# ''' ***************************************** COORDINATORS '''
+
+
+class ShardCoordinator():
+    """Base class for a coordinator of a pool of worker processes.
+
+    The driver_factory is called in each worker to create its driver and
+    must be picklable, e.g. functools.partial(EbpfInterf, in_interfaces,
+    out_interfaces, load_programs=False). The eBPF programs are expected
+    to be loaded once by a driver created in the coordinator process"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, role, driver_factory, num_shards=None,
+                 max_sessions=DEFAULT_MAX_SESSIONS, session_kwargs=None):
+
+        # pylint: disable=too-many-arguments
+
+        if num_shards is None:
+            num_shards = multiprocessing.cpu_count()
+        self.role = role
+        self.driver_factory = driver_factory
+        self.num_shards = num_shards
+        self.max_sessions = max_sessions
+        # Extra arguments for the sessions created in the workers
+        self.session_kwargs = session_kwargs \
+            if session_kwargs is not None else {}
+        # Shared memory containing the last measurement of each session.
+        # The one-way delays can be negative if the clocks are not in sync
+        self.results = multiprocessing.RawArray(
+            'q', max_sessions * SLOT_WORDS)
+        self.stop_event = multiprocessing.Event()
+        # Queues of the commands and of their replies, and queues of the
+        # packets, by shard
+        self.cmd_queues = []
+        self.reply_queues = []
+        self.pkt_queues = []
+        # Id of the last command, used to discard the replies arrived
+        # after their timeout
+        self.cmd_id = 0
+        self.workers = []
+        # Running sessions, indexed by the key of their SID list
+        self.sessions = {}
+        # Shard owning each session, indexed by the key of the SID list
+        # carried by the TWAMP packets received for the session
+        self.routes = {}
+        self.free_slots = list(range(max_sessions - 1, -1, -1))
+        # Commands are serialized, each one waits for the worker reply
+        self.lock = Lock()
+
+    def start(self):
+        """Start the worker processes"""
+
+        for shard_id in range(self.num_shards):
+            cmd_queue = multiprocessing.Queue()
+            pkt_queue = multiprocessing.Queue()
+            reply_queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(
+                target=shard_worker,
+                args=(self.role, shard_id, self.driver_factory, cmd_queue,
+                      pkt_queue, reply_queue, self.results, self.stop_event,
+                      self.session_kwargs),
+                name='shard-{role}-{shard}'.format(role=self.role,
+                                                   shard=shard_id))
+            worker.daemon = True
+            worker.start()
+            self.cmd_queues.append(cmd_queue)
+            self.pkt_queues.append(pkt_queue)
+            self.reply_queues.append(reply_queue)
+            self.workers.append(worker)
+
+    def stop(self):
+        """Stop the worker processes"""
+
+        self.stop_event.set()
+        for cmd_queue in self.cmd_queues:
+            cmd_queue.put(('quit', None, ()))
+
+    def join(self):
+        """Wait for the worker processes to terminate"""
+
+        for worker in self.workers:
+            worker.join()
+
+    def send_command(self, shard, cmd, args):
+        """Send a command to a worker and return its id"""
+
+        self.cmd_id += 1
+        self.cmd_queues[shard].put((cmd, self.cmd_id, args))
+        return self.cmd_id
+
+    def get_reply(self, shard, cmd_id):
+        """Wait for the reply of a worker to a command and return the
+        result. Raise ShardError if the command failed, if the worker died
+        or if it did not reply within REPLY_TIMEOUT seconds"""
+
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while True:
+            timeout = min(POLL_TIMEOUT, deadline - time.monotonic())
+            if timeout <= 0:
+                raise ShardError('shard {shard} did not reply'.format(
+                    shard=shard))
+            try:
+                reply_id, success, result = self.reply_queues[shard].get(
+                    timeout=timeout)
+            except queue.Empty:
+                if not self.workers[shard].is_alive():
+                    raise ShardError('shard {shard} is not running'.format(
+                        shard=shard)) from None
+                continue
+            if reply_id != cmd_id:
+                # Reply to a command which timed out
+                continue
+            if not success:
+                raise ShardError('shard {shard}: {err}'.format(
+                    shard=shard, err=result))
+            return result
+
+    def execute(self, shard, cmd, args):
+        """Send a command to a worker and wait for its reply. Raise
+        ShardError if the worker failed"""
+
+        return self.get_reply(shard, self.send_command(shard, cmd, args))
+
+    def broadcast(self, cmd, args):
+        """Send a command to all the workers and return their replies,
+        None for the workers which failed"""
+
+        return list(self.execute_many(
+            cmd, {shard: args for shard in range(self.num_shards)}).values())
+
+    def dispatch(self, key, data, rx_timestamp=None):
+        """Hand a raw TWAMP packet to the shard owning the session.
+        Return False if the packet does not belong to any session"""
+
+        shard = self.routes.get(key)
+        if shard is None:
+            return False
+        self.pkt_queues[shard].put((data, rx_timestamp))
+        return True
+
+    def execute_many(self, cmd, shard_args):
+        """Send a command to several workers and return their replies. The
+        arguments of each worker are indexed by shard. The workers execute
+        the command in parallel. The reply of a worker which failed is
+        None"""
+
+        cmd_ids = {shard: self.send_command(shard, cmd, args)
+                   for shard, args in shard_args.items()}
+        replies = {}
+        for shard, cmd_id in cmd_ids.items():
+            try:
+                replies[shard] = self.get_reply(shard, cmd_id)
+            except ShardError as err:
+                print('SHARDS: {cmd} failed: {err}'.format(cmd=cmd, err=err))
+                replies[shard] = None
+        return replies
+
+    def remove_session(self, key):
+        """Remove a session and its route and free its slot. Return the
+        session or None if it is not running. Called with the lock held"""
+
+        session = self.sessions.pop(key, None)
+        if session is None:
+            return None
+        # The packets of a sender session travel on the return SID list,
+        # the ones of a reflector session on the SID list
+        self.routes.pop(session.get('return_key', key), None)
+        if 'slot' in session:
+            self.free_slots.append(session['slot'])
+        return session
+
+    def stop_meas_many(self, sid_lists):
+        """Stop a batch of measurement processes, with a single command for
+        each shard. Return the list of the status codes of the SID lists"""
+
+        # Stopped sessions and their index in the request, by shard
+        batches = {}
+        with self.lock:
+            statuses, removed = remove_paths(sid_lists, self.remove_session)
+            for index, key, session in removed:
+                batches.setdefault(session['shard'], []).append(
+                    (index, key))
+            replies = self.execute_many(
+                'stop_many', {shard: ([key for _, key in batch],)
+                              for shard, batch in batches.items()})
+        for shard, batch in batches.items():
+            shard_statuses = replies[shard] \
+                if replies[shard] is not None \
+                else [STATUS_INTERNAL_ERROR] * len(batch)
+            for (index, _), status in zip(batch, shard_statuses):
+                statuses[index] = status
+        return statuses
+
+
+class ShardedSessionSender(ShardCoordinator):
+    """A coordinator exposing the SessionSender interface for the controller
+    and partitioning the sessions across a pool of worker processes"""
+
+    def __init__(self, driver_factory, num_shards=None,
+                 max_sessions=DEFAULT_MAX_SESSIONS, **kwargs):
+        # The extra arguments (e.g. the color options) are passed to the
+        # SessionSender of each worker
+        ShardCoordinator.__init__(self, ROLE_SENDER, driver_factory,
+                                  num_shards=num_shards,
+                                  max_sessions=max_sessions,
+                                  session_kwargs=kwargs)
+
+    def start_meas(self, meas_id, sid_list, rev_sid_list, interval=None,
+                   margin=None):
+        """Start a measurement process"""
+
+        # pylint: disable=too-many-arguments
+
+        key = utils.sid_list_key(sid_list.split('/'))
+        with self.lock:
+            if key in self.sessions:
+                return -1  # already started
+            if len(self.free_slots) == 0:
+                print('SHARDED SENDER: no free slot for ' + sid_list)
+                return -1
+            shard = shard_of(key, self.num_shards)
+            slot = self.free_slots.pop()
+            clear_meas(self.results, slot)
+            try:
+                res = self.execute(shard, 'start',
+                                   (slot, meas_id, sid_list, rev_sid_list,
+                                    interval, margin))
+            except ShardError as err:
+                print('SHARDED SENDER: start failed: {err}'.format(err=err))
+                res = -1
+            if res != 1:
+                self.free_slots.append(slot)
+                return res
+            return_key = utils.sid_list_key(rev_sid_list.split('/'))
+            self.sessions[key] = {'meas_id': meas_id, 'shard': shard,
+                                  'slot': slot, 'return_key': return_key}
+            # The responses travel on the return SID list
+            self.routes[return_key] = shard
+            return res
+
+    def start_meas_many(self, paths, interval=None, margin=None):
+        """Start a batch of measurement processes, with a single command
+        for each shard. 'paths' is a list of (meas_id, SID list, return SID
+        list) tuples. Return the list of the status codes of the paths"""
+
+        with self.lock:
+            statuses, valid = validate_paths(
+                [(sid_list, rev_sid_list)
+                 for _, sid_list, rev_sid_list in paths], self.sessions)
+            # Paths of each shard, with their index in the request
+            batches = {}
+            for index, key, sid_list, rev_sid_list in valid:
+                if len(self.free_slots) == 0:
+                    statuses[index] = STATUS_FULL
+                    continue
+                slot = self.free_slots.pop()
+                clear_meas(self.results, slot)
+                batches.setdefault(shard_of(key, self.num_shards), []).append(
+                    (index, slot, (paths[index][0], key,
+                                   '/'.join(rev_sid_list))))
+            replies = self.execute_many(
+                'start_many', {shard: ([slot for _, slot, _ in batch],
+                                       [path for _, _, path in batch],
+                                       interval, margin)
+                               for shard, batch in batches.items()})
+            for shard, batch in batches.items():
+                shard_statuses = replies[shard] \
+                    if replies[shard] is not None \
+                    else [STATUS_INTERNAL_ERROR] * len(batch)
+                for (index, slot, path), status in zip(batch,
+                                                       shard_statuses):
+                    statuses[index] = status
+                    if status != STATUS_OK:
+                        self.free_slots.append(slot)
+                        continue
+                    meas_id, key, rev_sid_list = path
+                    self.sessions[key] = {'meas_id': meas_id,
+                                          'shard': shard, 'slot': slot,
+                                          'return_key': rev_sid_list}
+                    self.routes[rev_sid_list] = shard
+        return statuses
+
+    def stop_meas(self, sid_list):
+        """Stop a measurement process"""
+
+        key = utils.sid_list_key(sid_list.split('/'))
+        with self.lock:
+            session = self.sessions.pop(key, None)
+            if session is None:
+                return -1  # not started
+            self.routes.pop(session['return_key'], None)
+            self.free_slots.append(session['slot'])
+            try:
+                return self.execute(session['shard'], 'stop', (sid_list,))
+            except ShardError as err:
+                print('SHARDED SENDER: stop failed: {err}'.format(err=err))
+                return -1
+
+    def get_meas(self, sid_list):
+        """Return the collected measurement data for a running process.
+        Raise KeyError if there is no process running on the SID list"""
+
+        session = self.sessions[utils.sid_list_key(sid_list.split('/'))]
+        meas = read_meas(self.results, session['slot'])
+        for field in seqwindow.STATS:
+            meas.setdefault(field, 0)
+        return meas, session['meas_id']
+
+    def get_delay_histogram(self, sid_list=None):
+        """Return the RTT histogram of a running process, or the histogram
+        of all the running processes merged across the shards if sid_list
+        is None"""
+
+        with self.lock:
+            if sid_list is not None:
+                session = self.sessions[
+                    utils.sid_list_key(sid_list.split('/'))]
+                return self.execute(session['shard'], 'hist', (sid_list,))
+            histograms = self.broadcast('hist', ())
+        # The shards which failed are missing from the histogram
+        histograms = [shard_histogram for shard_histogram in histograms
+                      if shard_histogram is not None]
+        if not histograms:
+            raise ShardError('no shard replied')
+        rtt_histogram = histograms[0]
+        for shard_histogram in histograms[1:]:
+            rtt_histogram.merge(shard_histogram)
+        return rtt_histogram
+
+
+class ShardedSessionReflector(ShardCoordinator):
+    """A coordinator exposing the SessionReflector interface for the
+    controller and partitioning the sessions across a pool of worker
+    processes"""
+
+    def __init__(self, driver_factory, num_shards=None,
+                 max_sessions=DEFAULT_MAX_SESSIONS,
+                 global_rate=admission.DEFAULT_GLOBAL_RATE,
+                 global_burst=admission.DEFAULT_GLOBAL_BURST, **kwargs):
+
+        # pylint: disable=too-many-arguments
+
+        # The extra arguments (e.g. stateless) are passed to the
+        # SessionReflector of each worker
+        ShardCoordinator.__init__(self, ROLE_REFLECTOR, driver_factory,
+                                  num_shards=num_shards,
+                                  max_sessions=max_sessions,
+                                  session_kwargs=kwargs)
+        self.stateless = kwargs.get('stateless', False)
+        # Each worker has its own admission control. The senders are
+        # sharded with their sessions, while the global rate and burst
+        # of the queries are split across the workers
+        if 'admission_control' not in self.session_kwargs:
+            self.session_kwargs['admission_control'] = \
+                admission.AdmissionControl(
+                    global_rate=global_rate / self.num_shards
+                    if global_rate is not None else None,
+                    global_burst=max(1, global_burst // self.num_shards))
+
+    def dispatch(self, key, data, rx_timestamp=None):
+        """Hand a raw TWAMP query to the shard owning the session. In
+        stateless mode, the queries received on unknown SID lists are
+        handed to the shard selected by the hash of the SID list"""
+
+        if ShardCoordinator.dispatch(self, key, data, rx_timestamp):
+            return True
+        if not self.stateless:
+            return False
+        self.pkt_queues[shard_of(key, self.num_shards)].put(
+            (data, rx_timestamp))
+        return True
+
+    def set_sender_return_path(self, sender, rev_sid_list):
+        """Set the return SID list used to answer the queries received
+        from a sender. Any shard can receive the queries of a sender"""
+
+        with self.lock:
+            replies = self.broadcast('set_sender_path',
+                                     (sender, rev_sid_list))
+        return -1 if None in replies else min(replies)
+
+    def rem_sender_return_path(self, sender):
+        """Remove the return SID list configured for a sender"""
+
+        with self.lock:
+            replies = self.broadcast('rem_sender_path', (sender,))
+        return -1 if None in replies else min(replies)
+
+    def start_meas(self, sid_list, rev_sid_list, interval=DEFAULT_INTERVAL,
+                   margin=DEFAULT_MARGIN, num_color=DEFAULT_NUM_COLOR):
+        """Start a measurement process"""
+
+        # pylint: disable=too-many-arguments
+
+        key = utils.sid_list_key(sid_list.split('/'))
+        with self.lock:
+            if key in self.sessions:
+                return -1  # already started
+            shard = shard_of(key, self.num_shards)
+            try:
+                res = self.execute(shard, 'start',
+                                   (sid_list, rev_sid_list, interval, margin,
+                                    num_color))
+            except ShardError as err:
+                print('SHARDED REFLECTOR: start failed: {err}'.format(
+                    err=err))
+                return -1
+            if res != 0:
+                return res
+            self.sessions[key] = {'shard': shard}
+            # The queries travel on the SID list
+            self.routes[key] = shard
+            return res
+
+    def start_meas_many(self, paths, interval=DEFAULT_INTERVAL,
+                        margin=DEFAULT_MARGIN, num_color=DEFAULT_NUM_COLOR):
+        """Start a batch of measurement processes, with a single command
+        for each shard. 'paths' is a list of (SID list, return SID list)
+        tuples. Return the list of the status codes of the paths"""
+
+        with self.lock:
+            statuses, valid = validate_paths(paths, self.sessions)
+            batches = {}
+            for index, key, _, rev_sid_list in valid:
+                batches.setdefault(shard_of(key, self.num_shards), []).append(
+                    (index, (key, '/'.join(rev_sid_list))))
+            replies = self.execute_many(
+                'start_many', {shard: ([path for _, path in batch],
+                                       interval, margin, num_color)
+                               for shard, batch in batches.items()})
+            for shard, batch in batches.items():
+                shard_statuses = replies[shard] \
+                    if replies[shard] is not None \
+                    else [STATUS_INTERNAL_ERROR] * len(batch)
+                for (index, path), status in zip(batch, shard_statuses):
+                    statuses[index] = status
+                    if status == STATUS_OK:
+                        self.sessions[path[0]] = {'shard': shard}
+                        self.routes[path[0]] = shard
+        return statuses
+
+    def stop_meas(self, sid_list):
+        """Stop a measurement process"""
+
+        key = utils.sid_list_key(sid_list.split('/'))
+        with self.lock:
+            session = self.sessions.pop(key, None)
+            if session is None:
+                return -1  # not started
+            self.routes.pop(key, None)
+            try:
+                return self.execute(session['shard'], 'stop', (sid_list,))
+            except ShardError as err:
+                print('SHARDED REFLECTOR: stop failed: {err}'.format(
+                    err=err))
+                return -1
+
+    def get_admission_stats(self):
+        """Return the counters of the admission control of the queries,
+        summed across the shards"""
+
+        with self.lock:
+            shard_stats = [stats for stats in self.broadcast('admission', ())
+                           if stats is not None]
+        if not shard_stats:
+            raise ShardError('no shard replied')
+        return {name: sum(stats[name] for stats in shard_stats)
+                for name in shard_stats[0]}
+
+
+# ''' ***************************************** RECEIVER '''
+
+
+class ShardedPacketReceiver(TestPacketReceiver):
+    """A listener for TWAMP packets which hands each packet to the worker
+    owning its session, without dissecting the packet with scapy. The
+    sender and the reflector are coordinators"""
+
+    def packet_recv_callback(self, data, rx_timestamp=None):
+        """Called when an IPv6 packet is received. Pass the packet and its
+        kernel timestamp to the coordinator owning the session"""
+
+        # pylint: disable=arguments-renamed
+
+        parsed = utils.parse_srv6_udp(data)
+        if parsed is None:
+            return
+        sid_list, dport, _ = parsed
+        if dport == self.refl_udp_port:
+            coordinator = self.session_reflector
+        elif dport == self.ss_udp_port:
+            coordinator = self.session_sender
+        else:
+            return
+        if coordinator is None:
+            return
+        # Both queries and responses carry the reversed SID list (con punt)
+        key = utils.sid_list_key(utils.rem_punt(sid_list)[::-1])
+        coordinator.dispatch(key, data, rx_timestamp)
+
+    def run(self):
+        """Start receiving TWAMP packets"""
+
+        # A datagram packet socket delivers the packets without the
+        # link-layer header, i.e. starting from the IPv6 header
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM,
+                             socket.htons(ETH_P_IPV6))
+        sock.bind((self.interface, ETH_P_IPV6))
+        sock.settimeout(POLL_TIMEOUT)
+        # The reception time of the TWAMP packets is used to measure the
+        # delay, so it is taken by the kernel
+        timestamps.enable_rx_timestamps(sock)
+        print('ShardedPacketReceiver Start receiving...')
+        while self.stop_event is None or not self.stop_event.is_set():
+            try:
+                data, rx_timestamp = timestamps.recv_with_timestamp(
+                    sock, 65535)
+            except socket.timeout:
+                continue
+            self.packet_recv_callback(data, rx_timestamp)
+        sock.close()
+        print('ShardedPacketReceiver Stop receiving')
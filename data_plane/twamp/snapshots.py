@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+
+"""This module contains the snapshots of the counters of the closed colors.
+
+After each change of color, the counters of the color just closed are
+read once for all the monitored flows, at the end of the margin (when
+the packets marked with the closed color have been counted), and stored
+in memory. The TWAMP
+queries and responses are then handled without reading the eBPF maps,
+and all the readers get the value of the counter at the same instant."""
+
+# Directions of the counters
+DIRECTION_TX = 'tx'
+DIRECTION_RX = 'rx'
+
+
+class CounterSnapshots():
+    """A class representing the snapshots of the counters, indexed by
+    color. Only the last snapshot of each color is kept"""
+
+    def __init__(self, driver):
+        self.driver = driver
+        # Color -> (number of the interval, {(direction, flow): counter})
+        self.snapshots = {}
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def take(self, num_interval, color, flows):
+        """Read the counters of a closed interval for a list of flows, i.e.
+        (direction, SID list) tuples, and store them as a new snapshot.
+        The flows of the same interval read earlier, e.g. the ones with
+        a shorter margin, are kept"""
+
+        snapshot = self.snapshots.get(color)
+        if snapshot is not None and snapshot[0] == num_interval:
+            counters = dict(snapshot[1])
+        else:
+            counters = {}
+        for direction, sid_list in flows:
+            flow = ','.join(sid_list)
+            if direction == DIRECTION_TX:
+                counters[(direction, flow)] = \
+                    self.driver.read_tx_counter(color, sid_list)
+            else:
+                counters[(direction, flow)] = \
+                    self.driver.read_rx_counter(color, sid_list)
+        # Replace the whole snapshot at once, so that the readers never
+        # see a partially updated snapshot
+        self.snapshots[color] = (num_interval, counters)
+
+    def read(self, num_interval, color, direction, sid_list):
+        """Return the counter of a flow for a closed interval. If the
+        snapshot of the interval does not contain the flow, read the
+        counter from the driver"""
+
+        snapshot = self.snapshots.get(color)
+        if snapshot is not None and snapshot[0] == num_interval:
+            counter = snapshot[1].get((direction, ','.join(sid_list)))
+            if counter is not None:
+                self.hits += 1
+                return counter
+        # The snapshot is missing or stale, e.g. because the flow has been
+        # added after the snapshot or because the query arrived before the
+        # snapshot was taken
+        self.misses += 1
+        if direction == DIRECTION_TX:
+            return self.driver.read_tx_counter(color, sid_list)
+        return self.driver.read_rx_counter(color, sid_list)
+
+    def clear(self):
+        """Remove all the snapshots"""
+
+        self.snapshots = {}
+
+
+def last_interval_of_color(num_interval, color, num_color):
+    """Return the number of the last closed interval marked with a color,
+    given the number of the current interval"""
+
+    closed_interval = num_interval - 1
+    return closed_interval - (closed_interval - color) % num_color
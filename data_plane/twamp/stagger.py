@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+
+"""This module spreads the TWAMP queries of the sessions over the interval.
+
+All the sessions used to be measured at the same instant, the change of
+color plus the margin, so with many sessions the sender, the reflectors
+and the eBPF maps took a burst of queries, responses and counter reads
+once per interval. Each session is now measured at a point of the safe
+window, which runs from the end of the margin of the session to the
+deadline (the change of color which reuses the closed color minus the
+margin, so that the response is back before its counters change). The
+sender rejects the margins leaving an empty window. The point
+is derived from a hash of the key of the session, so a session is always
+measured at the same point of the window and the sessions are spread
+uniformly over the first 'spread' fraction of the window. The instants
+are kept on a timing wheel (see data_plane.timing), driven by the
+scheduler of the sender."""
+
+# General imports
+import zlib
+
+# Data-plane dependencies
+from data_plane import timing
+
+# Default fraction of the safe window over which the queries are spread.
+# 0 sends all the queries at the end of the margin
+DEFAULT_SPREAD = 0.5
+# Default tick (in seconds) of the timing wheel
+DEFAULT_TICK = 0.01
+
+
+def stagger_offset(key, spread=DEFAULT_SPREAD):
+    """Return the offset of a session in the safe window, as a fraction
+    in [0, spread) of the window, derived from the key of the session"""
+
+    return zlib.crc32(str(key).encode()) / 2 ** 32 * spread
+
+
+class MeasurementScheduler():
+    """The measurement instants of the sessions, on a timing wheel. The
+    wheel is advanced by a single event of 'scheduler' (a sched.scheduler
+    on the clock 'now'), always armed at the earliest instant"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, scheduler, now, spread=DEFAULT_SPREAD,
+                 tick=DEFAULT_TICK):
+        if not 0 <= spread <= 1:
+            raise ValueError('Invalid spread {spread}'.format(spread=spread))
+        self.scheduler = scheduler
+        self.now = now
+        self.spread = spread
+        self.wheel = timing.TimingWheel(tick, start=now())
+        # Event of the scheduler advancing the wheel
+        self.event = None
+        # Statistics
+        self.scheduled = 0
+        self.executed = 0
+        self.missed = 0
+        self.max_lag = 0.0
+
+    def measure_time(self, key, start, deadline):
+        """Return the instant of the measurement of a session, given the
+        start and the deadline of its safe window"""
+
+        if deadline <= start:
+            # No room to spread the measurements
+            return start
+        return start + stagger_offset(key, self.spread) * (deadline - start)
+
+    def schedule(self, instant, deadline, action, argument=()):
+        """Schedule 'action(*argument)' at 'instant'. The action is run
+        anyway if 'deadline' has passed, but counted as missed"""
+
+        self.wheel.schedule(instant, self.run_action,
+                            (instant, deadline, action, argument))
+        self.scheduled += 1
+        self.arm(instant)
+
+    def add_timer(self, instant, action, argument=()):
+        """Schedule 'action(*argument)' at 'instant', without counting it
+        as a measurement (e.g. the timeout of a query). Return the timer"""
+
+        timer = self.wheel.schedule(instant, action, argument)
+        self.arm(instant)
+        return timer
+
+    def arm(self, instant):
+        """Arm the event advancing the wheel at 'instant', unless it is
+        already armed earlier"""
+
+        if self.event is not None:
+            if self.event.time <= instant:
+                return
+            try:
+                self.scheduler.cancel(self.event)
+            except ValueError:
+                # The event is running
+                pass
+        self.event = self.scheduler.enterabs(instant, 1, self.advance)
+
+    def advance(self):
+        """Run the measurements due and arm the event at the next one"""
+
+        self.event = None
+        self.wheel.advance(self.now())
+        instant = self.wheel.next_deadline()
+        if instant is not None:
+            self.arm(instant)
+
+    def run_action(self, instant, deadline, action, argument):
+        """Run the action of a measurement"""
+
+        now = self.now()
+        self.max_lag = max(self.max_lag, now - instant)
+        if now > deadline:
+            self.missed += 1
+        self.executed += 1
+        action(*argument)
+
+    def stats(self):
+        """Return the statistics of the scheduler"""
+
+        return {
+            'pending': len(self.wheel),
+            'scheduled': self.scheduled,
+            'executed': self.executed,
+            'missed': self.missed,
+            'maxLag': self.max_lag
+        }
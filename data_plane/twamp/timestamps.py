@@ -0,0 +1,218 @@
+#!/usr/bin/python
+
+
+"""This module contains the helpers used to timestamp the TWAMP packets.
+
+The timestamps are taken by the kernel (or by the NIC) with SO_TIMESTAMPING,
+so they are not affected by the scheduling of the Python threads. They are
+carried in the TWAMP packets in the NTP format (RFC 5905), i.e. seconds
+since 1900 in the 32 most significant bits and the fraction of second in
+the 32 least significant bits."""
+
+# General imports
+import select
+import socket
+import struct
+import time
+
+# Seconds between the NTP epoch (1900) and the UNIX epoch (1970)
+NTP_EPOCH_OFFSET = 2208988800
+
+# Socket options and flags from linux/net_tstamp.h and asm/socket.h, not
+# exported by the socket module
+SO_TIMESTAMPNS = 35
+SO_TIMESTAMPING = 37
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+SCM_TIMESTAMPING = SO_TIMESTAMPING
+SOF_TIMESTAMPING_TX_HARDWARE = 1 << 0
+SOF_TIMESTAMPING_TX_SOFTWARE = 1 << 1
+SOF_TIMESTAMPING_RX_HARDWARE = 1 << 2
+SOF_TIMESTAMPING_RX_SOFTWARE = 1 << 3
+SOF_TIMESTAMPING_SOFTWARE = 1 << 4
+SOF_TIMESTAMPING_RAW_HARDWARE = 1 << 6
+SOF_TIMESTAMPING_OPT_TSONLY = 1 << 11
+
+# Timestamping modes. The hardware timestamps require the NIC to be
+# configured for timestamping (e.g. with hwstamp_ctl)
+MODE_SOFTWARE = 'software'
+MODE_HARDWARE = 'hardware'
+TIMESTAMPING_FLAGS = {
+    MODE_SOFTWARE: (SOF_TIMESTAMPING_TX_SOFTWARE |
+                    SOF_TIMESTAMPING_RX_SOFTWARE |
+                    SOF_TIMESTAMPING_SOFTWARE),
+    MODE_HARDWARE: (SOF_TIMESTAMPING_TX_HARDWARE |
+                    SOF_TIMESTAMPING_RX_HARDWARE |
+                    SOF_TIMESTAMPING_RAW_HARDWARE)
+}
+# Index of the timestamp in the scm_timestamping struct, which contains
+# the software timestamp, a deprecated one and the hardware timestamp
+TIMESTAMPING_INDEX = {
+    MODE_SOFTWARE: 0,
+    MODE_HARDWARE: 2
+}
+# A timespec struct, i.e. seconds and nanoseconds
+TIMESPEC = struct.Struct('@ll')
+# Size of the buffer for the ancillary data of the error queue, which
+# contains the timestamps and an extended error
+ANCBUF_SIZE = 512
+
+# Max time (in seconds) waited for the TX timestamp of a packet
+TX_TIMESTAMP_TIMEOUT = 0.01
+# Offset of the checksum in the UDP header
+UDP_CHECKSUM_OFFSET = 6
+# An NTP timestamp
+NTP_TIMESTAMP = struct.Struct('!Q')
+
+
+def to_ntp(timestamp):
+    """Convert a UNIX timestamp (in seconds) to the NTP format"""
+
+    return int(round((timestamp + NTP_EPOCH_OFFSET) * (1 << 32)))
+
+
+def from_ntp(ntp_timestamp):
+    """Convert a timestamp in the NTP format to a UNIX timestamp"""
+
+    return ntp_timestamp / (1 << 32) - NTP_EPOCH_OFFSET
+
+
+def ones_complement_sum(data):
+    """Return the 16 bit one's complement sum of some bytes, padded with
+    a zero byte if their length is odd"""
+
+    if len(data) % 2 == 1:
+        data = bytes(data) + b'\x00'
+    total = sum(struct.unpack('!{num}H'.format(num=len(data) // 2), data))
+    while total > 0xffff:
+        total = (total & 0xffff) + (total >> 16)
+    return total
+
+
+def stamp_packet(data, offset, udp_offset, timestamp):
+    """Write an NTP timestamp at 'offset' of a packet (a bytearray) and
+    update the checksum of the UDP header at 'udp_offset' incrementally
+    (RFC 1624), so that the timestamp can be taken just before the
+    transmission, after the packet has been built"""
+
+    # The words of the checksum are aligned to the start of the UDP header
+    start = offset - (offset - udp_offset) % 2
+    end = offset + NTP_TIMESTAMP.size
+    end += (end - udp_offset) % 2
+    old_sum = ones_complement_sum(data[start:end])
+    NTP_TIMESTAMP.pack_into(data, offset, to_ntp(timestamp))
+    new_sum = ones_complement_sum(data[start:end])
+    checksum_offset = udp_offset + UDP_CHECKSUM_OFFSET
+    checksum = struct.unpack_from('!H', data, checksum_offset)[0]
+    # HC' = ~(~HC + ~m + m')
+    checksum = ones_complement_sum(struct.pack(
+        '!3H', ~checksum & 0xffff, ~old_sum & 0xffff, new_sum))
+    checksum = ~checksum & 0xffff
+    # A zero checksum means no checksum, it is sent as all ones
+    struct.pack_into('!H', data, checksum_offset, checksum or 0xffff)
+
+
+def parse_timestamp(ancdata, mode=MODE_SOFTWARE):
+    """Extract the timestamp from the ancillary data returned by recvmsg.
+    Return None if the ancillary data do not contain any timestamp"""
+
+    for cmsg_level, cmsg_type, cmsg_data in ancdata:
+        if cmsg_level != socket.SOL_SOCKET:
+            continue
+        if cmsg_type == SCM_TIMESTAMPING:
+            offset = TIMESTAMPING_INDEX[mode] * TIMESPEC.size
+            sec, nsec = TIMESPEC.unpack_from(cmsg_data, offset)
+        elif cmsg_type == SCM_TIMESTAMPNS:
+            sec, nsec = TIMESPEC.unpack_from(cmsg_data)
+        else:
+            continue
+        if sec == 0 and nsec == 0:
+            # The timestamp has not been taken, e.g. the NIC does not
+            # support hardware timestamping
+            return None
+        return sec + nsec / 1e9
+    return None
+
+
+def enable_rx_timestamps(sock, mode=MODE_SOFTWARE):
+    """Ask the kernel to timestamp the packets received by a socket"""
+
+    sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPING,
+                    TIMESTAMPING_FLAGS[mode])
+
+
+def recv_with_timestamp(sock, bufsize, mode=MODE_SOFTWARE):
+    """Receive a packet from a socket with RX timestamps enabled. Return
+    the packet and its timestamp (None if it is not available)"""
+
+    data, ancdata, _, _ = sock.recvmsg(
+        bufsize, socket.CMSG_SPACE(3 * TIMESPEC.size))
+    return data, parse_timestamp(ancdata, mode)
+
+
+class TimestampingSocket():
+    """A raw IPv6 socket sending complete packets (IPv6 header included)
+    and returning the kernel timestamp of their transmission"""
+
+    def __init__(self, mode=MODE_SOFTWARE):
+        self.mode = mode
+        # An IPPROTO_RAW socket expects the IPv6 header in the data
+        self.sock = socket.socket(socket.AF_INET6, socket.SOCK_RAW,
+                                  socket.IPPROTO_RAW)
+        # The timestamps are returned on the error queue of the socket,
+        # without the packet (OPT_TSONLY)
+        self.sock.setsockopt(
+            socket.SOL_SOCKET, SO_TIMESTAMPING,
+            TIMESTAMPING_FLAGS[mode] | SOF_TIMESTAMPING_OPT_TSONLY)
+
+    def send(self, data, dst, stamp_offset=None, udp_offset=None):
+        """Send a packet to the next hop 'dst' and return its TX timestamp.
+        If the kernel does not return the timestamp in time, return the
+        time measured just after the transmission.
+
+        If 'stamp_offset' is given, the packet carries its own transmission
+        time at that offset (with the UDP header at 'udp_offset'). A packet
+        cannot carry the kernel timestamp of its own transmission, so the
+        time is taken just before sendto: the timestamp misses the time
+        spent in the kernel until the TX timestamp (and in the queue of the
+        NIC with hardware timestamps), usually a few microseconds, i.e.
+        the difference between the returned timestamp and the carried one.
+        """
+
+        self.drain()
+        if stamp_offset is not None:
+            data = bytearray(data)
+            stamp_packet(data, stamp_offset, udp_offset, time.time())
+        self.sock.sendto(data, (dst, 0))
+        user_timestamp = time.time()
+        deadline = user_timestamp + TX_TIMESTAMP_TIMEOUT
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return user_timestamp
+            # A pending error queue makes the socket readable
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+            if not readable:
+                return user_timestamp
+            try:
+                _, ancdata, _, _ = self.sock.recvmsg(
+                    0, ANCBUF_SIZE, socket.MSG_ERRQUEUE | socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                continue
+            timestamp = parse_timestamp(ancdata, self.mode)
+            if timestamp is not None:
+                return timestamp
+
+    def drain(self):
+        """Discard the timestamps returned too late for previous packets"""
+
+        while True:
+            try:
+                self.sock.recvmsg(0, ANCBUF_SIZE,
+                                  socket.MSG_ERRQUEUE | socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+
+    def close(self):
+        """Close the socket"""
+
+        self.sock.close()
@@ -0,0 +1,385 @@
+#!/usr/bin/python
+
+
+"""This module implements a userspace driver counting the SRv6 packets of
+each SID list and color, with the same interface of the eBPF driver
+(twamp_demon.EbpfInterf).
+
+The packets are read from a PACKET_MMAP ring (TPACKET_V3) of an AF_PACKET
+socket on each monitored interface, so they are not copied to userspace:
+the kernel fills blocks of packets in a memory area shared with the
+process, which counts all the packets of a block and gives it back. The
+driver is used on the hosts without XDP support and to cross-check the
+eBPF counters, e.g. on veth test setups.
+
+The driver cannot mark the packets. The packets received marked with a
+color in the DSCP of the outer IPv6 header (color i is marked as i + 1,
+as in the eBPF maps) are counted in that color. The other packets, and
+all the packets sent, are counted in the color active when they were
+captured, according to their kernel timestamp and the instant of the
+last change of color."""
+
+# General imports
+import mmap
+import select
+import socket
+import struct
+import time
+from threading import Event, Thread
+
+# Data-plane dependencies
+from data_plane.twamp import snapshots
+
+# Socket options and constants from linux/if_packet.h and linux/if_ether.h,
+# not exported by the socket module
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+ETH_P_ALL = 0x0003
+ETH_P_IPV6 = 0x86DD
+PACKET_OUTGOING = 4
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+# Structs of the ring: tpacket_req3, the header of a block
+# (tpacket_block_desc, up to the timestamp of its last packet), the
+# header of a packet (tpacket3_hdr) and tpacket_stats_v3
+TPACKET_REQ3 = struct.Struct('@IIIIIII')
+BLOCK_STATUS = struct.Struct('@I')
+BLOCK_STATUS_OFFSET = 8
+BLOCK_HEADER = struct.Struct('@II')
+BLOCK_HEADER_OFFSET = 12
+BLOCK_TIMESTAMPS = struct.Struct('@IIII')
+BLOCK_TIMESTAMPS_OFFSET = 32
+PACKET_HEADER = struct.Struct('@IIIIIIHH')
+# Offset of the packet type in the sockaddr_ll following the header of
+# a packet (TPACKET_ALIGN(sizeof(struct tpacket3_hdr)) + 10)
+PKTTYPE_OFFSET = 58
+TPACKET_STATS_V3 = struct.Struct('@III')
+# IPv6 and SRH fields
+IPV6_HDR_LEN = 40
+IPPROTO_ROUTING = 43
+SRH_ROUTING_TYPE = 4
+SRH_FIXED_LEN = 8
+
+# Default geometry of the ring of each interface: 64 blocks of 1 MB,
+# frames of 2 KB (the frames only bound the snap length), and timeout (in
+# milliseconds) after which the kernel returns a block not full
+DEFAULT_BLOCK_SIZE = 1 << 20
+DEFAULT_NUM_BLOCKS = 64
+DEFAULT_FRAME_SIZE = 1 << 11
+DEFAULT_BLOCK_TIMEOUT = 10
+# Timeout (in milliseconds) of the poll, used to check the stop event
+POLL_TIMEOUT = 100
+
+# Number of colors supported by default
+DEFAULT_NUM_COLOR = 2
+
+
+def flow_key(sid_list):
+    """Return the key of a SID list, i.e. its SIDs as they are carried in
+    the SRH (last segment first, 16 bytes each). The key is compared with
+    the bytes of the received packets, without any conversion"""
+
+    return b''.join(socket.inet_pton(socket.AF_INET6, sid)
+                    for sid in reversed(sid_list))
+
+
+class PacketRing():
+    """A TPACKET_V3 ring of an AF_PACKET socket bound to an interface. The
+    packets sent are captured only if 'outgoing' is True, since the
+    kernel passes them only to the sockets receiving all the protocols"""
+
+    def __init__(self, interface, outgoing=False,
+                 block_size=DEFAULT_BLOCK_SIZE, num_blocks=DEFAULT_NUM_BLOCKS,
+                 frame_size=DEFAULT_FRAME_SIZE,
+                 block_timeout=DEFAULT_BLOCK_TIMEOUT):
+
+        # pylint: disable=too-many-arguments
+
+        self.interface = interface
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        protocol = ETH_P_ALL if outgoing else ETH_P_IPV6
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                  socket.htons(protocol))
+        try:
+            self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                                 TPACKET_REQ3.pack(
+                                     block_size, num_blocks, frame_size,
+                                     block_size // frame_size * num_blocks,
+                                     block_timeout, 0, 0))
+            self.mem = mmap.mmap(self.sock.fileno(), block_size * num_blocks,
+                                 mmap.MAP_SHARED,
+                                 mmap.PROT_READ | mmap.PROT_WRITE)
+            self.sock.bind((interface, protocol))
+        except OSError:
+            self.sock.close()
+            raise
+        # Index of the next block returned by the kernel
+        self.block = 0
+
+    def fileno(self):
+        """Return the file descriptor of the socket, used by poll"""
+
+        return self.sock.fileno()
+
+    def next_block(self):
+        """Return the offset of the next block filled by the kernel, or
+        None if it is still owned by the kernel"""
+
+        offset = self.block * self.block_size
+        status, = BLOCK_STATUS.unpack_from(self.mem,
+                                           offset + BLOCK_STATUS_OFFSET)
+        if not status & TP_STATUS_USER:
+            return None
+        return offset
+
+    def release_block(self, offset):
+        """Give a block back to the kernel and move to the next one"""
+
+        BLOCK_STATUS.pack_into(self.mem, offset + BLOCK_STATUS_OFFSET,
+                               TP_STATUS_KERNEL)
+        self.block = (self.block + 1) % self.num_blocks
+
+    def stats(self):
+        """Return the number of packets received and dropped by the ring
+        since the last call"""
+
+        packets, drops, _ = TPACKET_STATS_V3.unpack(self.sock.getsockopt(
+            SOL_PACKET, PACKET_STATISTICS, TPACKET_STATS_V3.size))
+        return packets, drops
+
+    def close(self):
+        """Unmap the ring and close the socket"""
+
+        self.mem.close()
+        self.sock.close()
+
+
+class TpacketInterf():
+    """A class representing a userspace driver, counting the packets read
+    from a TPACKET_V3 ring on each interface"""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, in_interfaces=None, out_interfaces=None,
+                 num_color=DEFAULT_NUM_COLOR, block_size=DEFAULT_BLOCK_SIZE,
+                 num_blocks=DEFAULT_NUM_BLOCKS):
+
+        # pylint: disable=too-many-arguments
+
+        self.blue = 1
+        self.red = 0
+        self.num_color = num_color
+        # Counters of the flows of each direction, indexed by the key of
+        # the SID list (see flow_key). Each flow has a counter per color
+        self.out_flows = {}
+        self.in_flows = {}
+        # Instant of the last change of color, previous color and active
+        # color, used to count the packets sent in the right color. The
+        # tuple is replaced at once, so the counting thread never sees a
+        # partial change
+        self.color_state = (0.0, self.blue, self.blue)
+        # Packets received and dropped by the rings
+        self.packets = 0
+        self.drops = 0
+
+        in_interfaces = set(in_interfaces or [])
+        out_interfaces = set(out_interfaces or [])
+        # Rings, with the directions counted on their interface
+        self.rings = []
+        for interface in sorted(in_interfaces | out_interfaces):
+            try:
+                ring = PacketRing(interface,
+                                  outgoing=interface in out_interfaces,
+                                  block_size=block_size,
+                                  num_blocks=num_blocks)
+            except OSError as err:
+                print('TPACKET ring not created on {intf}: {err}'.format(
+                    intf=interface, err=err))
+                continue
+            self.rings.append((ring, interface in in_interfaces,
+                               interface in out_interfaces))
+
+        self.stop_event = Event()
+        self.thread = Thread(target=self.run, name='TpacketInterf')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop counting and release the rings"""
+
+        print('Deallocating TpacketInterf object')
+        self.stop_event.set()
+        self.thread.join()
+        for ring, _, _ in self.rings:
+            ring.close()
+        self.rings = []
+
+    @property
+    def epbf_interfs_egr(self):
+        """Interfaces monitored on egress"""
+
+        return sorted(ring.interface for ring, _, count_out in self.rings
+                      if count_out)
+
+    @property
+    def epbf_interfs_igr(self):
+        """Interfaces monitored on ingress"""
+
+        return sorted(ring.interface for ring, count_in, _ in self.rings
+                      if count_in)
+
+    def set_sidlist_out(self, sid_list):
+        """Add a SID list from the monitored egress interface"""
+
+        self.out_flows.setdefault(flow_key(sid_list), [0] * self.num_color)
+
+    def set_sidlist_in(self, sid_list):
+        """Add a SID list from the monitored ingress interface"""
+
+        self.in_flows.setdefault(flow_key(sid_list), [0] * self.num_color)
+
+    def rem_sidlist_out(self, sid_list):
+        """Remove SID list from the monitored egress interface"""
+
+        self.out_flows.pop(flow_key(sid_list), None)
+
+    def rem_sidlist_in(self, sid_list):
+        """Remove SID list from the monitored ingress interface"""
+
+        self.in_flows.pop(flow_key(sid_list), None)
+
+    def set_flows(self, flows):
+        """Add several SID lists to the monitored interfaces, as in
+        EbpfInterf.set_flows. Return a list containing True for each
+        flow added"""
+
+        for direction, sid_list in flows:
+            flows_table = self.out_flows \
+                if direction == snapshots.DIRECTION_TX else self.in_flows
+            flows_table.setdefault(flow_key(sid_list), [0] * self.num_color)
+        return [True] * len(flows)
+
+    def rem_flows(self, flows):
+        """Remove several SID lists from the monitored interfaces"""
+
+        for direction, sid_list in flows:
+            flows_table = self.out_flows \
+                if direction == snapshots.DIRECTION_TX else self.in_flows
+            flows_table.pop(flow_key(sid_list), None)
+
+    def set_color(self, color):
+        """Change color"""
+
+        active_color = self.color_state[2]
+        if color == active_color:
+            return
+        self.color_state = (time.time(), active_color, color)
+
+    def get_color(self):
+        """Return the current color"""
+
+        return self.color_state[2]
+
+    def toggle_color(self):
+        """Move to the next color"""
+
+        self.set_color((self.get_color() + 1) % self.num_color)
+
+    def read_tx_counter(self, color, sid_list):
+        """Read counter for TX packets"""
+
+        counters = self.out_flows.get(flow_key(sid_list))
+        return counters[color] if counters is not None else 0
+
+    def read_rx_counter(self, color, sid_list):
+        """Read counter for RX packets"""
+
+        counters = self.in_flows.get(flow_key(sid_list))
+        return counters[color] if counters is not None else 0
+
+    def get_stats(self):
+        """Return the packets received and dropped by the rings. The
+        counters are underestimated if any packet has been dropped"""
+
+        for ring, _, _ in self.rings:
+            packets, drops = ring.stats()
+            self.packets += packets
+            self.drops += drops
+        return {'packets': self.packets, 'drops': self.drops}
+
+    def run(self):
+        """Count the packets of the rings until the driver is stopped"""
+
+        poller = select.poll()
+        rings = {}
+        for ring, count_in, count_out in self.rings:
+            poller.register(ring.fileno(), select.POLLIN | select.POLLERR)
+            rings[ring.fileno()] = (ring, count_in, count_out)
+        while not self.stop_event.is_set():
+            for fd, _ in poller.poll(POLL_TIMEOUT):
+                ring, count_in, count_out = rings[fd]
+                offset = ring.next_block()
+                while offset is not None:
+                    self.count_block(ring.mem, offset, count_in, count_out)
+                    ring.release_block(offset)
+                    offset = ring.next_block()
+
+    def count_block(self, mem, offset, count_in, count_out):
+        """Count the packets of a block of a ring"""
+
+        # pylint: disable=too-many-locals
+
+        # Color of the packets not marked, given by their timestamp. Only
+        # the blocks spanning a change of color need the timestamp of
+        # each packet
+        color_time, prev_color, active_color = self.color_state
+        first_sec, first_nsec, last_sec, last_nsec = \
+            BLOCK_TIMESTAMPS.unpack_from(mem, offset + BLOCK_TIMESTAMPS_OFFSET)
+        if first_sec + first_nsec * 1e-9 >= color_time:
+            block_color = active_color
+        elif last_sec + last_nsec * 1e-9 < color_time:
+            block_color = prev_color
+        else:
+            block_color = None
+        out_flows = self.out_flows if count_out else {}
+        in_flows = self.in_flows if count_in else {}
+        num_color = self.num_color
+        unpack_header = PACKET_HEADER.unpack_from
+
+        num_pkts, first_pkt = BLOCK_HEADER.unpack_from(
+            mem, offset + BLOCK_HEADER_OFFSET)
+        pkt = offset + first_pkt
+        for _ in range(num_pkts):
+            next_offset, sec, nsec, snaplen, _, _, mac, net = \
+                unpack_header(mem, pkt)
+            ipv6 = pkt + net
+            srh = ipv6 + IPV6_HDR_LEN
+            # Only the SRv6 packets are counted
+            if snaplen >= net - mac + IPV6_HDR_LEN + SRH_FIXED_LEN and \
+                    mem[ipv6] >> 4 == 6 and \
+                    mem[ipv6 + 6] == IPPROTO_ROUTING and \
+                    mem[srh + 2] == SRH_ROUTING_TYPE:
+                key = mem[srh + SRH_FIXED_LEN:
+                          srh + SRH_FIXED_LEN + 16 * (mem[srh + 4] + 1)]
+                outgoing = mem[pkt + PKTTYPE_OFFSET] == PACKET_OUTGOING
+                counters = out_flows.get(key) if outgoing \
+                    else in_flows.get(key)
+                if counters is not None:
+                    # DSCP of the traffic class of the outer header. The
+                    # packets sent are never marked by this driver
+                    mark = 0 if outgoing else \
+                        (mem[ipv6] & 0x0f) << 2 | mem[ipv6 + 1] >> 6
+                    if 0 < mark <= num_color:
+                        counters[mark - 1] += 1
+                    elif block_color is not None:
+                        counters[block_color] += 1
+                    else:
+                        counters[active_color
+                                 if sec + nsec * 1e-9 >= color_time
+                                 else prev_color] += 1
+            pkt += next_offset
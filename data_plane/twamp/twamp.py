@@ -4,9 +4,21 @@
 """This module contains classes representing TWAMP packets"""
 
 
-from scapy.all import (BitEnumField, BitField, ByteEnumField, ByteField,
-                       IntField, LongField, Packet, ShortField,
-                       ThreeBytesField, XByteField)
+from scapy.fields import (BitEnumField, BitField, ByteEnumField, ByteField,
+                          ConditionalField, IntField, LongField, ShortField,
+                          ThreeBytesField, XByteField)
+from scapy.packet import Packet
+
+# Offset of the transmission time of the response (Timestamp) from the
+# start of a response carrying the timestamps, used to write it in the
+# packet just before the transmission
+RESPONSE_TIMESTAMP_OFFSET = 49
+
+
+def has_timestamps(pkt):
+    """True if the packet carries the timestamps (T bit set)"""
+
+    return pkt.T == 1
 
 
 class TWAMPTestQuery(Packet):
@@ -19,13 +31,18 @@ class TWAMPTestQuery(Packet):
                                             1: "64bit Counter"}),
                    BitEnumField("B", 0, 1, {0: "Packet Counter",
                                             1: "Octet Counter"}),
-                   BitField("MBZ", 0, 6),
+                   BitEnumField("T", 0, 1, {0: "No Timestamp",
+                                            1: "Timestamp"}),
+                   BitField("MBZ", 0, 5),
                    ByteField("BlockNumber", 0),
                    ShortField("MBZ", 0),
                    ThreeBytesField("MBZ", 0),
                    ByteEnumField("SenderControlCode", 0,
                                  {0: "Out-of-band Response Requested",
-                                  1: "In-band Response Requested"})
+                                  1: "In-band Response Requested"}),
+                   # Transmission time of the query (NTP format)
+                   ConditionalField(LongField("Timestamp", 0),
+                                    has_timestamps)
                    ]  # manca il padding
 
 
@@ -37,7 +54,8 @@ class TWAMPTestResponse(Packet):
                    LongField("TransmitCounter", 0),
                    BitField("X", 0, 1),
                    BitField("B", 0, 1),
-                   BitField("MBZ", 0, 6),
+                   BitField("T", 0, 1),
+                   BitField("MBZ", 0, 5),
                    XByteField("BlockNumber", 0),
                    ShortField("MBZ", 0),
                    LongField("ReceiveCounter", 0),
@@ -51,4 +69,14 @@ class TWAMPTestResponse(Packet):
                    ByteEnumField(
                        "ReceverControlCode", 0, {
                            1: "Error - Invalid Message"}),
-                   XByteField("SenderTTL", 0)]  # manca il padding
+                   XByteField("SenderTTL", 0),
+                   # Reception time of the query, transmission time of the
+                   # response and transmission time of the query copied
+                   # from the query (NTP format)
+                   ConditionalField(LongField("ReceiveTimestamp", 0),
+                                    has_timestamps),
+                   ConditionalField(LongField("Timestamp", 0),
+                                    has_timestamps),
+                   ConditionalField(LongField("SenderTimestamp", 0),
+                                    has_timestamps)
+                   ]  # manca il padding
@@ -2,6 +2,9 @@
 
 # Disable pylint warnings on todos to avoid annoying pylint warnings
 # pylint: disable=fixme
+# The drivers, the sender, the reflector and the receiver of the daemon
+# share this module
+# pylint: disable=too-many-lines
 
 """This module implements several functionalities of a TWAMP deaemon"""
 
@@ -11,41 +14,157 @@ import os
 import sched
 import sys
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from threading import Thread
+from threading import Lock, Thread
 
-# Scapy dependencies
-from scapy.all import send, sniff
+# Scapy dependencies. Only the layers used by TWAMP are imported, scapy.all
+# would load every protocol layer and slow down the startup
 from scapy.layers.inet import UDP
 from scapy.layers.inet6 import IPv6, IPv6ExtHdrSegmentRouting
+from scapy.sendrecv import send, sniff
 
-# Netifaces dependencies
-import netifaces
 # Data-plane dependencies
-from data_plane.twamp import twamp, utils
+from data_plane.twamp import (admission, attach, dispatch, histogram,
+                              seqwindow, sessions, snapshots, stagger,
+                              timestamps, twamp, utils)
 
 # import subprocess
 # import shlex
 
 
-# SRv6 PM and data-plane dependencies
-try:
-    # srv6_pfplm_helper_user repository is required to run this module
-    from srv6_pfplm_helper_user import EbpfException, EbpfPFPLM
-except ImportError:
-    # srv6_pfplm_helper_user does not exist or not in the PYTHONPATH
-    print('ERROR: srv6_pfplm_helper_user not found. Is it installed?')
-    sys.exit(-2)
+# SRv6 PM and data-plane dependencies. srv6_pfplm_helper_user is imported
+# when the first eBPF driver is created (see import_ebpf_helper), so that
+# importing this module does not load the eBPF libraries
+EbpfException = None        # pylint: disable=invalid-name
+EbpfPFPLM = None        # pylint: disable=invalid-name
 
 # Folder containing this script
 BASE_PATH = os.path.dirname(os.path.realpath(__file__))
 
 # SRv6 PFPLM dependencies
 SRV6_PM_XDP_EBPF_PATH = os.getenv('SRV6_PM_XDP_EBPF_PATH', None)
-if SRV6_PM_XDP_EBPF_PATH is None:
-    print('SRV6_PM_XDP_EBPF_PATH environment variable not set')
-    sys.exit(-2)
-SRV6_PFPLM_PATH = os.path.join(SRV6_PM_XDP_EBPF_PATH, 'srv6-pfplm/')
+SRV6_PFPLM_PATH = os.path.join(SRV6_PM_XDP_EBPF_PATH, 'srv6-pfplm/') \
+    if SRV6_PM_XDP_EBPF_PATH is not None else None
+
+# Default color options: duration of the measurement interval (in seconds),
+# delay of the measurement after the change of color (in milliseconds)
+# and number of colors
+DEFAULT_INTERVAL = 15
+DEFAULT_MARGIN = 3000
+DEFAULT_NUM_COLOR = 2
+# Shortest measurement interval (in seconds)
+MIN_INTERVAL = 0.1
+
+# Default max number of paths auto-provisioned by a stateless reflector
+DEFAULT_MAX_AUTO_PATHS = 4096
+# Default length of the locators, used by a stateless reflector to derive
+# the SID of a sender from its address
+DEFAULT_LOCATOR_LEN = 64
+
+# Default max number of counters cached by the eBPF driver
+DEFAULT_MAX_CACHED_COUNTERS = 65536
+
+# Status codes of the paths of a bulk request (start_meas_many and
+# stop_meas_many)
+STATUS_OK = 0
+STATUS_INVALID_PATH = 1         # malformed SID list
+STATUS_DUPLICATE = 2        # path repeated in the request
+STATUS_ALREADY_STARTED = 3
+STATUS_NOT_STARTED = 4
+STATUS_INVALID_OPTIONS = 5      # color options not valid
+STATUS_DRIVER_ERROR = 6     # eBPF flows not added
+STATUS_FULL = 7     # no room for more sessions
+STATUS_INTERNAL_ERROR = 8       # the worker handling the path failed
+
+# Default time (in seconds) waited for the response to a query before
+# retransmitting it, and max number of retransmissions of a query
+DEFAULT_QUERY_TIMEOUT = 1.0
+DEFAULT_MAX_RETRIES = 2
+# Responses discarded by the sender, by classification (see seqwindow):
+# counter of the path and label of the log
+DISCARDED_RESPONSES = {
+    seqwindow.LATE: ('lateResponses', 'LATE'),
+    seqwindow.DUPLICATE: ('duplicateResponses', 'DUPLICATE'),
+    seqwindow.UNKNOWN: ('unknownResponses', 'UNKNOWN')
+}
+
+
+def import_ebpf_helper():
+    """Import the srv6_pfplm_helper_user module. Exit if it is missing"""
+
+    # pylint: disable=global-statement,invalid-name,import-outside-toplevel
+    global EbpfException, EbpfPFPLM
+
+    if EbpfPFPLM is not None:
+        return
+    if SRV6_PM_XDP_EBPF_PATH is None:
+        print('SRV6_PM_XDP_EBPF_PATH environment variable not set')
+        sys.exit(-2)
+    try:
+        # srv6_pfplm_helper_user repository is required by the eBPF driver
+        import srv6_pfplm_helper_user
+    except ImportError:
+        # srv6_pfplm_helper_user does not exist or not in the PYTHONPATH
+        print('ERROR: srv6_pfplm_helper_user not found. Is it installed?')
+        sys.exit(-2)
+    EbpfException = srv6_pfplm_helper_user.EbpfException
+    EbpfPFPLM = srv6_pfplm_helper_user.EbpfPFPLM
+
+
+def validate_paths(paths, running):
+    """Validate and canonicalize the SID lists of the paths of a bulk
+    request in a single pass. 'paths' is a list of (SID list, return SID
+    list) tuples and 'running' contains the keys of the running paths.
+    Return the status code of each path and the list of the (index, key,
+    SID list, return SID list) tuples of the valid paths"""
+
+    statuses = []
+    valid = []
+    seen = set()
+    for index, (sid_list, rev_sid_list) in enumerate(paths):
+        try:
+            sid_list = utils.parse_sid_list(sid_list)
+            rev_sid_list = utils.parse_sid_list(rev_sid_list)
+        except ValueError:
+            statuses.append(STATUS_INVALID_PATH)
+            continue
+        key = '/'.join(sid_list)
+        if key in seen:
+            statuses.append(STATUS_DUPLICATE)
+            continue
+        seen.add(key)
+        if key in running:
+            statuses.append(STATUS_ALREADY_STARTED)
+            continue
+        statuses.append(STATUS_OK)
+        valid.append((index, key, sid_list, rev_sid_list))
+    return statuses, valid
+
+
+def remove_paths(sid_lists, remove):
+    """Remove the paths of a bulk stop request in a single pass.
+    'sid_lists' is a list of SID lists, given as lists of SIDs or as
+    strings of SIDs separated by slashes, and 'remove(key)' removes a
+    running path and returns its state, or None if the path is not
+    running. Return the status code of each SID list and the list of the
+    (index, key, state) tuples of the removed paths"""
+
+    statuses = []
+    removed = []
+    for index, sid_list in enumerate(sid_lists):
+        try:
+            key = '/'.join(utils.parse_sid_list(sid_list))
+        except ValueError:
+            statuses.append(STATUS_INVALID_PATH)
+            continue
+        state = remove(key)
+        if state is None:
+            statuses.append(STATUS_NOT_STARTED)
+            continue
+        statuses.append(STATUS_OK)
+        removed.append((index, key, state))
+    return statuses, removed
 
 
 # ''' ***************************************** DRIVER EBPF '''
@@ -56,37 +175,73 @@ class EbpfInterf():
 
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, in_interfaces=None, out_interfaces=None):
-        if len(in_interfaces) == 0:
-            in_interfaces = netifaces.interfaces()
-        if len(out_interfaces) == 0:
-            out_interfaces = netifaces.interfaces()
+    def __init__(self, in_interfaces=None, out_interfaces=None,
+                 load_programs=True, num_color=DEFAULT_NUM_COLOR,
+                 warm_restart=False, watch_interfaces=True,
+                 max_cached_counters=DEFAULT_MAX_CACHED_COUNTERS,
+                 margin=DEFAULT_MARGIN):
+
+        # pylint: disable=too-many-arguments
+
+        import_ebpf_helper()
 
         self.blue = 1
         self.red = 0
-        self.mark = [1, 2]
-        self.epbf_interfs_egr = out_interfaces \
-            if out_interfaces is not None else []
-        self.epbf_interfs_igr = in_interfaces \
-            if in_interfaces is not None else []
+        # Color i is marked with the value i + 1 in the eBPF maps
+        self.num_color = num_color
+        self.mark = list(range(1, num_color + 1))
+        # Counters of the closed colors, indexed by (interval, direction,
+        # color, flow), where the interval is the number of changes of
+        # color seen by this driver. The counters of a closed color do not
+        # change until the color becomes active again, so the cache is
+        # cleared on every change of color. The active color is not cached
+        # and, until it is known (e.g. on warm restart), nothing is cached.
+        # The packets marked with the closed color can still be counted
+        # until the margin (in milliseconds) has elapsed since the change
+        # of color, so the counters read earlier are not cached
+        self.active_color = None
+        self.color_changes = 0
+        self.color_change_time = None
+        self.margin = margin / 1000
+        self.counter_cache = {}
+        self.max_cached_counters = max_cached_counters
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Keeps the programs attached to the interfaces. If no interface
+        # is given, the programs are attached to all the interfaces except
+        # the loopback ones, including the ones added later
+        self.attach_manager = None
+        # If False, the eBPF programs are supposed to be already loaded
+        # by another driver (e.g. the coordinator of a sharded daemon)
+        # and this driver only accesses the eBPF maps
+        self.load_programs = load_programs
+        # If True, the flows left by the previous instance of the daemon
+        # are reused, and the programs and the flows are left in place on
+        # stop, so that the counters have no gaps. The programs already
+        # attached are always reused
+        self.warm_restart = warm_restart
 
         try:
             self.epbf = EbpfPFPLM()
             self.egr = self.epbf.lib.FLOW_DIR_EGRESS
             self.igr = self.epbf.lib.FLOW_DIR_INGRESS
 
-            for intf in in_interfaces:
-                try:
-                    self.epbf.load_ingress(intf)
-                except EbpfException as err:
-                    err.print_exception()
-            for intf in out_interfaces:
-                try:
-                    self.epbf.load_egress(intf)
-                except EbpfException as err:
-                    err.print_exception()
+            self.attach_manager = attach.AttachManager(
+                self.epbf, EbpfException, in_interfaces, out_interfaces)
+
+            if not self.load_programs:
+                return
 
-            self.epbf.pfplm_change_active_color(self.mark[self.blue])
+            # Load the programs only where they are missing, in parallel
+            self.attach_manager.sync()
+            if watch_interfaces:
+                self.attach_manager.start_watch()
+
+            # On warm restart the active color is the one of the running
+            # interval, set by the previous instance
+            if not self.warm_restart:
+                self.epbf.pfplm_change_active_color(self.mark[self.blue])
+                self.update_active_color(self.blue)
 
         except EbpfException as err:
             err.print_exception()
@@ -95,20 +250,30 @@ class EbpfInterf():
         """Unload the eBPF program from all the interfaces"""
 
         print('Deallocating EbpfInterf object')
-        try:
-            for intf in self.epbf_interfs_igr:
-                try:
-                    self.epbf.unload_ingress(intf)
-                except EbpfException as err:
-                    err.print_exception()
-            for intf in self.epbf_interfs_egr:
-                try:
-                    self.epbf.unload_egress(intf)
-                except EbpfException as err:
-                    err.print_exception()
+        if self.attach_manager is None or not self.load_programs:
+            # The eBPF programs are owned by another driver
+            return
+        self.attach_manager.stop_watch()
+        if self.warm_restart:
+            # The eBPF programs are kept for the next instance of the daemon
+            return
+        self.attach_manager.detach_all()
 
-        except EbpfException as err:
-            err.print_exception()
+    @property
+    def epbf_interfs_egr(self):
+        """Interfaces monitored on egress"""
+
+        if self.attach_manager is None:
+            return []
+        return sorted(self.attach_manager.desired_out())
+
+    @property
+    def epbf_interfs_igr(self):
+        """Interfaces monitored on ingress"""
+
+        if self.attach_manager is None:
+            return []
+        return sorted(self.attach_manager.desired_in())
 
     def set_sidlist_out(self, sid_list):
         """Add a SID list from the monitored egress interface"""
@@ -121,6 +286,9 @@ class EbpfInterf():
         #     self.epbf_interfs_egr.append(interf)
 
         ebpf_sid_list = utils.sid_list_converter(sid_list)
+        if self.warm_restart and self.has_flow(self.egr, ebpf_sid_list):
+            print('EBPF REATTACHED OUT sidlist', ebpf_sid_list)
+            return
         print('EBPF INS OUT sidlist', ebpf_sid_list)
         try:
             self.epbf.pfplm_add_flow(self.egr, ebpf_sid_list)
@@ -138,6 +306,9 @@ class EbpfInterf():
         #     self.epbf_interfs_igr.append(interf)
 
         ebpf_sid_list = utils.sid_list_converter(sid_list)
+        if self.warm_restart and self.has_flow(self.igr, ebpf_sid_list):
+            print('EBPF REATTACHED IN sidlist', ebpf_sid_list)
+            return
         print('EBPF INS IN sidlist', ebpf_sid_list)
         try:
             self.epbf.pfplm_add_flow(self.igr, ebpf_sid_list)
@@ -153,6 +324,7 @@ class EbpfInterf():
             self.epbf.pfplm_del_flow(self.egr, ebpf_sid_list)  # da testare
         except EbpfException as err:
             err.print_exception()
+        self.counter_cache.clear()
 
     def rem_sidlist_in(self, sid_list):
         """Remove SID list from the monitored ingress interface"""
@@ -163,6 +335,62 @@ class EbpfInterf():
             self.epbf.pfplm_del_flow(self.igr, ebpf_sid_list)  # da testare
         except EbpfException as err:
             err.print_exception()
+        self.counter_cache.clear()
+
+    def set_flows(self, flows):
+        """Add several SID lists to the monitored interfaces. 'flows' is
+        a list of (direction, SID list) tuples, where direction is
+        snapshots.DIRECTION_TX (egress) or snapshots.DIRECTION_RX
+        (ingress). Return a list containing True for each flow added"""
+
+        # The helper has no batch update, so each flow is still a map
+        # update of its own. The loop only saves the per-path calls and
+        # prints of set_sidlist_*
+        added = []
+        for direction, sid_list in flows:
+            map_direction = self.egr \
+                if direction == snapshots.DIRECTION_TX else self.igr
+            ebpf_sid_list = utils.sid_list_converter(sid_list)
+            if self.warm_restart and self.has_flow(map_direction,
+                                                   ebpf_sid_list):
+                added.append(True)
+                continue
+            try:
+                self.epbf.pfplm_add_flow(map_direction, ebpf_sid_list)
+            except EbpfException as err:
+                err.print_exception()
+                added.append(False)
+                continue
+            added.append(True)
+        print('EBPF INS {num} sidlists ({failed} failed)'.format(
+            num=len(flows), failed=added.count(False)))
+        return added
+
+    def rem_flows(self, flows):
+        """Remove several SID lists from the monitored interfaces, one map
+        update per flow. 'flows' is a list of (direction, SID list)
+        tuples, as in set_flows"""
+
+        for direction, sid_list in flows:
+            map_direction = self.egr \
+                if direction == snapshots.DIRECTION_TX else self.igr
+            try:
+                self.epbf.pfplm_del_flow(
+                    map_direction, utils.sid_list_converter(sid_list))
+            except EbpfException as err:
+                err.print_exception()
+        self.counter_cache.clear()
+        print('EBPF REM {num} sidlists'.format(num=len(flows)))
+
+    def has_flow(self, direction, ebpf_sid_list):
+        """True if a flow is already present in the eBPF maps"""
+
+        try:
+            self.epbf.pfplm_get_flow_stats(
+                direction, ebpf_sid_list, self.mark[0])
+        except EbpfException:
+            return False
+        return True
 
     def set_color(self, color):
         """Change color"""
@@ -170,10 +398,18 @@ class EbpfInterf():
         if len(self.epbf_interfs_egr) == 0:
             return
 
-        if color == self.blue:
-            self.epbf.pfplm_change_active_color(self.mark[self.blue])
-        else:
-            self.epbf.pfplm_change_active_color(self.mark[self.red])
+        self.epbf.pfplm_change_active_color(self.mark[color])
+        self.update_active_color(color)
+
+    def update_active_color(self, color):
+        """Invalidate the cached counters if the active color changed"""
+
+        if color == self.active_color:
+            return
+        self.active_color = color
+        self.color_changes += 1
+        self.color_change_time = time.monotonic()
+        self.counter_cache.clear()
 
     def get_color(self):
         """Return the current color"""
@@ -181,36 +417,76 @@ class EbpfInterf():
         if len(self.epbf_interfs_egr) == 0:
             return self.red
         col = self.epbf.pfplm_get_active_color()
-        if col == self.mark[0]:
+        if col not in self.mark:
             return self.red
-        return self.blue
+        return self.mark.index(col)
 
     def toggle_color(self):
-        """Toggle color"""
+        """Move to the next color"""
 
-        if self.get_color() == self.blue:
-            self.epbf.pfplm_change_active_color(self.mark[self.red])
-        else:
-            self.epbf.pfplm_change_active_color(self.mark[self.blue])
+        color = (self.get_color() + 1) % len(self.mark)
+        self.epbf.pfplm_change_active_color(self.mark[color])
+        self.update_active_color(color)
 
     def read_tx_counter(self, color, sid_list):
         """Read counter for TX packets"""
 
         ebpf_sid_list = utils.sid_list_converter(sid_list)
-        print('SID LIST IN READ TX CNT', ebpf_sid_list)
-        return self.epbf.pfplm_get_flow_stats(
-            self.egr, ebpf_sid_list, self.mark[color])
+        return self.read_flow_stats(self.egr, color, ebpf_sid_list)
 
     def read_rx_counter(self, color, sid_list):
         """Read counter for RX packets"""
 
         ebpf_sid_list = utils.sid_list_converter(sid_list)
-        return self.epbf.pfplm_get_flow_stats(
-            self.igr, ebpf_sid_list, self.mark[color])
+        return self.read_flow_stats(self.igr, color, ebpf_sid_list)
+
+    def read_flow_stats(self, direction, color, ebpf_sid_list):
+        """Read the counter of a flow, from the cache if the color is
+        closed and the counter has already been read in this interval,
+        after the margin"""
+
+        if self.active_color is None or color == self.active_color:
+            return self.epbf.pfplm_get_flow_stats(
+                direction, ebpf_sid_list, self.mark[color])
+        if time.monotonic() - self.color_change_time < self.margin:
+            # The counter can still change, do not cache it
+            return self.epbf.pfplm_get_flow_stats(
+                direction, ebpf_sid_list, self.mark[color])
+        key = (self.color_changes, direction, color, ebpf_sid_list)
+        counter = self.counter_cache.get(key)
+        if counter is not None:
+            self.cache_hits += 1
+            return counter
+        self.cache_misses += 1
+        counter = self.epbf.pfplm_get_flow_stats(
+            direction, ebpf_sid_list, self.mark[color])
+        # If the color changed during the read, the entry is stale but it
+        # is never hit, since the key contains the old interval
+        if len(self.counter_cache) >= self.max_cached_counters:
+            # Evict the oldest counter
+            try:
+                del self.counter_cache[next(iter(self.counter_cache))]
+            except (KeyError, RuntimeError, StopIteration):
+                # Changed by another thread, e.g. on a change of color
+                pass
+        self.counter_cache[key] = counter
+        return counter
+
+    def get_counter_cache_stats(self):
+        """Return the statistics of the cache of the counters"""
+
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'size': len(self.counter_cache)
+        }
 
 
 # ''' ***************************************** DRIVER IPSET '''
 
+# The ipset driver is replaced by the userspace driver of the tpacket
+# module (tpacket.TpacketInterf), which counts the packets read from a
+# TPACKET_V3 ring and has the same interface of EbpfInterf
 
 # class IpSetInterf():
 #     def __init__(self):
@@ -312,7 +588,8 @@ class TestPacketReceiver(Thread):
     """A class implementing a listener for TWAMP packets"""
 
     def __init__(self, interface, sender, reflector,
-                 ss_udp_port=1206, refl_udp_port=1205, stop_event=None):
+                 ss_udp_port=1206, refl_udp_port=1205, stop_event=None,
+                 workers=0, queue_size=dispatch.DEFAULT_QUEUE_SIZE):
 
         # pylint: disable=too-many-arguments
 
@@ -323,10 +600,38 @@ class TestPacketReceiver(Thread):
         self.ss_udp_port = ss_udp_port
         self.refl_udp_port = refl_udp_port
         self.stop_event = stop_event
+        # Workers handling the TWAMP packets, sharded by session
+        # (dispatch.DispatchPool). If None, the packets are handled by the
+        # capture thread
+        self.dispatcher = dispatch.DispatchPool(
+            self.handle_packet, workers, queue_size) if workers > 0 else None
 
     def packet_recv_callback(self, packet):
         """Called when a TWAMP packet is received. Pass the packet
-        to the corresponding handler"""
+        to the worker of its session, or to the corresponding handler if
+        there are no workers"""
+
+        if self.dispatcher is None:
+            self.handle_packet(packet)
+        elif UDP in packet and packet[UDP].dport in (self.refl_udp_port,
+                                                     self.ss_udp_port):
+            # The other packets are dropped here, so they do not fill the
+            # queues of the workers
+            self.dispatcher.submit(self.session_key(packet), packet)
+
+    @staticmethod
+    def session_key(packet):
+        """Return the key of the session of a TWAMP packet, or None if the
+        packet has no SRH. The queries and the responses carry the
+        reversed SID list of their path (con punt)"""
+
+        if IPv6ExtHdrSegmentRouting not in packet:
+            return None
+        sid_list = list(packet[IPv6ExtHdrSegmentRouting].addresses)
+        return utils.sid_list_key(utils.rem_punt(sid_list)[::-1])
+
+    def handle_packet(self, packet):
+        """Pass a TWAMP packet to the corresponding handler"""
 
         # ss_udp_port and refl_udp_port are received from the controller
         if UDP in packet:
@@ -347,6 +652,8 @@ class TestPacketReceiver(Thread):
         # Create stop filter for scapy sniff
         def stop_filter(pkt):        # pylint: disable=unused-argument
             return self.stop_event.is_set()
+        if self.dispatcher is not None:
+            self.dispatcher.start()
         # Start sniffing
         print('TestPacketReceiver Start sniffing...')
         sniff(
@@ -355,8 +662,19 @@ class TestPacketReceiver(Thread):
             prn=self.packet_recv_callback,
             stop_filter=stop_filter if self.stop_event is not None else None)
         print('TestPacketReceiver Stop sniffing')
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
         # codice netqueue
 
+    def get_dispatch_stats(self):
+        """Return the queue depths and the overload counters of the
+        workers, or None if the packets are handled by the capture
+        thread"""
+
+        if self.dispatcher is None:
+            return None
+        return self.dispatcher.stats()
+
 
 # ''' ***************************************** SENDER '''
 
@@ -364,26 +682,88 @@ class TestPacketReceiver(Thread):
 class SessionSender(Thread):
     """A class representing a sender implemented as a thread"""
 
-    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-instance-attributes,too-many-public-methods
+
+    def __init__(self, driver, stop_event=None, interval=DEFAULT_INTERVAL,
+                 margin=DEFAULT_MARGIN, num_color=DEFAULT_NUM_COLOR,
+                 timestamping=None, checkpoint=None, clock=None,
+                 margin_controller=None, measlog=None,
+                 spread=stagger.DEFAULT_SPREAD,
+                 query_timeout=DEFAULT_QUERY_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES):
+
+        # pylint: disable=too-many-arguments,too-many-locals
 
-    def __init__(self, driver, stop_event=None):
         Thread.__init__(self)
-        self.started_meas = False
 
         self.ss_udp_port = 1206
         self.refl_udp_port = 1205
 
-        self.monitored_path = {}
+        # State of the monitored paths (sessions.SenderSession), with the
+        # SID lists shared by the paths
+        self.sessions = sessions.SessionTable(
+            sessions.SenderSession.COUNTERS)
+        # Monitored paths, indexed by the key of their SID list
+        self.monitored_paths = {}
+        # Index of the monitored paths by the key of their return SID
+        # list, used to match the received responses
+        self.return_paths = {}
 
         # self.lock = Thread.Lock()
 
-        self.interval = 15
-        self.margin = timedelta(milliseconds=3000)
-        self.num_color = 2
+        # Color options. The active color is shared by all the eBPF flows,
+        # so the color changes every 'interval' seconds for all the paths.
+        # The paths can be measured with a longer interval, which must be
+        # a multiple of this one. The driver must support at least
+        # 'num_color' colors
+        self.interval = interval
+        self.margin = timedelta(milliseconds=margin)
+        self.num_color = num_color
         self.hwadapter = driver
-        self.scheduler = sched.scheduler(time.time, time.sleep)
+        # Counters of the closed intervals, read once after each change
+        # of color and used to build the queries and the measurements
+        self.counter_snapshots = snapshots.CounterSnapshots(driver)
+        # Reference clock (clock.ClockOffsetEstimator) giving the instants
+        # of the changes of color. If None, the local clock is used
+        self.clock = clock
+        # Adaptive margin (clock.AdaptiveMargin). If set, the measurements
+        # are sent after the adaptive margin, capped by the margin of the
+        # path
+        self.margin_controller = margin_controller
+        # Log (measlog.MeasurementLog) storing the measurement data of
+        # every interval. If None, the data are only kept in memory
+        self.measlog = measlog
+        # Lock of the log, since the responses can be handled by several
+        # workers of the receiver
+        self.measlog_lock = Lock()
+        # The events are scheduled on the reference clock
+        self.scheduler = sched.scheduler(self.now, time.sleep)
+        # The measurements of the sessions are spread over the safe window
+        # of the interval, on a timing wheel driven by the scheduler
+        self.measure_scheduler = stagger.MeasurementScheduler(
+            self.scheduler, self.now, spread)
+        # Windows of the queries waiting for a response (seqwindow). A
+        # query without a response after 'query_timeout' seconds is
+        # retransmitted, up to 'max_retries' times, if the response can
+        # still arrive before the deadline of the measurement. Otherwise
+        # it is counted as lost. A timeout of None disables the timeouts
+        self.windows = seqwindow.SequenceWindows(self.sessions)
+        self.query_timeout = query_timeout
+        self.max_retries = max_retries
+        # Lock of the windows, updated by the scheduler and by the workers
+        # of the receiver
+        self.window_lock = Lock()
         # self.start_meas('fcff:3::1/fcff:4::1/fcff:5::1','fcff:4::1/fcff:3::1/fcff:2::1','#test')
 
+        # Timestamping mode (software or hardware) used to measure the
+        # delay. If None, the queries do not carry timestamps
+        self.tx_socket = timestamps.TimestampingSocket(timestamping) \
+            if timestamping is not None else None
+
+        # State file (checkpoint.SessionCheckpoint) used to resume the
+        # sessions after a restart. If None, the sessions are not stored
+        self.checkpoint = checkpoint
+
         self.stop_event = stop_event
 
     # def send_meas_data_to_controller(self):     # TODO fix hardcoded params
@@ -435,61 +815,184 @@ class SessionSender(Thread):
     # ''' Thread Tasks'''
 
     def run(self):
-        """Entry point for the thread, schedule the first change color event
-        and the first measurement event"""
+        """Entry point for the thread, schedule the first change color event,
+        which in turn schedules the measurement events"""
 
         # enter(delay, priority, action, argument=(), kwargs={})
         print('SessionSender start')
         # Starting changeColor task
-        cc_time = time.mktime(self.get_nexttime_to_change_color().timetuple())
-        self.scheduler.enterabs(cc_time, 1, self.run_change_color)
-        # Starting measure task
-        dm_time = time.mktime(self.get_nexttime_to_measure().timetuple())
-        self.scheduler.enterabs(dm_time, 1, self.run_measure)
+        cc_time = self.get_nexttime_to_change_color().timestamp()
+        self.scheduler.enterabs(cc_time, 1, self.run_change_color,
+                                (cc_time,))
         self.scheduler.run()
         print('SessionSender stop')
 
-    def run_change_color(self):
-        """Change color and schedule next change color event"""
+    def run_change_color(self, cc_time=None):
+        """Change color, schedule the measurements of the interval just
+        closed and schedule next change color event"""
 
+        num_interval = self.get_num_interval()
         if self.started_meas:
             # print(datetime.now(), 'SS run_change_color meas:',
             #       self.started_meas)
-            color = self.get_color()
-            self.hwadapter.set_color(color)
+            self.change_color(num_interval % self.num_color)
+            if self.margin_controller is not None and cc_time is not None:
+                # The packets sent after the scheduled instant are still
+                # marked with the old color
+                self.margin_controller.record_lateness(self.now() - cc_time)
+            margins = self.schedule_snapshot(num_interval)
+            self.schedule_measures(num_interval, margins)
 
         if self.stop_event is not None and self.stop_event.is_set():
             print('Terminating run_change_color')
         else:
-            cc_time = time.mktime(
-                self.get_nexttime_to_change_color().timetuple())
-            self.scheduler.enterabs(cc_time, 1, self.run_change_color)
+            cc_time = self.get_nexttime_to_change_color().timestamp()
+            self.scheduler.enterabs(cc_time, 1, self.run_change_color,
+                                    (cc_time,))
+
+    def change_color(self, color):
+        """Set the active color of the driver"""
+
+        self.hwadapter.set_color(color)
+
+    def schedule_snapshot(self, num_interval):
+        """Schedule the snapshot of the counters of the interval just
+        closed. The counters of a path are read at the end of its margin,
+        when the packets marked with the closed color have been counted,
+        so the paths are grouped by margin and each group has its own
+        snapshot. Return the margin (in seconds) of each path, by key"""
+
+        closed_interval = num_interval - 1
+        flip_time = closed_interval * self.interval
+        margins = {}
+        groups = {}
+        for monitored_path in list(self.monitored_paths.values()):
+            margin = self.get_margin(monitored_path).total_seconds()
+            margins[monitored_path['key']] = margin
+            groups.setdefault(margin, []).append(monitored_path)
+        for margin, monitored_paths in groups.items():
+            # The priority is lower than the one of the event running the
+            # measurements (see stagger), so a measurement starting at the
+            # end of the margin is sent after the snapshot
+            self.scheduler.enterabs(flip_time + margin, 0, self.run_snapshot,
+                                    (closed_interval, monitored_paths))
+        return margins
+
+    def run_snapshot(self, closed_interval, monitored_paths):
+        """Read the counters of a closed interval for some paths"""
+
+        flows = []
+        for monitored_path in monitored_paths:
+            flows.append((snapshots.DIRECTION_TX, monitored_path['sidlist']))
+            flows.append((snapshots.DIRECTION_RX,
+                          monitored_path['returnsidlist']))
+        self.counter_snapshots.take(
+            closed_interval, closed_interval % self.num_color, flows)
+
+    def schedule_measures(self, num_interval, margins=None):
+        """Schedule a measurement event for each monitored path whose
+        measurement interval has just been closed. The measurement of a
+        path is sent in the safe window between the end of its margin and
+        the last safe read of the closed color, i.e. the change of color
+        which reuses it minus the margin, at the point of the window
+        assigned to the path (see stagger). 'margins' are the margins of
+        the paths used by their snapshot, so that the window never starts
+        before it"""
+
+        # The interval just closed started at 'flip_time - self.interval'
+        closed_interval = num_interval - 1
+        flip_time = closed_interval * self.interval
+        block_number = closed_interval % self.num_color
+        # Iterate on a copy, the controller can add or remove paths
+        # while we are scheduling the measurements
+        for monitored_path in list(self.monitored_paths.values()):
+            if closed_interval % monitored_path['intervalRatio'] != 0:
+                continue
+            margin = margins.get(monitored_path['key']) \
+                if margins is not None else None
+            if margin is None:
+                # Path added after the snapshot
+                margin = self.get_margin(monitored_path).total_seconds()
+            deadline = (flip_time + (self.num_color - 1) * self.interval -
+                        margin)
+            dm_time = self.measure_scheduler.measure_time(
+                monitored_path['key'], flip_time + margin, deadline)
+            self.measure_scheduler.schedule(
+                dm_time, deadline, self.run_measure,
+                (monitored_path, block_number, deadline))
+
+    @property
+    def started_meas(self):
+        """True if there is at least one running measurement process"""
+
+        return len(self.monitored_paths) > 0
+
+    def run_measure(self, monitored_path, block_number, deadline=None):
+        """Send a TWAMP query for a monitored path"""
+
+        # The path could have been stopped after scheduling the measurement
+        if self.monitored_paths.get(monitored_path['key']) is monitored_path:
+            # print(datetime.now(),'SS run_measure meas:',self.started_meas)
+            self.send_twamp_test_query(monitored_path, block_number,
+                                       deadline)
 
-    def run_measure(self):
-        """Send a TWAMP query and schedule next measurement event"""
+    def run_query_timeout(self, monitored_path, seq_num, block_number,
+                          deadline, retries):
+        """Called when the timeout of a query expires. Retransmit the
+        query if its response can still arrive before the deadline of the
+        measurement, otherwise count the query as lost"""
 
-        if self.started_meas:
-            # print(datetime.now(),'SS run_measure meas:',self.started_meas)
-            self.send_twamp_test_query()
+        # pylint: disable=too-many-arguments
 
-        # Schedule next measure
-        if self.stop_event is not None and self.stop_event.is_set():
-            print('Terminating run_measure')
-        else:
-            dm_time = time.mktime(self.get_nexttime_to_measure().timetuple())
-            self.scheduler.enterabs(dm_time, 1, self.run_measure)
+        if self.monitored_paths.get(monitored_path['key']) \
+                is not monitored_path:
+            return
+        retransmit = (retries < self.max_retries and deadline is not None and
+                      self.now() + self.query_timeout <= deadline)
+        with self.window_lock:
+            if not self.windows.is_pending(monitored_path.index, seq_num):
+                # Answered in time
+                return
+            if not retransmit:
+                self.windows.expire(monitored_path.index, seq_num)
+                monitored_path['lostQueries'] += 1
+        if not retransmit:
+            print('SS - QUERY LOST SL {sl} - SN {sn}'.format(
+                sl=monitored_path['sidlistgrpc'], sn=seq_num))
+            return
+        monitored_path['retransmissions'] += 1
+        # The query carries the same sequence number and color, so the
+        # counters are the ones of the same closed interval and a
+        # reflector which already answered it sends the same response
+        self.send_twamp_test_query(monitored_path, block_number, deadline,
+                                   seq_num, retries + 1)
+
+    def get_return_path(self, sid_list):
+        """Return the monitored path of a response received on a SID list
+        or None. The response travels on the return SID list of the path"""
+
+        nopunt_sid_list = utils.rem_punt(
+            sid_list)[::-1]  # no punt and reversed
+        return self.return_paths.get(utils.sid_list_key(nopunt_sid_list))
 
     # ''' TWAMP methods '''
 
-    def send_twamp_test_query(self):
-        """Send a TWAMP query to a reflector"""
+    def send_twamp_test_query(self, monitored_path, block_number=None,
+                              deadline=None, seq_num=None, retries=0):
+        """Send a TWAMP query to a reflector. 'deadline' is the instant by
+        which the response is needed, used to decide whether the query
+        can be retransmitted. If 'seq_num' is given, the query is the
+        retransmission of the query with that sequence number"""
+
+        # pylint: disable=too-many-arguments,too-many-locals
 
-        print('sid ist', self.monitored_path)
         # Get the counter for the color of the previuos interval
-        sender_block_number = self.get_prev_color()
-        sender_transmit_counter = self.hwadapter.read_tx_counter(
-            sender_block_number, self.monitored_path['sidlist'])
-        list_rev = list(self.monitored_path['sidlistrev'])
+        sender_block_number = block_number \
+            if block_number is not None else self.get_prev_color()
+        sender_transmit_counter = self.read_counter(
+            snapshots.DIRECTION_TX, sender_block_number,
+            monitored_path['sidlist'])
+        list_rev = list(monitored_path['sidlistrev'])
         mod_sidlist = utils.set_punt(list_rev)
 
         ipv6_packet = IPv6()
@@ -519,7 +1022,9 @@ class SessionSender(Thread):
 
         # in band response TODO gestire out band nel controller
         sender_control_code = 1
-        sender_seq_num = self.monitored_path['txSequenceNumber']
+        retransmission = seq_num is not None
+        sender_seq_num = seq_num if retransmission \
+            else monitored_path['txSequenceNumber']
 
         twamp_data = twamp.TWAMPTestQuery(
             SequenceNumber=sender_seq_num,
@@ -527,6 +1032,11 @@ class SessionSender(Thread):
             BlockNumber=sender_block_number,
             SenderControlCode=sender_control_code
         )
+        if self.tx_socket is not None:
+            # The reflector needs the timestamp carried by the query only
+            # to echo it, we use the kernel timestamp taken on transmission
+            twamp_data.T = 1
+            twamp_data.Timestamp = timestamps.to_ntp(time.time())
 
         pkt = (ipv6_packet / srv6_header / ipv6_packet_inside /
                udp_packet / twamp_data)
@@ -538,25 +1048,77 @@ class SessionSender(Thread):
                 sn=sender_seq_num,
                 txc=sender_transmit_counter,
                 col=sender_block_number))
-        send(pkt, count=1, verbose=False)
-
-        # Increase the SN
-        self.monitored_path['txSequenceNumber'] += 1
+        # The query is marked as pending and the SN increased before the
+        # transmission, the response can be handled by a worker of the
+        # receiver before transmit returns
+        with self.window_lock:
+            lost = self.windows.sent(monitored_path.index, sender_seq_num,
+                                     retransmission)
+            if lost > 0:
+                # Pending queries fell out of the window
+                monitored_path['lostQueries'] += lost
+            if not retransmission:
+                monitored_path['txSequenceNumber'] += 1
+        tx_timestamp = self.transmit(pkt)
+        if tx_timestamp is not None:
+            monitored_path['queryTimestamp'] = (sender_seq_num, tx_timestamp)
+        if self.query_timeout is not None:
+            self.measure_scheduler.add_timer(
+                self.now() + self.query_timeout, self.run_query_timeout,
+                (monitored_path, sender_seq_num, sender_block_number,
+                 deadline, retries))
+
+        if not retransmission:
+            self.checkpoint_seq(monitored_path,
+                                monitored_path['txSequenceNumber'])
+
+    def transmit(self, pkt):
+        """Send a packet. Return the kernel timestamp of its transmission,
+        or None if the timestamping is disabled"""
+
+        if self.tx_socket is None:
+            send(pkt, count=1, verbose=False)
+            return None
+        return self.tx_socket.send(bytes(pkt), pkt[IPv6].dst)
 
     def recv_twamp_response(self, packet):
-        """Called when a TWAMP response is received from a reflector"""
+        """Called when a TWAMP response is received from a reflector.
+        Return the monitored path updated by the response or None if the
+        response does not belong to any monitored path"""
+
+        # pylint: disable=too-many-statements
 
-        # TODO controllare che la sidlist è quella che sto monitorando
-        # (levando il punt)
         srh = packet[IPv6ExtHdrSegmentRouting]
         sid_list = srh.addresses
         resp = packet[twamp.TWAMPTestResponse]
 
+        monitored_path = self.get_return_path(sid_list)
+        if monitored_path is None:
+            print('SS - RECV RESP for unknown SL {sl}'.format(sl=sid_list))
+            return None
+
+        # Match the response with its query. The late responses, the
+        # duplicates (e.g. the answers to both a query and its
+        # retransmission) and the answers to queries never sent are
+        # counted and discarded: the counters they carry may belong to an
+        # interval already measured, or to no interval at all
+        with self.window_lock:
+            status = self.windows.acknowledge(
+                monitored_path.index, resp.SenderSequenceNumber,
+                monitored_path['txSequenceNumber'])
+            discarded = DISCARDED_RESPONSES.get(status)
+            if discarded is not None:
+                monitored_path[discarded[0]] += 1
+        if discarded is not None:
+            print('SS - RECV {kind} RESP SL {sl} - SN {sn}'.format(
+                kind=discarded[1], sl=sid_list,
+                sn=resp.SenderSequenceNumber))
+            return None
+
         # Read the RX counter FW path
-        nopunt_sid_list = utils.rem_punt(
-            sid_list)[::-1]  # no punt and reversed
-        ss_receive_counter = self.hwadapter.read_rx_counter(
-            resp.BlockNumber, nopunt_sid_list)
+        ss_receive_counter = self.read_counter(
+            snapshots.DIRECTION_RX, resp.BlockNumber,
+            monitored_path['returnsidlist'])
 
         print('SS - RECV QUERY SL {sl} '.format(sl=sid_list))
         print('---          FW: SN {sn} - TX {tx} - RX {rx} - C {col} '.format(
@@ -570,71 +1132,358 @@ class SessionSender(Thread):
             rx=ss_receive_counter,
             col=resp.BlockNumber))
 
-        self.monitored_path['lastMeas']['sssn'] = resp.SenderSequenceNumber
-        self.monitored_path['lastMeas']['ssTXc'] = resp.SenderCounter
-        self.monitored_path['lastMeas']['rfRXc'] = resp.ReceiveCounter
-        self.monitored_path['lastMeas']['fwColor'] = resp.SenderBlockNumber
-        self.monitored_path['lastMeas']['rfsn'] = resp.SequenceNumber
-        self.monitored_path['lastMeas']['rfTXc'] = resp.TransmitCounter
-        self.monitored_path['lastMeas']['ssRXc'] = ss_receive_counter
-        self.monitored_path['lastMeas']['rvColor'] = resp.BlockNumber
+        # The measurement data are double-buffered: the response fills
+        # the back buffer, which is then swapped with the front one, so
+        # get_meas never returns data mixed from two intervals
+        meas_index = monitored_path['measIndex'] ^ 1
+        meas_buffers = monitored_path['measBuffers']
+        if meas_buffers is None:
+            # The buffers are allocated by the first response of the path
+            meas_buffers = [{}, {}]
+            monitored_path['measBuffers'] = meas_buffers
+        meas = meas_buffers[meas_index]
+        meas['sssn'] = resp.SenderSequenceNumber
+        meas['ssTXc'] = resp.SenderCounter
+        meas['rfRXc'] = resp.ReceiveCounter
+        meas['fwColor'] = resp.SenderBlockNumber
+        meas['rfsn'] = resp.SequenceNumber
+        meas['rfTXc'] = resp.TransmitCounter
+        meas['ssRXc'] = ss_receive_counter
+        meas['rvColor'] = resp.BlockNumber
+        # The RTT of a retransmitted query is not sampled, the response
+        # could answer any of its copies
+        if resp.T == 1 and status != seqwindow.ACK_RETX:
+            self.compute_delays(monitored_path, resp, float(packet.time), meas)
+            if monitored_path['rttHistogram'] is None:
+                # Allocated by the first response carrying timestamps
+                monitored_path['rttHistogram'] = histogram.DelayHistogram()
+            monitored_path['rttHistogram'].record(meas['rtt'])
+            if self.margin_controller is not None:
+                self.margin_controller.record_rtt(meas['rtt'] / 1e9)
+            print('---          DELAY: RTT {rtt} - FW {fw} - RV {rv}'.format(
+                rtt=meas['rtt'], fw=meas['fwDelay'], rv=meas['rvDelay']))
+        else:
+            # The buffer could contain the delays of an older response
+            for field in ('rtt', 'fwDelay', 'rvDelay'):
+                meas.pop(field, None)
+        # Distribution of the RTT since the start of the measurement
+        if monitored_path['rttHistogram'] is not None:
+            meas.update(monitored_path['rttHistogram'].summary('rtt'))
+        else:
+            meas['rttCount'] = 0
+        monitored_path['measIndex'] = meas_index
+        monitored_path['lastMeas'] = meas
+        if self.measlog is not None:
+            with self.measlog_lock:
+                self.measlog.append(self.now(), monitored_path['meas_id'],
+                                    meas)
+
+        return monitored_path
+
+    @staticmethod
+    def compute_delays(monitored_path, resp, rx_timestamp, meas):
+        """Compute the round-trip time and the one-way delays (in
+        nanoseconds) from the timestamps of a response. The one-way delays
+        are meaningful only if the clocks of the nodes are synchronized"""
+
+        seq_num, tx_timestamp = monitored_path.get(
+            'queryTimestamp', (None, None))
+        if seq_num != resp.SenderSequenceNumber:
+            # No kernel timestamp for the query, use the one it carried
+            tx_timestamp = timestamps.from_ntp(resp.SenderTimestamp)
+        rf_rx_timestamp = timestamps.from_ntp(resp.ReceiveTimestamp)
+        rf_tx_timestamp = timestamps.from_ntp(resp.Timestamp)
+        # The time spent in the reflector is not part of the RTT
+        meas['rtt'] = int(round(((rx_timestamp - tx_timestamp) -
+                                 (rf_tx_timestamp - rf_rx_timestamp)) * 1e9))
+        meas['fwDelay'] = int(round((rf_rx_timestamp - tx_timestamp) * 1e9))
+        meas['rvDelay'] = int(round((rx_timestamp - rf_tx_timestamp) * 1e9))
 
     # ''' Interface for the controller'''
 
-    def start_meas(self, meas_id, sid_list, rev_sid_list):
-        """Start a measurement process"""
+    def start_meas(self, meas_id, sid_list, rev_sid_list, interval=None,
+                   margin=None):
+        """Start a measurement process. The interval (in seconds) and the
+        margin (in milliseconds) default to the ones of the sender"""
 
-        if self.started_meas:
+        # pylint: disable=too-many-arguments
+
+        key = utils.sid_list_key(sid_list.split('/'))
+        if key in self.monitored_paths:
             return -1  # already started
         print('SESSION SENDER: Start Meas for ' + sid_list)
 
-        self.monitored_path['meas_id'] = meas_id
-        self.monitored_path['sidlistgrpc'] = sid_list
-        self.monitored_path['sidlist'] = sid_list.split('/')
-        self.monitored_path['sidlistrev'] = \
-            self.monitored_path['sidlist'][::-1]
-        self.monitored_path['returnsidlist'] = rev_sid_list.split('/')
-        self.monitored_path['returnsidlistrev'] = \
-            self.monitored_path['returnsidlist'][::-1]
-        self.monitored_path['meas_counter'] = 1  # reset counter
-        self.monitored_path['txSequenceNumber'] = 1
-        self.monitored_path['lastMeas'] = {}
-
-        self.hwadapter.set_sidlist_out(self.monitored_path['sidlist'])
-        self.hwadapter.set_sidlist_in(self.monitored_path['returnsidlist'])
-        self.started_meas = True
+        interval = self.interval if interval is None else interval
+        margin = self.margin if margin is None \
+            else timedelta(milliseconds=margin)
+        interval_ratio = self.check_color_options(interval, margin)
+        if interval_ratio is None:
+            return -1  # invalid color options
+
+        monitored_path = self.build_monitored_path(
+            key, meas_id, sid_list.split('/'), rev_sid_list.split('/'),
+            interval, interval_ratio, margin)
+
+        self.hwadapter.set_sidlist_out(monitored_path['sidlist'])
+        self.hwadapter.set_sidlist_in(monitored_path['returnsidlist'])
+        self.add_monitored_path(monitored_path)
         return 1  # mettere in un try e semmai tronare errore
 
+    def start_meas_many(self, paths, interval=None, margin=None):
+        """Start a batch of measurement processes with the same color
+        options. 'paths' is a list of (meas_id, SID list, return SID list)
+        tuples, where the SID lists are lists of SIDs or strings of SIDs
+        separated by slashes. Return the list of the status codes of the
+        paths (STATUS_*)"""
+
+        # pylint: disable=too-many-locals
+
+        interval = self.interval if interval is None else interval
+        margin = self.margin if margin is None \
+            else timedelta(milliseconds=margin)
+        interval_ratio = self.check_color_options(interval, margin)
+        if interval_ratio is None:
+            return [STATUS_INVALID_OPTIONS] * len(paths)
+
+        statuses, valid = validate_paths(
+            [(sid_list, rev_sid_list) for _, sid_list, rev_sid_list in paths],
+            self.monitored_paths)
+        flows = []
+        for _, _, sid_list, rev_sid_list in valid:
+            flows.append((snapshots.DIRECTION_TX, sid_list))
+            flows.append((snapshots.DIRECTION_RX, rev_sid_list))
+        added = self.hwadapter.set_flows(flows)
+        rollback = []
+        for idx, (index, key, sid_list, rev_sid_list) in enumerate(valid):
+            if not (added[2 * idx] and added[2 * idx + 1]):
+                # Remove the flow of the other direction, if added
+                rollback.extend(flow for flow, flow_added in
+                                zip(flows[2 * idx:2 * idx + 2],
+                                    added[2 * idx:2 * idx + 2])
+                                if flow_added)
+                statuses[index] = STATUS_DRIVER_ERROR
+                continue
+            monitored_path = self.build_monitored_path(
+                key, paths[index][0], sid_list, rev_sid_list, interval,
+                interval_ratio, margin)
+            self.add_monitored_path(monitored_path)
+        if rollback:
+            self.hwadapter.rem_flows(rollback)
+        print('SESSION SENDER: Started {num} of {total} paths'.format(
+            num=statuses.count(STATUS_OK), total=len(paths)))
+        return statuses
+
     def stop_meas(self, sid_list):
         """Stop a measurement process"""
 
         print('SESSION SENDER: Stop Meas for ' + sid_list)
 
-        self.started_meas = False
-        self.hwadapter.rem_sidlist_out(self.monitored_path['sidlist'])
-        self.hwadapter.rem_sidlist_in(self.monitored_path['returnsidlist'])
-        self.monitored_path = {}
+        monitored_path = self.remove_monitored_path(
+            utils.sid_list_key(sid_list.split('/')))
+        if monitored_path is None:
+            return -1  # not started
+        self.hwadapter.rem_sidlist_out(monitored_path['sidlist'])
+        self.hwadapter.rem_sidlist_in(monitored_path['returnsidlist'])
         # Clear color options
         # self.interval = None
         # self.margin = None
         # self.num_color = None
         return 1  # mettere in un try e semmai tronare errore
 
+    def stop_meas_many(self, sid_lists):
+        """Stop a batch of measurement processes. 'sid_lists' is a list of
+        SID lists, given as lists of SIDs or as strings of SIDs separated
+        by slashes. Return the list of the status codes of the SID lists
+        (STATUS_*)"""
+
+        statuses, removed = remove_paths(sid_lists,
+                                         self.remove_monitored_path)
+        flows = []
+        for _, _, monitored_path in removed:
+            flows.append((snapshots.DIRECTION_TX, monitored_path['sidlist']))
+            flows.append((snapshots.DIRECTION_RX,
+                          monitored_path['returnsidlist']))
+        if flows:
+            self.hwadapter.rem_flows(flows)
+        print('SESSION SENDER: Stopped {num} of {total} paths'.format(
+            num=statuses.count(STATUS_OK), total=len(sid_lists)))
+        return statuses
+
+    def build_monitored_path(self, key, meas_id, sid_list, rev_sid_list,
+                             interval, interval_ratio, margin):
+        """Build the state of a path measured by the sender. The path
+        takes an id in the table of the sessions, released by
+        remove_monitored_path"""
+
+        # pylint: disable=too-many-arguments
+
+        return sessions.SenderSession(
+            self.sessions, key, meas_id, sid_list, rev_sid_list, interval,
+            interval_ratio, margin)
+
+    def add_monitored_path(self, monitored_path):
+        """Add a path, whose eBPF flows are already installed, to the
+        measured ones and store it in the checkpoint"""
+
+        self.return_paths[
+            utils.sid_list_key(monitored_path['returnsidlist'])
+        ] = monitored_path
+        self.monitored_paths[monitored_path['key']] = monitored_path
+        if self.checkpoint is not None:
+            monitored_path['checkpointSlot'] = self.checkpoint.store(
+                '/'.join(monitored_path['sidlist']),
+                '/'.join(monitored_path['returnsidlist']),
+                monitored_path['interval'],
+                monitored_path['margin'].total_seconds() * 1000,
+                self.num_color, meas_id=monitored_path['meas_id'],
+                seq_num=monitored_path['txSequenceNumber'])
+
+    def remove_monitored_path(self, key):
+        """Remove a path from the measured ones and from the checkpoint.
+        Return the path, or None if it is not measured. The eBPF flows are
+        removed by the caller"""
+
+        monitored_path = self.monitored_paths.pop(key, None)
+        if monitored_path is None:
+            return None
+        self.return_paths.pop(
+            utils.sid_list_key(monitored_path['returnsidlist']), None)
+        if monitored_path.get('checkpointSlot') is not None:
+            self.checkpoint.clear(monitored_path['checkpointSlot'])
+        self.sessions.remove(monitored_path)
+        return monitored_path
+
     def get_meas(self, sid_list):
-        """Return the collected measurement data for a running process"""
+        """Return the collected measurement data for a running process.
+        Raise KeyError if there is no process running on the SID list"""
 
         print('SESSION SENDER: Get Meas Data for ' + sid_list)
-        # TODO controllare la sid_list e rilanciate un eccezione
-        return self.monitored_path['lastMeas'], self.monitored_path['meas_id']
+        monitored_path = self.monitored_paths[
+            utils.sid_list_key(sid_list.split('/'))]
+        # No data until the first response
+        meas = dict(monitored_path['lastMeas'] or {})
+        # Queries lost and retransmitted, late and duplicate responses
+        # since the start of the measurement
+        for field in seqwindow.STATS:
+            meas[field] = monitored_path[field]
+        return meas, monitored_path['meas_id']
+
+    def get_delay_histogram(self, sid_list=None):
+        """Return a copy of the RTT histogram of a running process, or the
+        histogram of all the running processes if sid_list is None"""
+
+        if sid_list is not None:
+            monitored_paths = [self.monitored_paths[
+                utils.sid_list_key(sid_list.split('/'))]]
+        else:
+            monitored_paths = list(self.monitored_paths.values())
+        rtt_histogram = histogram.DelayHistogram()
+        for monitored_path in monitored_paths:
+            if monitored_path['rttHistogram'] is not None:
+                rtt_histogram.merge(monitored_path['rttHistogram'])
+        return rtt_histogram
+
+    def restore_sessions(self):
+        """Resume the sessions stored in the checkpoint by the previous
+        instance of the daemon. Return the number of resumed sessions"""
+
+        if self.checkpoint is None:
+            return 0
+        resumed = 0
+        for record in self.checkpoint.load():
+            res = self.start_meas(record['meas_id'], record['sid_list'],
+                                  record['rev_sid_list'],
+                                  interval=record['interval'],
+                                  margin=record['margin'])
+            # start_meas has stored the session in a new record
+            self.checkpoint.clear(record['slot'])
+            if res != 1:
+                continue
+            # Resume the sequence numbers where the previous instance
+            # stopped, so the reflector sees no gaps
+            monitored_path = self.monitored_paths[
+                utils.sid_list_key(record['sid_list'].split('/'))]
+            monitored_path['txSequenceNumber'] = record['seq_num']
+            self.checkpoint_seq(monitored_path, record['seq_num'])
+            resumed += 1
+        print('SESSION SENDER: Resumed {num} sessions'.format(num=resumed))
+        return resumed
 
     # ''' Utility methods '''
 
+    def check_color_options(self, interval, margin):
+        """Check the color options of a path. Return the ratio between
+        the interval of the path and the one of the sender, or None if
+        the options are not valid"""
+
+        interval_ratio = int(round(interval / self.interval))
+        if not utils.is_multiple(interval, self.interval):
+            print('SESSION SENDER: the interval must be a multiple of '
+                  '{interval} s'.format(interval=self.interval))
+            return None
+        # Consecutive measurements of a path must read different colors,
+        # otherwise some colors are never measured
+        if math.gcd(interval_ratio, self.num_color) != 1:
+            print('SESSION SENDER: the interval ratio {ratio} must be '
+                  'coprime with the number of colors {num_color}'
+                  .format(ratio=interval_ratio, num_color=self.num_color))
+            return None
+        # The counters must be read before the color is used again: the
+        # safe window, from the margin after the change of color to the
+        # margin before the color is reused, must not be empty
+        max_margin = (self.num_color - 1) * self.interval / 2
+        if margin <= timedelta(0) or margin >= timedelta(seconds=max_margin):
+            print('SESSION SENDER: the margin must be shorter than '
+                  '{max} s'.format(max=max_margin))
+            return None
+        return interval_ratio
+
+    def get_margin(self, monitored_path):
+        """Return the margin of a path, i.e. the adaptive margin capped by
+        the one configured for the path, if the margin is adaptive"""
+
+        if self.margin_controller is None:
+            return monitored_path['margin']
+        margin = self.margin_controller.margin()
+        if margin is None:
+            # No round-trip time observed yet
+            return monitored_path['margin']
+        return min(margin, monitored_path['margin'])
+
+    def checkpoint_seq(self, monitored_path, seq_num):
+        """Store the sequence number of a path in the checkpoint"""
+
+        if monitored_path.get('checkpointSlot') is not None:
+            self.checkpoint.update_seq(monitored_path['checkpointSlot'],
+                                       seq_num)
+
+    def read_counter(self, direction, color, sid_list):
+        """Return a counter of the last closed interval marked with a
+        color, from the snapshot of the interval if it has been taken"""
+
+        num_interval = snapshots.last_interval_of_color(
+            self.get_num_interval(), color, self.num_color)
+        return self.counter_snapshots.read(
+            num_interval, color, direction, sid_list)
+
+    def now(self):
+        """Return the current time of the reference clock (POSIX timestamp
+        in seconds)"""
+
+        if self.clock is None:
+            return time.time()
+        return self.clock.now()
+
+    def get_num_interval(self):
+        """Return the number of the current interval. The interval n
+        starts at (n - 1) * interval and ends at n * interval"""
+
+        return math.floor(self.now() / self.interval) + 1
+
     def get_nexttime_to_change_color(self):
         """Return the next instant of change color"""
 
-        date = datetime.now()
-        date_timestamp = date.timestamp()
-        num_interval = math.ceil(date_timestamp / self.interval)
+        num_interval = self.get_num_interval()
         return datetime.fromtimestamp(num_interval * self.interval)
 
     def get_nexttime_to_measure(self):
@@ -646,17 +1495,13 @@ class SessionSender(Thread):
     def get_color(self):
         """Return the current color"""
 
-        date = datetime.now()
-        date_timestamp = date.timestamp()
-        num_interval = math.ceil(date_timestamp / self.interval)
+        num_interval = self.get_num_interval()
         return num_interval % self.num_color
 
     def get_prev_color(self):
         """Return the previous color"""
 
-        date = datetime.now()
-        date_timestamp = date.timestamp()
-        num_interval = math.ceil(date_timestamp / self.interval)
+        num_interval = self.get_num_interval()
         return (num_interval - 1) % self.num_color
 
 
@@ -666,25 +1511,78 @@ class SessionSender(Thread):
 class SessionReflector(Thread):
     """A class representing a reflector implemented as a thread"""
 
-    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-instance-attributes,too-many-public-methods
+
+    def __init__(self, driver, stop_event=None, interval=DEFAULT_INTERVAL,
+                 margin=DEFAULT_MARGIN, num_color=DEFAULT_NUM_COLOR,
+                 stateless=False, max_auto_paths=DEFAULT_MAX_AUTO_PATHS,
+                 locator_len=DEFAULT_LOCATOR_LEN, checkpoint=None,
+                 admission_control=None, clock=None, timestamping=None):
+
+        # pylint: disable=too-many-arguments
 
-    def __init__(self, driver, stop_event=None):
         Thread.__init__(self)
         self.name = 'SessionReflector'
-        self.started_meas = False
-        self.interval = 15
-        self.margin = timedelta(milliseconds=3000)
-        self.num_color = 2
+        # Timestamping mode (software or hardware) of the socket sending
+        # the responses. If None, the responses are sent with scapy and
+        # their transmission time also counts the time spent by scapy to
+        # send them (about a millisecond), which ends up in the delays
+        self.tx_socket = timestamps.TimestampingSocket(timestamping) \
+            if timestamping is not None else None
+        # Color options, shared by all the paths. They are replaced by
+        # the ones received with start_meas when no path is running
+        self.interval = interval
+        self.margin = timedelta(milliseconds=margin)
+        self.num_color = num_color
 
         self.ss_udp_port = 1206
         self.refl_udp_port = 1205
 
-        self.monitored_path = {}
+        # State of the answered paths (sessions.ReflectorSession), with the
+        # SID lists shared by the paths
+        self.sessions = sessions.SessionTable(
+            sessions.ReflectorSession.COUNTERS)
+        # Monitored paths, indexed by the key of their SID list
+        self.monitored_paths = {}
+
+        # In stateless mode the reflector answers to the queries received
+        # on any SID list. The return path and the counter keys are derived
+        # from the SRH of the query and the eBPF flows are provisioned the
+        # first time a SID list is seen
+        self.stateless = stateless
+        # Paths provisioned on first sight, in least recently used order
+        self.auto_paths = OrderedDict()
+        self.max_auto_paths = max_auto_paths
+        # Return SID lists configured for specific senders, indexed by
+        # the address of the sender. They override the derived ones
+        self.sender_return_paths = {}
+        self.locator_len = locator_len
 
         self.hwadapter = driver
+        # Counters of the closed intervals, read once after each change
+        # of color and used to build the responses
+        self.counter_snapshots = snapshots.CounterSnapshots(driver)
+        # State file (checkpoint.SessionCheckpoint) used to resume the
+        # paths configured by the controller after a restart. The
+        # auto-provisioned paths are not stored
+        self.checkpoint = checkpoint
+        # Admission control of the queries (admission.AdmissionControl),
+        # keyed by the address of the sender and the SID list. It bounds
+        # the work done by the reflector under a storm of queries
+        self.admission_control = admission_control \
+            if admission_control is not None \
+            else admission.AdmissionControl()
+        # Reference clock (clock.ClockOffsetEstimator) giving the instants
+        # of the changes of color. If None, the local clock is used
+        self.clock = clock
+
+        # Lock of the state shared by the sessions (admission control and
+        # auto-provisioned paths), since the queries can be handled by
+        # several workers of the receiver
+        self.lock = Lock()
 
         # per ora non lo uso è per il cambio di colore
-        self.scheduler = sched.scheduler(time.time, time.sleep)
+        self.scheduler = sched.scheduler(self.now, time.sleep)
 
         self.stop_event = stop_event
 
@@ -694,54 +1592,92 @@ class SessionReflector(Thread):
         # enter(delay, priority, action, argument=(), kwargs={})
         print('SessionReflector start')
         # Starting changeColor task
-        cc_time = time.mktime(self.get_nexttime_to_change_color().timetuple())
+        cc_time = self.get_nexttime_to_change_color().timestamp()
         self.scheduler.enterabs(cc_time, 1, self.run_change_color)
         self.scheduler.run()
         print('SessionReflector stop')
 
+    @property
+    def started_meas(self):
+        """True if there is at least one running measurement process"""
+
+        return len(self.monitored_paths) > 0
+
     def run_change_color(self):
         """Change color and schedule next change color event"""
 
-        if self.started_meas:
+        if self.started_meas or self.stateless:
             # print(datetime.now(), 'RF run_change_color meas:',
             #       self.started_meas)
-            color = self.get_color()
-            self.hwadapter.set_color(color)
+            num_interval = self.get_num_interval()
+            self.change_color(num_interval % self.num_color)
+            self.schedule_snapshot(num_interval)
 
         if self.stop_event is not None and self.stop_event.is_set():
             print('Terminating run_change_color')
         else:
-            cc_time = time.mktime(
-                self.get_nexttime_to_change_color().timetuple())
+            cc_time = self.get_nexttime_to_change_color().timestamp()
             self.scheduler.enterabs(cc_time, 1, self.run_change_color)
 
+    def change_color(self, color):
+        """Set the active color of the driver"""
+
+        self.hwadapter.set_color(color)
+
+    def schedule_snapshot(self, num_interval):
+        """Schedule the snapshot of the counters of the interval just
+        closed, at the end of the margin, when the packets marked with the
+        closed color have been counted. The queries of the interval are
+        sent after the margin"""
+
+        closed_interval = num_interval - 1
+        snapshot_time = (closed_interval * self.interval +
+                         self.margin.total_seconds())
+        self.scheduler.enterabs(snapshot_time, 0, self.run_snapshot,
+                                (closed_interval,))
+
+    def run_snapshot(self, closed_interval):
+        """Read the counters of a closed interval for all the paths"""
+
+        flows = []
+        for monitored_path in (list(self.monitored_paths.values()) +
+                               list(self.auto_paths.values())):
+            flows.append((snapshots.DIRECTION_RX, monitored_path['sidlist']))
+            flows.append((snapshots.DIRECTION_TX,
+                          monitored_path['returnsidlist']))
+        self.counter_snapshots.take(
+            closed_interval, closed_interval % self.num_color, flows)
+
     # ''' TWAMP methods '''
 
-    def send_twamp_test_response(self, sid_list, sender_block_color,
-                                 sender_counter, sender_seq_num):
-        """Send a TWAMP response to the sender"""
+    def send_twamp_test_response(self, monitored_path, sender_block_color,
+                                 sender_counter, sender_seq_num,
+                                 sender_timestamp=None, rx_timestamp=None):
+        """Send a TWAMP response to the sender and return it. If the query
+        carried a timestamp, the response carries the timestamps of the
+        reception of the query and of the transmission of the response"""
 
-        # pylint: disable=too-many-locals
+        # pylint: disable=too-many-arguments,too-many-locals
 
         # Read the RX counter FW path
-        nopunt_sid_list = utils.rem_punt(
-            sid_list)[::-1]  # no punt and reversed
-        rf_receive_counter = self.hwadapter.read_rx_counter(
-            sender_block_color, nopunt_sid_list)
+        rf_receive_counter = self.read_counter(
+            snapshots.DIRECTION_RX, sender_block_color,
+            monitored_path['sidlist'])
 
         # Reverse path
         rf_block_number = self.get_prev_color()
-        rf_transmit_counter = self.hwadapter.read_tx_counter(
-            rf_block_number, self.monitored_path['returnsidlist'])
+        rf_transmit_counter = self.read_counter(
+            snapshots.DIRECTION_TX, rf_block_number,
+            monitored_path['returnsidlist'])
 
         ipv6_packet = IPv6()
         # ipv6_packet.src = 'fcff:5::1' #TODO  me li da il controller?
         # ipv6_packet.dst = 'fcff:4::1' #TODO  me li da il controller?
         ipv6_packet.src = 'fcff:8::1'
-        ipv6_packet.dst = self.monitored_path['returnsidlist'][0]
+        ipv6_packet.dst = monitored_path['returnsidlist'][0]
 
         mod_sidlist = utils.set_punt(
-            list(self.monitored_path['returnsidlistrev']))
+            list(monitored_path['returnsidlistrev']))
         srv6_header = IPv6ExtHdrSegmentRouting()
         srv6_header.addresses = mod_sidlist
         # TODO vedere se funziona con NS variabile
@@ -753,14 +1689,14 @@ class SessionReflector(Thread):
         # ipv6_packet_inside.src = 'fcff:5::1' #TODO  me li da il controller?
         # ipv6_packet_inside.dst = 'fcff:2::1' #TODO  me li da il controller?
         ipv6_packet_inside.src = 'fcff:8::1'
-        ipv6_packet_inside.dst = self.monitored_path['returnsidlist'][-1]
+        ipv6_packet_inside.dst = monitored_path['returnsidlist'][-1]
 
         udp_packet = UDP()
         udp_packet.dport = self.ss_udp_port
         udp_packet.sport = self.refl_udp_port
 
         # Response sequence number
-        rf_sequence_number = self.monitored_path['revTxSequenceNumber']
+        rf_sequence_number = monitored_path['revTxSequenceNumber']
 
         # Response control code
         rf_receiver_control_code = 0
@@ -776,12 +1712,22 @@ class SessionReflector(Thread):
             ReceverControlCode=rf_receiver_control_code
         )
 
+        if sender_timestamp is not None:
+            twamp_data.T = 1
+            twamp_data.ReceiveTimestamp = timestamps.to_ntp(rx_timestamp)
+            twamp_data.SenderTimestamp = sender_timestamp
+            # Overwritten by transmit just before the packet is written to
+            # the timestamping socket
+            twamp_data.Timestamp = timestamps.to_ntp(time.time())
+
         pkt = (ipv6_packet / srv6_header / ipv6_packet_inside / udp_packet /
                twamp_data)
 
-        send(pkt, count=1, verbose=False)
+        self.transmit(pkt)
         # Increse the SequenceNumber
-        self.monitored_path['revTxSequenceNumber'] += 1
+        monitored_path['revTxSequenceNumber'] += 1
+        self.checkpoint_seq(monitored_path,
+                            monitored_path['revTxSequenceNumber'])
 
         print(
             'RF - SEND RESP SL {sl} - SN {sn} - TXC {txc} - C {col} - RC {rc}'
@@ -791,25 +1737,89 @@ class SessionReflector(Thread):
                 txc=rf_transmit_counter,
                 col=rf_block_number,
                 rc=rf_receive_counter))
+        return pkt
 
     def recv_twamp_test_query(self, packet):
         """Called when a TWAMP query is received from a sender"""
 
-        # TODO controllare che la sidlist è quella che sto monitorando
-        # (levando il punt)
         srh = packet[IPv6ExtHdrSegmentRouting]
         sid_list = srh.addresses
         query = packet[twamp.TWAMPTestQuery]
+
+        # Match the query against the monitored paths (levando il punt)
+        nopunt_sid_list = utils.rem_punt(
+            sid_list)[::-1]  # no punt and reversed
+        key = utils.sid_list_key(nopunt_sid_list)
+
+        # Admission control, before any counter is read or any path is
+        # provisioned. A duplicate of a query already answered in this
+        # interval (e.g. a retransmission) gets the same response again
+        sender_key = (packet[IPv6].src, key)
+        query_id = (self.get_num_interval(), query.BlockNumber,
+                    query.SequenceNumber)
+        # The admission control and the auto-provisioned paths are shared
+        # by all the sessions, which can be handled by several workers
+        with self.lock:
+            decision = self.admission_control.admit(sender_key, query_id)
+            response = self.admission_control.get_response(sender_key) \
+                if decision == admission.COALESCE else None
+        if decision == admission.DROP:
+            return
+        if decision == admission.COALESCE:
+            self.transmit(response)
+            return
+
         print('RF - RECV QUERY SL {sl} - SN {sn} - TXC {txc} - C {col}'.format(
             sl=sid_list,
             sn=query.SequenceNumber,
             txc=query.TransmitCounter,
             col=query.BlockNumber))
 
-        self.send_twamp_test_response(
-            sid_list, query.BlockNumber,
-            query.TransmitCounter, query.SequenceNumber
+        monitored_path = self.monitored_paths.get(key)
+        if monitored_path is None and self.stateless:
+            with self.lock:
+                monitored_path = self.get_auto_path(
+                    key, nopunt_sid_list, packet[IPv6].src)
+        if monitored_path is None:
+            print('RF - RECV QUERY for unknown SL {sl}'.format(sl=sid_list))
+            return
+
+        # The reception time of the query is the kernel timestamp recorded
+        # by the socket that captured the packet
+        has_timestamp = query.T == 1
+        pkt = self.send_twamp_test_response(
+            monitored_path, query.BlockNumber,
+            query.TransmitCounter, query.SequenceNumber,
+            sender_timestamp=query.Timestamp if has_timestamp else None,
+            rx_timestamp=float(packet.time) if has_timestamp else None
         )
+        with self.lock:
+            self.admission_control.store_response(sender_key, query_id, pkt)
+
+    def get_admission_stats(self):
+        """Return the counters of the admission control of the queries"""
+
+        return self.admission_control.stats()
+
+    def transmit(self, pkt):
+        """Send a packet. With a timestamping socket, the transmission time
+        carried by a response is taken just before the packet is written
+        to the socket (see timestamps.TimestampingSocket.send)"""
+
+        if self.tx_socket is None:
+            send(pkt, count=1, verbose=False)
+            return
+        data = bytes(pkt)
+        if twamp.TWAMPTestResponse not in pkt or \
+                pkt[twamp.TWAMPTestResponse].T != 1:
+            self.tx_socket.send(data, pkt[IPv6].dst)
+            return
+        # The response is the last layer of the packet
+        response_offset = len(data) - len(pkt[twamp.TWAMPTestResponse])
+        self.tx_socket.send(
+            data, pkt[IPv6].dst,
+            stamp_offset=response_offset + twamp.RESPONSE_TIMESTAMP_OFFSET,
+            udp_offset=response_offset - len(UDP()))
 
     # ''' Interface for the controller'''
 
@@ -817,58 +1827,316 @@ class SessionReflector(Thread):
             self,
             sid_list,
             rev_sid_list,
-            interval=10,
-            margin=5,
-            num_color=2):
-        """Start a measurement process"""
+            interval=DEFAULT_INTERVAL,
+            margin=DEFAULT_MARGIN,
+            num_color=DEFAULT_NUM_COLOR):
+        """Start a measurement process. The interval is in seconds and the
+        margin is in milliseconds"""
 
         # pylint: disable=too-many-arguments
 
-        if self.started_meas:
+        key = utils.sid_list_key(sid_list.split('/'))
+        if key in self.monitored_paths:
             return -1  # already started
         print('REFLECTOR: Start Meas for ' + sid_list)
 
-        self.monitored_path['sidlistgrpc'] = sid_list
-        self.monitored_path['sidlist'] = sid_list.split('/')
-        self.monitored_path['sidlistrev'] = \
-            self.monitored_path['sidlist'][::-1]
-        self.monitored_path['returnsidlist'] = rev_sid_list.split('/')
-        self.monitored_path['returnsidlistrev'] = \
-            self.monitored_path['returnsidlist'][::-1]
-        self.monitored_path['revTxSequenceNumber'] = 0
-        # Set color options
-        self.interval = interval
-        self.margin = timedelta(milliseconds=margin)
-        self.num_color = num_color
-        # pprint.pprint(self.monitored_path)
-        self.hwadapter.set_sidlist_in(self.monitored_path['sidlist'])
-        self.hwadapter.set_sidlist_out(self.monitored_path['returnsidlist'])
-        self.started_meas = True
+        # A path configured by the controller replaces the auto-provisioned
+        # one, whose return path could be different
+        if key in self.auto_paths:
+            self.evict_auto_path(key)
+
+        if not self.set_color_options(interval, margin, num_color):
+            return -1
+
+        monitored_path = self.build_monitored_path(
+            sid_list.split('/'), rev_sid_list.split('/'))
+        # pprint.pprint(monitored_path)
+        self.hwadapter.set_sidlist_in(monitored_path['sidlist'])
+        self.hwadapter.set_sidlist_out(monitored_path['returnsidlist'])
+        self.add_monitored_path(key, monitored_path)
         return 0
 
+    def start_meas_many(self, paths, interval=DEFAULT_INTERVAL,
+                        margin=DEFAULT_MARGIN, num_color=DEFAULT_NUM_COLOR):
+        """Start a batch of measurement processes with the same color
+        options. 'paths' is a list of (SID list, return SID list) tuples,
+        where the SID lists are lists of SIDs or strings of SIDs separated
+        by slashes. Return the list of the status codes of the paths
+        (STATUS_*)"""
+
+        # pylint: disable=too-many-locals
+
+        statuses, valid = validate_paths(paths, self.monitored_paths)
+        if valid and not self.set_color_options(interval, margin,
+                                                num_color):
+            return [STATUS_INVALID_OPTIONS] * len(paths)
+        for _, key, _, _ in valid:
+            if key in self.auto_paths:
+                self.evict_auto_path(key)
+        flows = []
+        for _, _, sid_list, rev_sid_list in valid:
+            flows.append((snapshots.DIRECTION_RX, sid_list))
+            flows.append((snapshots.DIRECTION_TX, rev_sid_list))
+        added = self.hwadapter.set_flows(flows)
+        rollback = []
+        for idx, (index, key, sid_list, rev_sid_list) in enumerate(valid):
+            if not (added[2 * idx] and added[2 * idx + 1]):
+                # Remove the flow of the other direction, if added
+                rollback.extend(flow for flow, flow_added in
+                                zip(flows[2 * idx:2 * idx + 2],
+                                    added[2 * idx:2 * idx + 2])
+                                if flow_added)
+                statuses[index] = STATUS_DRIVER_ERROR
+                continue
+            monitored_path = self.build_monitored_path(sid_list,
+                                                       rev_sid_list)
+            self.add_monitored_path(key, monitored_path)
+        if rollback:
+            self.hwadapter.rem_flows(rollback)
+        print('REFLECTOR: Started {num} of {total} paths'.format(
+            num=statuses.count(STATUS_OK), total=len(paths)))
+        return statuses
+
     def stop_meas(self, sid_list):
         """Stop a measurement process"""
 
         print('REFLECTOR: Stop Meas for ' + sid_list)
 
-        self.started_meas = False
-        self.hwadapter.rem_sidlist_in(self.monitored_path['sidlist'])
-        self.hwadapter.rem_sidlist_out(self.monitored_path['returnsidlist'])
-        self.monitored_path = {}
+        monitored_path = self.remove_monitored_path(
+            utils.sid_list_key(sid_list.split('/')))
+        if monitored_path is None:
+            return -1  # not started
+        self.hwadapter.rem_sidlist_in(monitored_path['sidlist'])
+        self.hwadapter.rem_sidlist_out(monitored_path['returnsidlist'])
         # Clear color options
         # self.interval = None
         # self.margin = None
         # self.num_color = None
         return 1  # mettere in un try e semmai tornare errore
 
+    def stop_meas_many(self, sid_lists):
+        """Stop a batch of measurement processes. 'sid_lists' is a list of
+        SID lists, given as lists of SIDs or as strings of SIDs separated
+        by slashes. Return the list of the status codes of the SID lists
+        (STATUS_*)"""
+
+        statuses, removed = remove_paths(sid_lists,
+                                         self.remove_monitored_path)
+        flows = []
+        for _, _, monitored_path in removed:
+            flows.append((snapshots.DIRECTION_RX, monitored_path['sidlist']))
+            flows.append((snapshots.DIRECTION_TX,
+                          monitored_path['returnsidlist']))
+        if flows:
+            self.hwadapter.rem_flows(flows)
+        print('REFLECTOR: Stopped {num} of {total} paths'.format(
+            num=statuses.count(STATUS_OK), total=len(sid_lists)))
+        return statuses
+
+    def set_color_options(self, interval, margin, num_color):
+        """Set the color options of the reflector. The active color is
+        shared by all the paths, so the options can be changed only if no
+        path is running. Return False if the options are not valid or do
+        not match the ones of the running paths"""
+
+        # pylint: disable=too-many-return-statements
+
+        # The driver can only mark the colors of its maps
+        driver_colors = getattr(self.hwadapter, 'num_color', None)
+        if num_color < 2:
+            print('REFLECTOR: at least 2 colors are required')
+            return False
+        if driver_colors is not None and num_color > driver_colors:
+            print('REFLECTOR: the driver supports at most {max} colors'
+                  .format(max=driver_colors))
+            return False
+        if interval < MIN_INTERVAL:
+            print('REFLECTOR: the interval must be at least {min} s'.format(
+                min=MIN_INTERVAL))
+            return False
+        # The counters must be read before the color is used again, as in
+        # SessionSender.check_color_options
+        max_margin = (num_color - 1) * interval / 2
+        if margin <= 0 or margin / 1000 >= max_margin:
+            print('REFLECTOR: the margin must be positive and shorter '
+                  'than {max} s'.format(max=max_margin))
+            return False
+        if not self.monitored_paths and not self.auto_paths:
+            self.interval = interval
+            self.margin = timedelta(milliseconds=margin)
+            self.num_color = num_color
+        elif num_color != self.num_color or \
+                not utils.is_multiple(interval, self.interval):
+            print('REFLECTOR: the color options do not match the ones of '
+                  'the running paths')
+            return False
+        elif math.gcd(int(round(interval / self.interval)),
+                      self.num_color) != 1:
+            # Consecutive queries of the path would read the same colors
+            print('REFLECTOR: the interval ratio must be coprime with the '
+                  'number of colors {num_color}'.format(
+                      num_color=self.num_color))
+            return False
+        return True
+
+    def add_monitored_path(self, key, monitored_path):
+        """Add a path, whose eBPF flows are already installed, to the
+        answered ones and store it in the checkpoint"""
+
+        self.monitored_paths[key] = monitored_path
+        if self.checkpoint is not None:
+            monitored_path['checkpointSlot'] = self.checkpoint.store(
+                '/'.join(monitored_path['sidlist']),
+                '/'.join(monitored_path['returnsidlist']),
+                self.interval, self.margin.total_seconds() * 1000,
+                self.num_color,
+                seq_num=monitored_path['revTxSequenceNumber'])
+
+    def remove_monitored_path(self, key):
+        """Remove a path from the answered ones and from the checkpoint.
+        Return the path, or None if it is not answered. The eBPF flows are
+        removed by the caller"""
+
+        monitored_path = self.monitored_paths.pop(key, None)
+        if monitored_path is None:
+            return None
+        if monitored_path.get('checkpointSlot') is not None:
+            self.checkpoint.clear(monitored_path['checkpointSlot'])
+        self.sessions.remove(monitored_path)
+        return monitored_path
+
+    def set_sender_return_path(self, sender, rev_sid_list):
+        """Set the return SID list used by a stateless reflector to answer
+        the queries received from a sender"""
+
+        sender = utils.canonical_sid(sender)
+        self.sender_return_paths[sender] = rev_sid_list.split('/')
+        # Drop the paths already provisioned for the sender, they will be
+        # provisioned again with the new return SID list
+        with self.lock:
+            self.evict_sender_paths(sender)
+        return 1
+
+    def rem_sender_return_path(self, sender):
+        """Remove the return SID list configured for a sender"""
+
+        sender = utils.canonical_sid(sender)
+        if self.sender_return_paths.pop(sender, None) is None:
+            return -1
+        with self.lock:
+            self.evict_sender_paths(sender)
+        return 1
+
+    def restore_sessions(self):
+        """Resume the paths stored in the checkpoint by the previous
+        instance of the daemon. Return the number of resumed paths"""
+
+        if self.checkpoint is None:
+            return 0
+        resumed = 0
+        for record in self.checkpoint.load():
+            res = self.start_meas(record['sid_list'], record['rev_sid_list'],
+                                  record['interval'], record['margin'],
+                                  record['num_color'])
+            # start_meas has stored the path in a new record
+            self.checkpoint.clear(record['slot'])
+            if res != 0:
+                continue
+            monitored_path = self.monitored_paths[
+                utils.sid_list_key(record['sid_list'].split('/'))]
+            monitored_path['revTxSequenceNumber'] = record['seq_num']
+            self.checkpoint_seq(monitored_path, record['seq_num'])
+            resumed += 1
+        print('REFLECTOR: Resumed {num} paths'.format(num=resumed))
+        return resumed
+
+    # ''' Stateless mode '''
+
+    def get_auto_path(self, key, sid_list, sender):
+        """Return the auto-provisioned path for a SID list received from a
+        sender, provisioning it if it is the first time we see it"""
+
+        monitored_path = self.auto_paths.get(key)
+        if monitored_path is not None:
+            # Keep the recently used paths at the end of the LRU
+            self.auto_paths.move_to_end(key)
+            return monitored_path
+
+        rev_sid_list = self.sender_return_paths.get(sender)
+        if rev_sid_list is None:
+            rev_sid_list = utils.derive_return_sid_list(
+                sid_list, sender, self.locator_len)
+        monitored_path = self.build_monitored_path(sid_list, rev_sid_list)
+        monitored_path['sender'] = sender
+        print('REFLECTOR: Auto Provisioning for ' + key)
+        self.hwadapter.set_sidlist_in(monitored_path['sidlist'])
+        self.hwadapter.set_sidlist_out(monitored_path['returnsidlist'])
+        self.auto_paths[key] = monitored_path
+        # Evict the least recently used path
+        if len(self.auto_paths) > self.max_auto_paths:
+            self.evict_auto_path(next(iter(self.auto_paths)))
+        return monitored_path
+
+    def evict_auto_path(self, key):
+        """Remove an auto-provisioned path and its eBPF flows"""
+
+        monitored_path = self.auto_paths.pop(key)
+        print('REFLECTOR: Auto Eviction for ' + key)
+        self.hwadapter.rem_sidlist_in(monitored_path['sidlist'])
+        self.hwadapter.rem_sidlist_out(monitored_path['returnsidlist'])
+        self.sessions.remove(monitored_path)
+
+    def evict_sender_paths(self, sender):
+        """Remove all the paths auto-provisioned for a sender"""
+
+        for key in [key for key, monitored_path in self.auto_paths.items()
+                    if monitored_path['sender'] == sender]:
+            self.evict_auto_path(key)
+
     # ''' Utility methods '''
 
+    def build_monitored_path(self, sid_list, rev_sid_list):
+        """Build the state of a path answered by the reflector. The path
+        takes an id in the table of the sessions, released when the path
+        is removed or evicted"""
+
+        return sessions.ReflectorSession(self.sessions, sid_list,
+                                         rev_sid_list)
+
+    def checkpoint_seq(self, monitored_path, seq_num):
+        """Store the sequence number of a path in the checkpoint"""
+
+        if monitored_path.get('checkpointSlot') is not None:
+            self.checkpoint.update_seq(monitored_path['checkpointSlot'],
+                                       seq_num)
+
+    def read_counter(self, direction, color, sid_list):
+        """Return a counter of the last closed interval marked with a
+        color, from the snapshot of the interval if it has been taken"""
+
+        num_interval = snapshots.last_interval_of_color(
+            self.get_num_interval(), color, self.num_color)
+        return self.counter_snapshots.read(
+            num_interval, color, direction, sid_list)
+
+    def now(self):
+        """Return the current time of the reference clock (POSIX timestamp
+        in seconds)"""
+
+        if self.clock is None:
+            return time.time()
+        return self.clock.now()
+
+    def get_num_interval(self):
+        """Return the number of the current interval. The interval n
+        starts at (n - 1) * interval and ends at n * interval"""
+
+        return math.floor(self.now() / self.interval) + 1
+
     def get_nexttime_to_change_color(self):
         """Return the next instant of change color"""
 
-        date = datetime.now()
-        date_timestamp = date.timestamp()
-        num_interval = math.ceil(date_timestamp / self.interval)
+        num_interval = self.get_num_interval()
         return datetime.fromtimestamp(num_interval * self.interval)
 
     def get_nexttime_to_measure(self):
@@ -880,15 +2148,11 @@ class SessionReflector(Thread):
     def get_color(self):
         """Return the current color"""
 
-        date = datetime.now()
-        date_timestamp = date.timestamp()
-        num_interval = math.ceil(date_timestamp / self.interval)
+        num_interval = self.get_num_interval()
         return num_interval % self.num_color
 
     def get_prev_color(self):
         """Return the previous color"""
 
-        date = datetime.now()
-        date_timestamp = date.timestamp()
-        num_interval = math.ceil(date_timestamp / self.interval)
+        num_interval = self.get_num_interval()
         return (num_interval - 1) % self.num_color
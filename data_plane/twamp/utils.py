@@ -3,6 +3,24 @@
 
 """This module contains a collection of utilities used by several modules"""
 
+import ipaddress
+import socket
+import struct
+
+# IPv6 next header values
+IPPROTO_ROUTING = 43
+IPPROTO_IPV6 = 41
+IPPROTO_UDP = 17
+# Length of the IPv6 header
+IPV6_HDR_LEN = 40
+# Length of the fixed part of the Segment Routing Header
+SRH_FIXED_LEN = 8
+# Length of the UDP header
+UDP_HDR_LEN = 8
+# Function of the SID used to decapsulate the TWAMP packets (without punt),
+# i.e. the function set by rem_punt()
+DECAP_FUNCTION = 0x100
+
 
 def set_punt(sid_list):
     """Set PUNT to a SID list and return the new SID list"""
@@ -22,3 +40,89 @@ def rem_punt(sid_list):
 def sid_list_converter(sid_list):
     """Convert list reporesentation of a SID list to a string representation"""
     return ",".join(sid_list)
+
+
+def is_multiple(value, base, tolerance=1e-6):
+    """Return True if a (float) value is a positive integer multiple of
+    base"""
+
+    ratio = round(value / base)
+    return ratio >= 1 and abs(ratio * base - value) <= tolerance
+
+
+def canonical_sid(sid):
+    """Return the canonical (compressed) text representation of a SID"""
+
+    return socket.inet_ntop(socket.AF_INET6,
+                            socket.inet_pton(socket.AF_INET6, sid))
+
+
+def parse_sid_list(sid_list):
+    """Return the canonical SIDs of a SID list, given as a list of SIDs or
+    as a string of SIDs separated by slashes. Raise ValueError if the SID
+    list is empty or contains an invalid SID"""
+
+    if isinstance(sid_list, str):
+        sid_list = sid_list.split('/')
+    if len(sid_list) == 0:
+        raise ValueError('Empty SID list')
+    try:
+        return [canonical_sid(sid) for sid in sid_list]
+    except (OSError, TypeError) as err:
+        raise ValueError('Invalid SID list {sl}'.format(sl=sid_list)) from err
+
+
+def sid_list_key(sid_list):
+    """Return the key used to index a SID list, i.e. the canonical
+    representation of its SIDs separated by slashes"""
+
+    return '/'.join(canonical_sid(sid) for sid in sid_list)
+
+
+def node_sid(address, locator_len, function=DECAP_FUNCTION):
+    """Return the SID of a function on the node owning an address, assuming
+    that the address belongs to the locator of the node"""
+
+    locator = ipaddress.IPv6Network((address, locator_len), strict=False)
+    return str(locator.network_address + function)
+
+
+def derive_return_sid_list(sid_list, sender, locator_len):
+    """Derive the return SID list of a path from its SID list and from the
+    address of the sender, assuming that the path is symmetric: the transit
+    SIDs are traversed in reverse order and the last SID is the decap SID
+    of the sender"""
+
+    return sid_list[-2::-1] + [node_sid(sender, locator_len)]
+
+
+def parse_srv6_udp(data):
+    """Parse a raw IPv6 packet carrying an SRH, an inner IPv6 header and a
+    UDP datagram (the format of the TWAMP packets) without using scapy.
+    Return a tuple (SRH addresses, UDP destination port, offset of the
+    UDP payload) or None if the packet does not match the format"""
+
+    # Outer IPv6 header followed by the SRH
+    if len(data) < IPV6_HDR_LEN + SRH_FIXED_LEN or \
+            data[6] != IPPROTO_ROUTING:
+        return None
+    srh = IPV6_HDR_LEN
+    next_header, hdr_ext_len, _, _, last_entry = \
+        struct.unpack_from('!BBBBB', data, srh)
+    if next_header != IPPROTO_IPV6:
+        return None
+    # The addresses are carried in the SRH in reverse order,
+    # as in the "addresses" field of scapy
+    addresses = [
+        socket.inet_ntop(socket.AF_INET6,
+                         data[srh + SRH_FIXED_LEN + 16 * i:
+                              srh + SRH_FIXED_LEN + 16 * (i + 1)])
+        for i in range(last_entry + 1)
+    ]
+    # Inner IPv6 header followed by UDP
+    inner = srh + (hdr_ext_len + 1) * 8
+    udp = inner + IPV6_HDR_LEN
+    if len(data) < udp + UDP_HDR_LEN or data[inner + 6] != IPPROTO_UDP:
+        return None
+    dport, = struct.unpack_from('!H', data, udp + 2)
+    return addresses, dport, udp + UDP_HDR_LEN
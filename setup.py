@@ -20,6 +20,8 @@ if os.path.isfile(requirements_path):
 packages = [
     'data_plane',
     'data_plane/twamp',
+    'data_plane/benchmarks',
+    'data_plane/traffic_generator',
 ]
 
 setuptools.setup(